@@ -0,0 +1,91 @@
+'''安全模式的单条消息开销: 明文模式 vs 安全模式(校验msg_signature + 解密 + 加密回复)
+两种模式都包含签名校验、消息解析和回复生成，差值就是加解密带来的额外开销
+运行: python benchmark/bench_crypto.py [次数]
+'''
+import os
+import sys
+import time
+import base64
+import timeit
+import hashlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.crypto import WeChatCrypto
+from tools.xml_codec import parse_message, unparse_reply
+from bench_xml_codec import REQUESTS, REPLIES
+
+
+TOKEN = "benchmark_token"
+APPID = "wxbenchmark000000"
+AES_KEY = base64.b64encode(os.urandom(32)).decode().rstrip("=")
+TIMESTAMP = str(int(time.time()))
+NONCE = "1234567890"
+
+crypto = WeChatCrypto(TOKEN, AES_KEY, APPID)
+
+
+def sign(*items):
+    return hashlib.sha1("".join(sorted(items)).encode()).hexdigest()
+
+
+def make_envelope(body:bytes):
+    '''模拟微信发来的安全模式消息'''
+    encrypt = crypto.encrypt(body)
+    envelope = f"<xml><ToUserName><![CDATA[gh_123456]]></ToUserName><Encrypt><![CDATA[{encrypt}]]></Encrypt></xml>".encode()
+    return envelope, sign(TOKEN, TIMESTAMP, NONCE, encrypt)
+
+
+def plain_mode(body:bytes, reply:dict, signature:str):
+    assert sign(TOKEN, TIMESTAMP, NONCE) == signature
+    parse_message(body)
+    return unparse_reply(reply)
+
+
+def safe_mode(envelope:bytes, reply:dict, signature:str, msg_signature:str):
+    assert sign(TOKEN, TIMESTAMP, NONCE) == signature
+    encrypt = parse_message(envelope)["Encrypt"]
+    assert crypto.verify(msg_signature, TIMESTAMP, NONCE, encrypt)
+    parse_message(crypto.decrypt(encrypt))
+    return crypto.encrypt_reply(unparse_reply(reply), TIMESTAMP, NONCE)
+
+
+def check():
+    '''加密回复能被解出原文，解密结果与原消息一致'''
+    for body in REQUESTS.values():
+        envelope, msg_signature = make_envelope(body)
+        encrypt = parse_message(envelope)["Encrypt"]
+        assert crypto.verify(msg_signature, TIMESTAMP, NONCE, encrypt)
+        assert crypto.decrypt(encrypt) == body
+    for reply in REPLIES.values():
+        xml = unparse_reply(reply)
+        encrypted = parse_message(crypto.encrypt_reply(xml, TIMESTAMP, NONCE))
+        assert encrypted["MsgSignature"] == sign(TOKEN, TIMESTAMP, NONCE, encrypted["Encrypt"])
+        assert crypto.decrypt(encrypted["Encrypt"]).decode() == xml
+
+
+def bench(label:str, func, number:int):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    print(f"{label:<28}{seconds / number * 1e6:>10.2f} us/op")
+    return seconds
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    check()
+    print(f"python {sys.version.split()[0]}, {number} ops x 5")
+    signature = sign(TOKEN, TIMESTAMP, NONCE)
+    for name, reply_name in (("text", "text"), ("image", "image"), ("event", "news")):
+        body, reply = REQUESTS[name], REPLIES[reply_name]
+        envelope, msg_signature = make_envelope(body)
+        plain = bench(f"{name} plaintext", lambda: plain_mode(body, reply, signature), number)
+        safe = bench(f"{name} safe mode", lambda: safe_mode(envelope, reply, signature, msg_signature), number)
+        print(f"{'':<28}{(safe - plain) / number * 1e6:>+10.2f} us/op ({safe / plain:.1f}x)")
+    for size in (256, 4096):
+        data = os.urandom(size // 2).hex().encode()
+        encrypt = crypto.encrypt(data)
+        bench(f"encrypt {size}B", lambda: crypto.encrypt(data), number)
+        bench(f"decrypt {size}B", lambda: crypto.decrypt(encrypt), number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+'''请求处理中记录消息内容和来源ip日志的耗时(调用logger的线程中花费的时间)
+text: loguru的文本文件sink；json: 后台线程写文件；json 1%: 按1%采样
+每次记录之间sleep一段时间，模拟事件循环等待网络io的空闲，后台线程在空闲时写文件
+运行: python benchmark/bench_logging.py [次数] [每次间隔的秒数]
+'''
+import os
+import sys
+import json
+import time
+import glob
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from loguru import logger
+from tools.log_sink import LogSampler, BackgroundJsonSink, text_format
+from tools.xml_codec import parse_message
+from bench_xml_codec import REQUESTS
+
+
+def log_message(request_data:dict):
+    logger.bind(category="body", data=request_data).debug("收到消息")
+    logger.bind(category="remote_ip", data="101.226.103.61").debug("远程ip")
+
+
+def bench(label:str, request_data:dict, number:int, idle:float):
+    costs = []
+    for _ in range(number):
+        start = time.perf_counter()
+        log_message(request_data)
+        costs.append(time.perf_counter() - start)
+        time.sleep(idle)
+    costs.sort()
+    print(f"{label:<16}{sum(costs) / number * 1e6:>10.2f} us/op  p99 {costs[int(number * 0.99)] * 1e6:.2f} us"
+          f"  max {costs[-1] * 1e6:.2f} us")
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    idle = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0005
+    request_data = parse_message(REQUESTS["text"])
+    print(f"python {sys.version.split()[0]}, {number} ops, idle {idle * 1000}ms")
+    with tempfile.TemporaryDirectory() as tmp:
+        logger.remove()
+        handler = logger.add(os.path.join(tmp, "web_app.log"), level="DEBUG", format=text_format)
+        bench("text", request_data, number, idle)
+        logger.remove(handler)
+        for label, rates in (("json", None), ("json 1%", {"body": 0.01, "remote_ip": 0.01})):
+            # 队列足够大，不丢弃记录
+            sink = BackgroundJsonSink(os.path.join(tmp, label), queue_size=number * 2)
+            handler = logger.add(sink, level="DEBUG", format="{message}", filter=LogSampler(rates))
+            bench(label, request_data, number, idle)
+            logger.remove(handler)
+            written = 0
+            for path in glob.glob(os.path.join(tmp, f"{label}.*")):
+                with open(path, encoding="utf-8") as f:
+                    for line in f:
+                        json.loads(line)
+                        written += 1
+            print(f"{'':<16}written {written} records")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+'''xml编解码的性能对比: xmltodict vs tools.xml_codec
+运行: python benchmark/bench_xml_codec.py [次数]
+'''
+import os
+import sys
+import timeit
+import xmltodict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.xml_codec import parse_message, unparse_reply
+
+
+REQUESTS = {
+    "text": b'<xml><ToUserName><![CDATA[gh_123456]]></ToUserName><FromUserName><![CDATA[oABCDEFG1234567]]></FromUserName>'
+            b'<CreateTime>1700000000</CreateTime><MsgType><![CDATA[text]]></MsgType><Content><![CDATA[hello <world> & you]]></Content>'
+            b'<MsgId>23456789012345678</MsgId></xml>',
+    "image": b'<xml><ToUserName><![CDATA[gh_123456]]></ToUserName><FromUserName><![CDATA[oABCDEFG1234567]]></FromUserName>'
+             b'<CreateTime>1700000000</CreateTime><MsgType><![CDATA[image]]></MsgType><PicUrl><![CDATA[http://mmbiz.qpic.cn/abc]]></PicUrl>'
+             b'<MediaId><![CDATA[media_id_123]]></MediaId><MsgId>23456789012345678</MsgId></xml>',
+    "event": b'<xml><ToUserName><![CDATA[gh_123456]]></ToUserName><FromUserName><![CDATA[oABCDEFG1234567]]></FromUserName>'
+             b'<CreateTime>1700000000</CreateTime><MsgType><![CDATA[event]]></MsgType><Event><![CDATA[subscribe]]></Event>'
+             b'<EventKey><![CDATA[qrscene_123]]></EventKey></xml>',
+}
+
+_BASE = {"ToUserName": "oABCDEFG1234567", "FromUserName": "gh_123456", "CreateTime": 1700000000}
+REPLIES = {
+    "text": {"xml": {**_BASE, "MsgType": "text", "Content": "你好 <b> & \"quote\""}},
+    "image": {"xml": {**_BASE, "MsgType": "image", "Image": {"MediaId": "media_id_123"}}},
+    "voice": {"xml": {**_BASE, "MsgType": "voice", "Voice": {"MediaId": "media_id_123"}}},
+    "video": {"xml": {**_BASE, "MsgType": "video", "Video": {"Title": "标题", "Description": "简介", "MediaId": "media_id_123"}}},
+    "news": {"xml": {**_BASE, "MsgType": "news", "ArticleCount": 1, "Articles": {"item": {
+        "Title": "标题", "Description": "描述", "PicUrl": None, "Url": "https://example.com/?a=1&b=2"}}}},
+}
+
+
+def check():
+    '''确认两种实现的结果一致'''
+    for name, body in REQUESTS.items():
+        expected = xmltodict.parse(body)["xml"]
+        msg = parse_message(body)
+        for key, value in expected.items():
+            assert msg[key] == value, (name, key, msg[key], value)
+    for name, data in REPLIES.items():
+        assert unparse_reply(data) == xmltodict.unparse(data), name
+
+
+def bench(label:str, func, number:int):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    print(f"{label:<28}{seconds / number * 1e6:>10.2f} us/op")
+    return seconds
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    check()
+    print(f"python {sys.version.split()[0]}, {number} ops x 5")
+    for name, body in REQUESTS.items():
+        old = bench(f"parse {name} xmltodict", lambda: xmltodict.parse(body)["xml"], number)
+        new = bench(f"parse {name} xml_codec", lambda: parse_message(body), number)
+        print(f"{'':<28}{old / new:>10.1f}x")
+    for name, data in REPLIES.items():
+        old = bench(f"unparse {name} xmltodict", lambda: xmltodict.unparse(data), number)
+        new = bench(f"unparse {name} xml_codec", lambda: unparse_reply(data), number)
+        print(f"{'':<28}{old / new:>10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
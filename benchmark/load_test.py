@@ -0,0 +1,251 @@
+'''压测: 启动本地模拟的微信接口和web_app，按目标速率发送带合法签名的回调消息
+输出延迟分位数、吞吐量和web_app进程的内存，只需要一台Linux机器，不需要外网
+运行: python benchmark/load_test.py --rate 500 --duration 30 --mix text=0.6,image=0.2,event=0.2
+三个进程: 模拟微信接口、web_app、压测客户端(当前进程)，互不抢占CPU
+'''
+import os
+import sys
+import json
+import time
+import uuid
+import types
+import random
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import multiprocessing
+from collections import Counter
+from urllib.parse import urljoin
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from mock_wechat import MockWeChat
+
+
+TOKEN = "benchmark_token"
+APPID = "wxbenchmark000000"
+
+
+def run_mock(port:int, latency:float, jitter:float, error_rate:float):
+    mock = MockWeChat(latency, jitter, error_rate)
+    web.run_app(mock.make_app(), host="127.0.0.1", port=port, print=None)
+
+
+def run_app(port:int, mock_port:int, options:dict):
+    '''在子进程中启动web_app，配置通过临时的settings模块传入'''
+    settings = types.ModuleType("settings")
+    settings.API_PORT = port
+    settings.TOKEN = TOKEN
+    settings.APPID = APPID
+    settings.SECRET = "benchmark_secret"
+    settings.AES_KEY = None
+    settings.API_BASE = f"http://127.0.0.1:{mock_port}"
+    # 日志、access_token、白名单和素材缓存等文件都写到临时目录，不影响正式环境；白名单从模拟接口获取(包含127.0.0.1)
+    settings.LOG_DIR = tempfile.mkdtemp(prefix="wechat_bench_")
+    for key, value in options.items():
+        setattr(settings, key, value)
+    sys.modules["settings"] = settings
+    # 标准输出的日志仍会格式化，只是不打印到终端
+    os.chdir(settings.LOG_DIR)
+    sys.stdout = open(os.devnull, "w")
+
+    import web_app
+    app = web_app.init_app()
+    web.run_app(app, host="127.0.0.1", port=port, print=None)
+
+
+def read_memory(pid:int):
+    '''读取进程当前和峰值的常驻内存(MB)'''
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS", "VmHWM")):
+                    name, value = line.split(":")
+                    memory[name] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return memory
+
+
+def sign_query():
+    timestamp = str(int(time.time()))
+    nonce = uuid.uuid4().hex[:10]
+    signature = hashlib.sha1("".join(sorted([TOKEN, nonce, timestamp])).encode()).hexdigest()
+    return {"timestamp": timestamp, "nonce": nonce, "signature": signature}
+
+
+def build_message(kind:str, seq:int):
+    '''生成回调消息，MsgId和FromUserName各不相同，不会被去重'''
+    user = f"oBenchUser{seq % 5000:06d}"
+    head = (f"<xml><ToUserName><![CDATA[gh_benchmark]]></ToUserName><FromUserName><![CDATA[{user}]]></FromUserName>"
+            f"<CreateTime>{int(time.time())}</CreateTime>")
+    msgid = 10 ** 16 + seq
+    if kind == "text":
+        body = f"<MsgType><![CDATA[text]]></MsgType><Content><![CDATA[压测消息 {seq}]]></Content><MsgId>{msgid}</MsgId>"
+    elif kind == "image":
+        body = (f"<MsgType><![CDATA[image]]></MsgType><PicUrl><![CDATA[http://mmbiz.qpic.cn/bench/{seq}]]></PicUrl>"
+                f"<MediaId><![CDATA[bench_media_{seq}]]></MediaId><MsgId>{msgid}</MsgId>")
+    elif kind == "event":
+        event = random.choice(("subscribe", "unsubscribe", "CLICK"))
+        body = (f"<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[{event}]]></Event>"
+                f"<EventKey><![CDATA[bench_{seq}]]></EventKey>")
+        # 事件按FromUserName+CreateTime去重，用户名需要唯一
+        head = head.replace(user, f"oBenchEvent{seq:08d}")
+    else:
+        raise ValueError(kind)
+    return (head + body + "</xml>").encode()
+
+
+def parse_mix(text:str):
+    mix = {}
+    for item in text.split(","):
+        kind, weight = item.split("=")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+async def wait_ready(session:ClientSession, url:str, timeout:float=30):
+    '''等待/ready返回200(预热完成)，冷启动的耗时不计入压测结果'''
+    ready_url = urljoin(url, "/ready")
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(ready_url) as resp:
+                if resp.status == 200:
+                    return
+        except OSError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url}启动超时")
+
+
+async def generate_load(url:str, rate:float, duration:float, mix:dict, max_inflight:int):
+    '''开环发送: 按计划时间发送，不等待上一个请求返回，延迟从计划发送时间开始计算'''
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    latencies = {kind: [] for kind in kinds}
+    statuses = Counter()
+    inflight = asyncio.Semaphore(max_inflight)
+    connector = TCPConnector(limit=max_inflight)
+    async with ClientSession(connector=connector, timeout=ClientTimeout(total=30)) as session:
+        await wait_ready(session, url)
+
+        async def send(kind:str, seq:int, scheduled:float):
+            try:
+                async with session.post(url, params=sign_query(), data=build_message(kind, seq)) as resp:
+                    await resp.read()
+                    statuses[resp.status] += 1
+            except Exception as e:
+                statuses[type(e).__name__] += 1
+            else:
+                latencies[kind].append(time.perf_counter() - scheduled)
+            finally:
+                inflight.release()
+
+        total = int(rate * duration)
+        tasks = []
+        start = time.perf_counter()
+        for seq in range(total):
+            scheduled = start + seq / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if inflight.locked():
+                # 客户端并发达到上限，说明服务端已经跟不上，记为丢弃
+                statuses["dropped"] += 1
+                continue
+            await inflight.acquire()
+            kind = random.choices(kinds, weights)[0]
+            tasks.append(asyncio.ensure_future(send(kind, seq, scheduled)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    return latencies, statuses, elapsed
+
+
+def percentile(values:list, q:float):
+    if not values:
+        return 0
+    index = min(len(values) - 1, int(len(values) * q))
+    return values[index]
+
+
+def summarize(latencies:dict, statuses:Counter, elapsed:float):
+    report = {"elapsed_s": round(elapsed, 2), "status": dict(statuses), "latency_ms": {}}
+    all_values = sorted(v for values in latencies.values() for v in values)
+    report["throughput_rps"] = round(len(all_values) / elapsed, 1) if elapsed else 0
+    for kind, values in list(latencies.items()) + [("all", all_values)]:
+        values = sorted(values)
+        report["latency_ms"][kind] = {
+            "count": len(values),
+            "p50": round(percentile(values, 0.5) * 1000, 2),
+            "p90": round(percentile(values, 0.9) * 1000, 2),
+            "p99": round(percentile(values, 0.99) * 1000, 2),
+            "max": round(values[-1] * 1000, 2) if values else 0,
+        }
+    return report
+
+
+def print_report(report:dict):
+    print(f"耗时: {report['elapsed_s']}s, 吞吐量: {report['throughput_rps']} req/s")
+    print(f"状态: {report['status']}")
+    print(f"{'类型':<8}{'数量':>8}{'p50(ms)':>10}{'p90(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}")
+    for kind, item in report["latency_ms"].items():
+        print(f"{kind:<8}{item['count']:>8}{item['p50']:>10}{item['p90']:>10}{item['p99']:>10}{item['max']:>10}")
+    memory = report.get("app_memory_mb", {})
+    if memory:
+        print(f"web_app内存: 当前{memory.get('VmRSS', 0):.1f}MB, 峰值{memory.get('VmHWM', 0):.1f}MB")
+    print(f"模拟接口调用: {report.get('mock_stats')}")
+
+
+async def fetch_mock_stats(port:int):
+    async with ClientSession() as session:
+        async with session.get(f"http://127.0.0.1:{port}/__stats") as resp:
+            return await resp.json()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="web_app压测")
+    parser.add_argument("--rate", type=float, default=200, help="每秒发送的请求数")
+    parser.add_argument("--duration", type=float, default=10, help="持续秒数")
+    parser.add_argument("--mix", default="text=0.6,image=0.2,event=0.2", help="消息类型比例")
+    parser.add_argument("--max-inflight", type=int, default=1000, help="客户端最大并发请求数")
+    parser.add_argument("--port", type=int, default=18800, help="web_app端口")
+    parser.add_argument("--mock-port", type=int, default=18900, help="模拟微信接口端口")
+    parser.add_argument("--latency-ms", type=float, default=20, help="模拟接口的平均延迟")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="模拟接口延迟的随机波动")
+    parser.add_argument("--error-rate", type=float, default=0, help="模拟接口注入错误的比例")
+    parser.add_argument("--async-reply", action="store_true", help="开启异步回复(客服消息)")
+    parser.add_argument("--json", help="把结果写入json文件，便于对比")
+    args = parser.parse_args()
+
+    options = {"ASYNC_REPLY": args.async_reply}
+    ctx = multiprocessing.get_context("spawn")
+    mock = ctx.Process(target=run_mock, args=(args.mock_port, args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate))
+    app = ctx.Process(target=run_app, args=(args.port, args.mock_port, options))
+    mock.start()
+    time.sleep(0.5)
+    app.start()
+    try:
+        url = f"http://127.0.0.1:{args.port}/WeChatBizServer"
+        latencies, statuses, elapsed = asyncio.run(
+            generate_load(url, args.rate, args.duration, parse_mix(args.mix), args.max_inflight))
+        report = summarize(latencies, statuses, elapsed)
+        report["args"] = vars(args)
+        report["app_memory_mb"] = read_memory(app.pid)
+        report["mock_stats"] = asyncio.run(fetch_mock_stats(args.mock_port))
+    finally:
+        app.terminate()
+        app.join(10)
+        mock.terminate()
+        mock.join(10)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fw:
+            json.dump(report, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+'''本地模拟的微信接口服务器(api.weixin.qq.com)，用于压测，不需要访问外网
+支持: 获取token、回调ip、上传临时/永久素材、上传图文图片、客服消息、用户信息、关注者列表、永久素材列表，可配置延迟和错误注入
+运行: python benchmark/mock_wechat.py --port 18900 --latency-ms 50 --error-rate 0.01
+'''
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter
+from aiohttp import web
+
+
+class MockWeChat:
+    def __init__(self, latency:float=0, jitter:float=0, error_rate:float=0, callback_ips=("127.0.0.1",),
+                 followers:int=25000) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.callback_ips = list(callback_ips)
+        self.followers = [f"oMOCK{i:08d}" for i in range(followers)]
+        # 永久素材，{"type", "media_id", "name", "url", "update_time"}，新的在后面
+        self.materials = []
+        self.stats = Counter()
+        self.token_seq = 0
+        self.access_token = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=20 * 1024 * 1024)
+        app.router.add_get("/cgi-bin/token", self.token)
+        app.router.add_get("/cgi-bin/getcallbackip", self.callback_ip)
+        app.router.add_get("/cgi-bin/get_api_domain_ip", self.callback_ip)
+        app.router.add_post("/cgi-bin/media/upload", self.upload)
+        app.router.add_post("/cgi-bin/media/uploadimg", self.upload)
+        app.router.add_post("/cgi-bin/material/add_material", self.upload)
+        app.router.add_post("/cgi-bin/message/custom/send", self.custom_send)
+        app.router.add_post("/cgi-bin/user/info/batchget", self.user_info_batchget)
+        app.router.add_get("/cgi-bin/user/get", self.user_get)
+        app.router.add_get("/cgi-bin/media/get", self.media_get)
+        app.router.add_post("/cgi-bin/material/get_materialcount", self.material_count)
+        app.router.add_post("/cgi-bin/material/batchget_material", self.batchget_material)
+        app.router.add_get("/mock/video/{media_id}", self.video_file)
+        app.router.add_get("/__stats", self.get_stats)
+        return app
+
+    async def _simulate(self, request:web.Request, check_token:bool=True):
+        '''模拟网络延迟，按error_rate注入500或系统繁忙，校验access_token'''
+        name = request.path
+        self.stats[name] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if self.error_rate and random.random() < self.error_rate:
+            self.stats[f"{name} injected_error"] += 1
+            if random.random() < 0.5:
+                raise web.HTTPInternalServerError()
+            return web.json_response({"errcode": -1, "errmsg": "system error"})
+        if check_token and request.query.get("access_token") != self.access_token:
+            self.stats[f"{name} invalid_token"] += 1
+            return web.json_response({"errcode": 40001, "errmsg": "invalid credential"})
+
+    async def token(self, request:web.Request):
+        error = await self._simulate(request, check_token=False)
+        if error:
+            return error
+        self.token_seq += 1
+        self.access_token = f"MOCK_ACCESS_TOKEN_{self.token_seq}"
+        return web.json_response({"access_token": self.access_token, "expires_in": 7200})
+
+    async def callback_ip(self, request:web.Request):
+        error = await self._simulate(request)
+        if error:
+            return error
+        return web.json_response({"ip_list": self.callback_ips})
+
+    async def upload(self, request:web.Request):
+        # 先读完请求体，模拟真实的上传耗时
+        size = 0
+        async for chunk in request.content.iter_chunked(64 * 1024):
+            size += len(chunk)
+        self.stats["upload_bytes"] += size
+        error = await self._simulate(request)
+        if error:
+            return error
+        media_id = f"MOCK_MEDIA_{self.stats[request.path]}"
+        if request.path.endswith("uploadimg"):
+            return web.json_response({"url": f"http://mmbiz.qpic.cn/mock/{media_id}"})
+        if request.path.endswith("add_material"):
+            media_id = f"MOCK_MATERIAL_{len(self.materials)}"
+            self.materials.append({"type": request.query.get("type"), "media_id": media_id, "name": f"{media_id}.bin",
+                                   "url": f"http://mmbiz.qpic.cn/mock/{media_id}", "update_time": int(time.time())})
+        return web.json_response({
+            "type": request.query.get("type"),
+            "media_id": media_id,
+            "created_at": int(time.time()),
+            "url": f"http://mmbiz.qpic.cn/mock/{media_id}"
+        })
+
+    async def custom_send(self, request:web.Request):
+        await request.read()
+        error = await self._simulate(request)
+        if error:
+            return error
+        return web.json_response({"errcode": 0, "errmsg": "ok"})
+
+    async def user_info_batchget(self, request:web.Request):
+        data = await request.json()
+        error = await self._simulate(request)
+        if error:
+            return error
+        user_list = data.get("user_list", [])
+        self.stats["user_info_openids"] += len(user_list)
+        if len(user_list) > 100:
+            return web.json_response({"errcode": 45035, "errmsg": "too many openids"})
+        return web.json_response({"user_info_list": [
+            {"subscribe": 1, "openid": user["openid"], "nickname": f"nick_{user['openid'][-4:]}", "tagid_list": []}
+            for user in user_list
+        ]})
+
+    async def user_get(self, request:web.Request):
+        error = await self._simulate(request)
+        if error:
+            return error
+        next_openid = request.query.get("next_openid")
+        start = self.followers.index(next_openid) + 1 if next_openid in self.followers else 0
+        page = self.followers[start:start + 10000]
+        return web.json_response({
+            "total": len(self.followers),
+            "count": len(page),
+            "data": {"openid": page} if page else {},
+            "next_openid": page[-1] if page else ""
+        })
+
+    async def media_get(self, request:web.Request):
+        '''video开头的MediaId返回video_url，invalid开头的返回错误，其他返回1MB的图片内容'''
+        error = await self._simulate(request)
+        if error:
+            return error
+        media_id = request.query.get("media_id", "")
+        if media_id.startswith("invalid"):
+            return web.json_response({"errcode": 40007, "errmsg": "invalid media_id"})
+        if media_id.startswith("video"):
+            return web.json_response({"video_url": f"http://{request.host}/mock/video/{media_id}"})
+        return await self._stream_file(request, "image/jpeg", 1024 * 1024)
+
+    async def video_file(self, request:web.Request):
+        self.stats[request.path.rsplit("/", 1)[0]] += 1
+        return await self._stream_file(request, "video/mp4", 8 * 1024 * 1024)
+
+    async def _stream_file(self, request:web.Request, content_type:str, size:int):
+        resp = web.StreamResponse(headers={"Content-Type": content_type, "Content-Length": str(size)})
+        await resp.prepare(request)
+        chunk = b"\xff" * (64 * 1024)
+        for _ in range(size // len(chunk)):
+            await resp.write(chunk)
+        self.stats["download_bytes"] += size
+        return resp
+
+    async def material_count(self, request:web.Request):
+        error = await self._simulate(request)
+        if error:
+            return error
+        counts = Counter(item["type"] for item in self.materials)
+        return web.json_response({f"{t}_count": counts.get(t, 0) for t in ("image", "voice", "video", "news")})
+
+    async def batchget_material(self, request:web.Request):
+        data = await request.json()
+        error = await self._simulate(request)
+        if error:
+            return error
+        # 按更新时间倒序
+        items = sorted((item for item in self.materials if item["type"] == data["type"]),
+                       key=lambda item: item["update_time"], reverse=True)
+        page = items[data.get("offset", 0):data.get("offset", 0) + min(data.get("count", 20), 20)]
+        result = []
+        for item in page:
+            if item["type"] == "news":
+                result.append({"media_id": item["media_id"], "update_time": item["update_time"], "content": {
+                    "news_item": [{"title": item["name"], "url": item["url"], "content": "<p>...</p>"}]}})
+            else:
+                result.append({key: item[key] for key in ("media_id", "name", "url", "update_time")})
+        return web.json_response({"total_count": len(items), "item_count": len(result), "item": result})
+
+    async def get_stats(self, request:web.Request):
+        return web.json_response(dict(self.stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的微信接口服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18900)
+    parser.add_argument("--latency-ms", type=float, default=0, help="每个接口的平均延迟")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="延迟的随机波动范围")
+    parser.add_argument("--error-rate", type=float, default=0, help="注入错误(500或errcode -1)的比例")
+    args = parser.parse_args()
+    mock = MockWeChat(args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate)
+    web.run_app(mock.make_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import time
+from aiohttp import web
+from aiohttp.web_request import Request
+from tools.metrics import registry, REQUEST_LATENCY, REQUESTS
+
+
+@web.middleware
+async def metrics_middleware(request:Request, handler):
+    '''放在最外层，记录回调请求经过白名单、签名校验和处理函数的总耗时
+    msg_type和event由RenderApiView解析消息后写入request，被拦截的请求为空
+    '''
+    if request.path in request.app.get("public_paths", ()):
+        return await handler(request)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        msg_type = request.get("msg_type", "")
+        event = request.get("event", "")
+        REQUEST_LATENCY.labels(msg_type, event).observe(time.perf_counter() - start)
+        REQUESTS.labels(msg_type, event, status).inc()
+
+
+async def metrics_handler(request:Request):
+    '''Prometheus抓取接口，不经过白名单和签名校验，需要在网关或防火墙限制访问来源'''
+    return web.Response(
+        body=registry.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
@@ -2,12 +2,15 @@ import hashlib
 from loguru import logger
 from aiohttp import web
 from aiohttp.web_request import Request
+from tools.xml_codec import XMLParseError, parse_message
 
 
 def VerifyMiddleware(biz_token):
 
     @web.middleware
     async def verify_middleware(request:Request, handler):
+        if request.path in request.app.get("public_paths", ()):
+            return await handler(request)
         query = request.query
         timestamp = query.get("timestamp")
         signature = query.get("signature") 
@@ -20,7 +23,17 @@ def VerifyMiddleware(biz_token):
                 reason='Invalid parameter',
             )
         
-        sign_str = "".join(sorted([biz_token, nonce, timestamp])).encode()
+        token = biz_token
+        # 多公众号: /WeChatBizServer/{appid}使用该公众号自己的令牌
+        appid = request.match_info.get("appid")
+        if appid is not None:
+            accounts = request.app.get("accounts")
+            token = accounts.token(appid) if accounts else None
+            if not token:
+                raise web.HTTPNotFound(
+                    reason='Unknown appid',
+                )
+        sign_str = "".join(sorted([token, nonce, timestamp])).encode()
         sign = hashlib.sha1(sign_str).hexdigest()
         if sign != signature:
             logger.info(request.url)
@@ -28,6 +41,38 @@ def VerifyMiddleware(biz_token):
                 reason='Signature verification failed',
             )
         
+        if query.get("encrypt_type") == "aes" and request.method == "POST":
+            await verify_encrypted(request, appid)
         return await handler(request)
     
     return verify_middleware
+
+
+async def verify_encrypted(request:Request, appid:str=None):
+    '''安全模式: 校验msg_signature，通过后把加解密器和密文放到request中，由RenderApiView解密
+    没有配置aes_key的公众号按明文处理(兼容模式下消息体中同时有明文字段)
+    '''
+    accounts = request.app.get("accounts")
+    if accounts is None:
+        return
+    try:
+        envelope = parse_message(await request.read())
+    except XMLParseError:
+        raise web.HTTPBadRequest(
+            reason='Invalid xml',
+        )
+    if appid is None:
+        ba = accounts.find(envelope.get("ToUserName")) or request.app["ba"]
+        appid = ba.appid
+    crypto = accounts.crypto(appid)
+    if crypto is None:
+        return
+    query = request.query
+    encrypt = envelope.get("Encrypt")
+    if not encrypt or not crypto.verify(query.get("msg_signature"), query["timestamp"], query["nonce"], encrypt):
+        logger.info(request.url)
+        raise web.HTTPForbidden(
+            reason='Message signature verification failed',
+        )
+    request["crypto"] = crypto
+    request["encrypt"] = encrypt
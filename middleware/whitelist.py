@@ -1,47 +1,103 @@
 import os
 import time
 import json
+import asyncio
 import aiofiles
 from loguru import logger
 from aiohttp import web
 from aiohttp.web_request import Request
+from tools.filelock import file_lock
+from tools.ip_whitelist import IPMatcher, real_client_ip
 
 
-_wechat_ip_whitelist = []
-curdir = os.path.dirname(os.path.dirname(__file__))
-
 async def load_whitelist(ba):
-    filename = os.path.join(curdir, "log", "whitelist_" + time.strftime("%Y%m%d"))
-    if not os.path.exists(filename):
-        whitelist = await ba.get_callback_whitelist()
-        async with aiofiles.open(filename, 'w', encoding='utf-8') as fw:
-            await fw.write(json.dumps(whitelist))
-    else:
-        if not os.path.getsize(filename):
-            os.remove(filename)
-            return await load_whitelist(ba)
-        async with aiofiles.open(filename, 'r', encoding='utf-8') as f:
-            d = await f.read()
-        try:
-            whitelist = json.loads(d)
-        except:
-            os.remove(filename)
-            return await load_whitelist(ba)
+    '''读取当天的白名单文件，没有时请求接口并写入文件
+    多个worker进程通过文件锁协调，只有拿到锁的进程请求接口，其他进程读它写入的文件
+    '''
+    filename = os.path.join(ba.log_dir, "whitelist_" + time.strftime("%Y%m%d"))
+    async with file_lock(os.path.join(ba.log_dir, "whitelist.lock")):
+        whitelist = None
+        if os.path.exists(filename):
+            async with aiofiles.open(filename, 'r', encoding='utf-8') as f:
+                d = await f.read()
+            try:
+                whitelist = json.loads(d)
+            except ValueError:
+                pass
+        if not whitelist:
+            whitelist = await ba.get_callback_whitelist()
+            async with aiofiles.open(filename, 'w', encoding='utf-8') as fw:
+                await fw.write(json.dumps(whitelist))
     logger.info(f"获取的白名单列表: {whitelist}")
     return whitelist
 
+class CallbackWhitelist:
+    '''微信服务器的回调ip白名单，启动预热时加载(refresh)，之后每隔refresh_interval秒在后台刷新
+    刷新时整体替换编译好的IPMatcher，请求处理中不会看到更新了一半的名单；刷新失败时继续使用上一次的名单
+    在可信的反向代理(trusted_proxies)后面时，从forwarded_header中取真实的客户端地址
+    '''
+    def __init__(self, ba, refresh_interval:float=3600, trusted_proxies=(), forwarded_header:str="X-Forwarded-For") -> None:
+        self.ba = ba
+        self.refresh_interval = refresh_interval
+        self.trusted_proxies = IPMatcher(trusted_proxies)
+        self.forwarded_header = forwarded_header
+        self.matcher = IPMatcher()
+        self._lock = asyncio.Lock()
+        self._task:asyncio.Task = None
+
+    async def start(self):
+        '''启动后台刷新，第一次加载由启动预热完成'''
+        if self.refresh_interval:
+            self._task = asyncio.ensure_future(self._refresh_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def update(self, entries):
+        self.matcher = IPMatcher(entries)
+
+    async def refresh(self, only_if_empty:bool=False):
+        '''重新加载白名单，成功返回True'''
+        async with self._lock:
+            # 并发的请求在等锁期间可能已经加载好了
+            if only_if_empty and self.matcher:
+                return True
+            try:
+                matcher = IPMatcher(await load_whitelist(self.ba))
+            except Exception as e:
+                logger.warning(f"加载白名单失败，继续使用当前的{len(self.matcher)}条记录: {e!r}")
+                return False
+            if not matcher:
+                logger.warning(f"获取的白名单为空，继续使用当前的{len(self.matcher)}条记录")
+                return False
+            self.matcher = matcher
+            return True
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh()
+
+    def client_ip(self, request:Request):
+        return real_client_ip(request.remote, request.headers.get(self.forwarded_header), self.trusted_proxies)
+
 @web.middleware
 async def whitelist_middleware(request:Request, handler):
     '''只允许微信服务器发过来的请求'''
-    global _wechat_ip_whitelist
-    if not _wechat_ip_whitelist:
-        _wechat_ip_whitelist = await load_whitelist(request.app["ba"])
+    if request.path in request.app.get("public_paths", ()):
+        return await handler(request)
+    whitelist:CallbackWhitelist = request.app["whitelist"]
+    if not whitelist.matcher:
+        # 启动时加载失败，收到请求时再试一次
+        await whitelist.refresh(only_if_empty=True)
         
-    remote = request.remote
-    logger.debug(f"远程ip: {remote}")
-    if remote not in _wechat_ip_whitelist:
+    remote = whitelist.client_ip(request)
+    request["remote_ip"] = remote
+    logger.bind(category="remote_ip", data=remote).debug("远程ip")
+    if remote not in whitelist.matcher:
         raise web.HTTPForbidden(
             reason='Invalid net parameter',
         )
     return await handler(request)
-
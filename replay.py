@@ -0,0 +1,167 @@
+'''回放回调消息日志(settings.JOURNAL_DIR)中一段时间内的消息
+dry-run: 在本进程中交给处理函数，只统计(和输出)回复，不回复给用户；处理函数调用的微信接口发到--api-base
+live: 按微信的方式签名(安全模式的消息重新加密)后POST到--url指定的服务，可以作为接近线上的压测流量
+--speed为回放速度的倍数，1为按原来的时间间隔，0为不等待
+用法: python replay.py --start "2026-10-17 10:00:00" --end "2026-10-17 11:00:00" --speed 10
+      python replay.py --mode live --url http://127.0.0.1:8000/WeChatBizServer --speed 0 --concurrency 200
+'''
+import sys
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+from collections import Counter
+from datetime import datetime
+from aiohttp import ClientSession, ClientTimeout
+from loguru import logger
+import settings
+from web_app import create_accounts
+from tools.journal import JournalRecord, iter_journal
+from tools.render_view import RenderApiView
+from tools.xml_codec import XMLParseError, parse_message
+
+
+def parse_time(value:str) -> float:
+    '''时间戳或"%Y-%m-%d %H:%M:%S"格式的本地时间'''
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timestamp()
+
+
+class Replayer:
+    def __init__(self, args) -> None:
+        self.args = args
+        self.view = RenderApiView()
+        self.view.router.compile()
+        self.accounts = None
+        self.session:ClientSession = None
+        self.results = Counter()
+        self.latencies = []
+
+    async def run(self, records):
+        args = self.args
+        # 连接池需要在事件循环中创建
+        self.accounts = create_accounts(api_base=args.api_base)
+        if args.mode == "live":
+            self.session = ClientSession(timeout=ClientTimeout(total=args.timeout))
+        semaphore = asyncio.Semaphore(args.concurrency)
+        tasks = set()
+        first, started = None, time.monotonic()
+        try:
+            for count, record in enumerate(records):
+                if args.limit and count >= args.limit:
+                    break
+                if first is None:
+                    first = record.time
+                if args.speed > 0:
+                    delay = started + (record.time - first) / args.speed - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await semaphore.acquire()
+                task = asyncio.ensure_future(self.replay(record))
+                task.add_done_callback(lambda t: semaphore.release())
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            if self.session:
+                await self.session.close()
+            await self.accounts.close()
+        self.report(time.monotonic() - started)
+
+    async def replay(self, record:JournalRecord):
+        start = time.perf_counter()
+        try:
+            if self.args.mode == "live":
+                result = await self.post(record)
+            else:
+                result = await self.dispatch(record)
+        except Exception as e:
+            result = type(e).__name__
+            logger.warning(f"回放{datetime.fromtimestamp(record.time)}的消息失败: {e!r}")
+        self.latencies.append(time.perf_counter() - start)
+        self.results[result] += 1
+
+    async def dispatch(self, record:JournalRecord):
+        try:
+            request_data = parse_message(record.body)
+        except XMLParseError:
+            return "invalid xml"
+        # 与RenderApiView.get_biz_api相同的规则
+        if record.appid:
+            ba = self.accounts.get(record.appid)
+        else:
+            ba = self.accounts.find(request_data.get("ToUserName")) or self.accounts.get(settings.APPID)
+        if ba is None:
+            return "unknown appid"
+        reply = await self.view.dispatch(ba, request_data)
+        if self.args.verbose:
+            print(f"{datetime.fromtimestamp(record.time)} {request_data.get('MsgType')} -> {reply}")
+        return "success" if reply == "success" else "reply"
+
+    async def post(self, record:JournalRecord):
+        url = self.args.url.rstrip("/")
+        token = settings.TOKEN
+        if record.appid:
+            url = f"{url}/{record.appid}"
+            token = self.accounts.token(record.appid) or token
+        timestamp, nonce = str(int(time.time())), str(random.randint(10 ** 8, 10 ** 9))
+        params = {"timestamp": timestamp, "nonce": nonce,
+                  "signature": hashlib.sha1("".join(sorted([token, timestamp, nonce])).encode()).hexdigest()}
+        body = record.body
+        if record.encrypted:
+            to_user = parse_message(body).get("ToUserName")
+            ba = self.accounts.get(record.appid) if record.appid else \
+                self.accounts.find(to_user) or self.accounts.get(settings.APPID)
+            crypto = self.accounts.crypto(ba.appid)
+            if crypto:
+                encrypt = crypto.encrypt(body)
+                params.update(encrypt_type="aes", msg_signature=crypto.signature(timestamp, nonce, encrypt))
+                body = (f"<xml><ToUserName><![CDATA[{to_user}]]></ToUserName>"
+                        f"<Encrypt><![CDATA[{encrypt}]]></Encrypt></xml>").encode()
+        async with self.session.post(url, params=params, data=body, headers={"Content-Type": "text/xml"}) as resp:
+            text = await resp.text()
+        if self.args.verbose:
+            print(f"{datetime.fromtimestamp(record.time)} {resp.status} {text[:200]}")
+        return resp.status
+
+    def report(self, elapsed:float):
+        total = sum(self.results.values())
+        print(f"回放{total}条消息，耗时{elapsed:.2f}秒({total / elapsed if elapsed else 0:.1f}条/秒)")
+        for result, count in self.results.most_common():
+            print(f"  {result}: {count}")
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            p = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000
+            print(f"  耗时(ms): p50 {p(0.5):.2f}, p90 {p(0.9):.2f}, p99 {p(0.99):.2f}, max {latencies[-1] * 1000:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放回调消息日志")
+    parser.add_argument("--dir", default=getattr(settings, "JOURNAL_DIR", None) or "log/journal", help="回调消息日志目录")
+    parser.add_argument("--start", type=parse_time, help="开始时间(包含)")
+    parser.add_argument("--end", type=parse_time, help="结束时间(不包含)")
+    parser.add_argument("--mode", choices=("dry-run", "live"), default="dry-run")
+    parser.add_argument("--speed", type=float, default=1, help="回放速度倍数，0为不等待")
+    parser.add_argument("--concurrency", type=int, default=100, help="同时处理的消息数上限")
+    parser.add_argument("--limit", type=int, default=0, help="最多回放的消息数")
+    parser.add_argument("--url", help="live模式的回调地址，如http://127.0.0.1:8000/WeChatBizServer")
+    parser.add_argument("--api-base", help="dry-run模式下处理函数调用的微信接口地址，默认为settings.API_BASE")
+    parser.add_argument("--timeout", type=float, default=10, help="live模式的请求超时秒数")
+    parser.add_argument("-v", "--verbose", action="store_true", help="输出每条消息的回复")
+    args = parser.parse_args()
+    if args.mode == "live" and not args.url:
+        parser.error("live模式需要指定--url")
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    if args.mode == "dry-run" and not args.api_base and "api.weixin.qq.com" in getattr(settings, "API_BASE", "api.weixin.qq.com"):
+        logger.warning("处理函数调用的微信接口会发到线上，可以用--api-base指向benchmark/mock_wechat.py")
+    records = iter_journal(args.dir, args.start, args.end)
+    asyncio.run(Replayer(args).run(records))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,5 +6,85 @@ APPID = "wx123456575675"
 
 SECRET = "aaaaaaaaaaaaaaaaaaaaaaaaaa"
 
-# 未实现
+# 安全模式的消息加解密密钥(EncodingAESKey)，明文模式填None，需要安装cryptography
 AES_KEY = None
+
+# 消息去重缓存，默认在进程内；多进程部署时设置为sqlite文件路径，所有worker共享
+DEDUP_SQLITE_FILE = None
+
+# 异步回复: 开启后先给微信回复success，处理结果通过客服消息接口发送
+# 处理函数可以用sync_reply/deferred_reply装饰器指定回复方式，未标记的按异步处理
+ASYNC_REPLY = False
+ASYNC_REPLY_WORKERS = 4
+ASYNC_REPLY_QUEUE_SIZE = 1000
+
+# 调用微信接口的连接池参数，见tools.request.create_session
+HTTP_OPTIONS = {
+    "timeout": 15,
+    "limit": 100,
+    "limit_per_host": 30,
+    "ttl_dns_cache": 300,
+    "keepalive_timeout": 30,
+}
+
+# 微信接口地址，压测时指向benchmark/mock_wechat.py启动的模拟服务器
+API_BASE = "https://api.weixin.qq.com"
+
+# 多进程模式: 大于1时主进程预先fork出WORKERS个worker共享监听端口，worker异常退出后自动重启
+# access_token和回调ip白名单通过log目录下加锁的文件在worker之间共享，/metrics只统计当前worker
+WORKERS = 1
+# True时每个worker用SO_REUSEPORT各自监听端口(linux 3.9+)，由内核均衡分配连接
+WORKER_REUSE_PORT = False
+# 优雅退出时等待处理中的请求完成的秒数
+SHUTDOWN_TIMEOUT = 30
+
+# 多公众号: 除了上面的默认公众号，其他公众号的回调地址配置为/WeChatBizServer/{appid}
+# token不填时使用TOKEN；填写original_id(gh_开头的原始id)且没有单独令牌的公众号也可以使用/WeChatBizServer
+# 所有公众号共用一个连接池，第一次收到消息时才加载
+# "warm_up": True的公众号在启动后于后台提前加载(获取access_token、载入素材缓存)，失败只记录日志，/ready只等默认公众号
+ACCOUNTS = {
+    # "wx0000000000000000": {"secret": "...", "token": "...", "aes_key": None, "original_id": "gh_000000000000", "warm_up": False},
+}
+
+# 回调ip白名单在启动时加载，之后每隔多少秒刷新一次，0为不刷新
+WHITELIST_REFRESH_INTERVAL = 3600
+# 部署在负载均衡/反向代理后面时填写代理的地址或网段，来自这些地址的请求从FORWARDED_HEADER中取真实客户端ip
+TRUSTED_PROXIES = [
+    # "10.0.0.0/8",
+]
+FORWARDED_HEADER = "X-Forwarded-For"
+
+# 日志、access_token、白名单、素材缓存等文件的目录，None为log(web_app的日志和去重库在当前目录下，其他在项目目录下)
+LOG_DIR = None
+# 日志: text为loguru的文本文件(log/web_app.log)，json为后台线程批量写的json文件(log/web_app.json.日期)
+# json模式下日志队列满(超过LOG_QUEUE_SIZE条未写出)时丢弃新记录，丢弃数见/metrics的wechat_log_records_total
+LOG_FORMAT = "text"
+LOG_QUEUE_SIZE = 10000
+# 控制台的日志级别，控制台输出是同步的，json模式下建议设为WARNING
+LOG_STDOUT_LEVEL = "INFO"
+# 按类别采样的比例，WARNING及以上总是保留; body: 收到的消息内容，response: 微信接口的响应，remote_ip: 回调请求的来源ip
+LOG_SAMPLE_RATES = {
+    # "body": 0.01,
+    # "response": 0.01,
+    # "remote_ip": 0.01,
+}
+
+# 回调消息日志: 记录收到的每条回调消息(安全模式为解密后的明文)，用replay.py回放，None为不记录
+# 多进程时每个worker写自己的文件，文件超过JOURNAL_SEGMENT_SIZE字节后换新文件，旧文件需要自行清理
+JOURNAL_DIR = None  # "log/journal"
+JOURNAL_SEGMENT_SIZE = 64 * 1024 * 1024
+# True时每次写入后fsync，消息写入磁盘后才回复微信(合并写入，会增加回复耗时)
+JOURNAL_FSYNC = False
+
+# 准入控制: 同时处理的消息数上限(0为不限制)，超出的最多ADMISSION_QUEUE_SIZE条等待ADMISSION_QUEUE_TIMEOUT秒
+# 等不到名额或等待队列已满时立即回复，不等到微信5秒超时后重试；消息仍会写入JOURNAL_DIR
+MAX_CONCURRENT_HANDLERS = 200
+ADMISSION_QUEUE_SIZE = 200
+ADMISSION_QUEUE_TIMEOUT = 0.5
+# 每个用户(openid)每秒处理的消息数和允许的突发条数，0为不限制；最多记录USER_RATE_LIMIT_SIZE个用户
+USER_RATE_LIMIT = 1
+USER_RATE_BURST = 10
+USER_RATE_LIMIT_SIZE = 100000
+# 过载或限速时回复给用户的文本，None为回复success(用户收不到回复)
+# 处理名额和等待队列都满时不解析消息，总是回复success
+OVERLOAD_REPLY = None  # "消息太多啦，请稍后再试"
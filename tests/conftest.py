@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 在仓库根目录外运行pytest时也能导入tools
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,73 @@
+import asyncio
+from tools.admission import AdmissionController
+
+
+def test_acquire_and_release():
+    async def main():
+        admission = AdmissionController(max_concurrent=2, max_waiting=1, queue_timeout=1)
+        assert await admission.acquire()
+        assert await admission.acquire()
+        waiter = asyncio.ensure_future(admission.acquire())
+        await asyncio.sleep(0)
+        # 等待队列已满
+        assert admission.reject_early()
+        assert not await admission.acquire()
+        # 名额直接转交给等待者
+        admission.release()
+        assert await waiter
+        assert admission.active == 2
+        admission.release()
+        admission.release()
+        assert admission.active == 0
+    asyncio.run(main())
+
+
+def test_acquire_timeout():
+    async def main():
+        admission = AdmissionController(max_concurrent=1, max_waiting=5, queue_timeout=0.01)
+        assert await admission.acquire()
+        assert not await admission.acquire()
+        assert not admission._waiters
+        admission.release()
+        assert admission.active == 0
+        assert await admission.acquire()
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_returns_slot():
+    async def main():
+        admission = AdmissionController(max_concurrent=1, max_waiting=5, queue_timeout=1)
+        assert await admission.acquire()
+        waiter = asyncio.ensure_future(admission.acquire())
+        await asyncio.sleep(0)
+        # 名额转交之后等待者被取消，名额要归还
+        admission.release()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert admission.active == 0
+        assert not admission._waiters
+    asyncio.run(main())
+
+
+def test_unlimited():
+    async def main():
+        admission = AdmissionController(max_concurrent=0, user_rate=0)
+        assert all([await admission.acquire() for _ in range(1000)])
+        assert not admission.reject_early()
+        assert admission.allow_user("o1")
+    asyncio.run(main())
+
+
+def test_user_rate_limit(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("tools.admission.time.monotonic", lambda: now[0])
+    admission = AdmissionController(user_rate=1, user_burst=2, max_users=2)
+    assert admission.allow_user("o1") and admission.allow_user("o1")
+    assert not admission.allow_user("o1")
+    now[0] += 1
+    assert admission.allow_user("o1")
+    assert not admission.allow_user("o1")
+    # 最久没有消息的用户被淘汰
+    admission.allow_user("o2")
+    admission.allow_user("o3")
+    assert list(admission._buckets) == ["o2", "o3"]
@@ -0,0 +1,96 @@
+import asyncio
+import pytest
+from tools.bulk_sender import BulkSender, _chunks
+from tools.errors import QuotaExceededError, WeChatApiError
+
+
+class FakeBizApi:
+    '''只有批量发送用到的接口，记录每次发送的接收者'''
+    appid = "wx1"
+
+    def __init__(self, blocked:set=()) -> None:
+        self.sent = []
+        self.blocked = set(blocked)
+
+    async def send_template_message(self, data:dict):
+        await asyncio.sleep(0)
+        if data["touser"] in self.blocked:
+            raise WeChatApiError(43004, "require subscribe")
+        self.sent.append(data["touser"])
+        return {"errcode": 0, "msgid": len(self.sent)}
+
+
+def collect(sender:BulkSender, job_id:str, api:str, recipients):
+    async def main():
+        return [result async for result in sender.send(job_id, api, recipients, {"template_id": "T"})]
+    return asyncio.run(main())
+
+
+def test_chunks_borrow_for_min_batch():
+    async def main(recipients, size, min_size):
+        return [chunk async for chunk in _chunks(recipients, size, min_size)]
+    # 最后一批不足min_size时从上一批借
+    assert asyncio.run(main(range(7), 3, 2)) == [[0, 1, 2], [3, 4], [5, 6]]
+    assert asyncio.run(main(range(6), 3, 2)) == [[0, 1, 2], [3, 4, 5]]
+    assert asyncio.run(main([], 3, 2)) == []
+
+
+def test_failed_recipients_do_not_stop_job(tmp_path):
+    ba = FakeBizApi(blocked={"o2"})
+    sender = BulkSender(ba, str(tmp_path / "bulk.db"), qps={"template": 1000}, concurrency=2)
+    results = collect(sender, "job", "template", [f"o{i}" for i in range(5)])
+    assert sorted(result.index for result in results) == [0, 1, 2, 3, 4]
+    failed = [result for result in results if not result.ok]
+    assert [(r.openids, r.errcode) for r in failed] == [(["o2"], 43004)]
+    assert sorted(ba.sent) == ["o0", "o1", "o3", "o4"]
+    assert sender.store.load("job") == (5, set(), 4, 1)
+    # 已完成的任务再次调用不会重复发送
+    assert collect(sender, "job", "template", [f"o{i}" for i in range(5)]) == []
+    assert len(ba.sent) == 4
+    sender.close()
+
+
+def test_resume_after_quota_exceeded(tmp_path):
+    checkpoint_file = str(tmp_path / "bulk.db")
+    recipients = [f"o{i}" for i in range(10)]
+    ba = FakeBizApi()
+    sender = BulkSender(ba, checkpoint_file, qps={"template": 1000}, daily_quota={"template": 4}, concurrency=1)
+    with pytest.raises(QuotaExceededError):
+        collect(sender, "job", "template", recipients)
+    assert ba.sent == recipients[:4]
+    assert sender.store.load("job")[0] == 4
+    sender.close()
+
+    # 重启后同一天的调用次数从文件中恢复
+    sender = BulkSender(ba, checkpoint_file, qps={"template": 1000}, daily_quota={"template": 6}, concurrency=1)
+    with pytest.raises(QuotaExceededError):
+        collect(sender, "job", "template", recipients)
+    assert ba.sent == recipients[:6]
+    sender.close()
+
+    # 配额足够时从中断的位置继续，已发送的不再发送
+    sender = BulkSender(ba, checkpoint_file, qps={"template": 1000}, concurrency=4)
+    results = collect(sender, "job", "template", recipients)
+    assert sorted(result.index for result in results) == [6, 7, 8, 9]
+    assert sorted(ba.sent) == sorted(recipients)
+    assert sender.store.load("job") == (10, set(), 10, 0)
+    sender.close()
+
+
+def test_progress_saved_when_consumer_stops(tmp_path):
+    async def main():
+        ba = FakeBizApi()
+        sender = BulkSender(ba, str(tmp_path / "bulk.db"), qps={"template": 1000}, concurrency=1)
+        recipients = [f"o{i}" for i in range(10)]
+        gen = sender.send("job", "template", recipients, {"template_id": "T"})
+        first = await gen.__anext__()
+        await gen.aclose()
+        assert first.index == 0 and first.data == {"errcode": 0, "msgid": 1}
+        # 只有已经返回给调用者的批次记为完成
+        assert sender.store.load("job") == (1, set(), 1, 0)
+        rest = [result async for result in sender.send("job", "template", recipients, {"template_id": "T"})]
+        assert sorted(result.index for result in rest) == list(range(1, 10))
+        assert set(ba.sent) == set(recipients)
+        assert sender.store.load("job") == (10, set(), 10, 0)
+        sender.close()
+    asyncio.run(main())
@@ -0,0 +1,59 @@
+import base64
+import pytest
+from tools.crypto import BLOCK_SIZE, DecryptError, WeChatCrypto
+from tools.xml_codec import parse_message
+
+
+AES_KEY = "abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG"
+APPID = "wx0000000000000000"
+
+
+@pytest.fixture
+def crypto():
+    return WeChatCrypto("token", AES_KEY, APPID)
+
+
+@pytest.mark.parametrize("size", [0, 1, 11, 12, 31, 32, 100, 4096])
+def test_round_trip(crypto:WeChatCrypto, size:int):
+    body = ("消" * size).encode()[:size]
+    encrypt = crypto.encrypt(body)
+    # 随机串、长度、消息、appid按32字节填充
+    assert len(base64.b64decode(encrypt)) % BLOCK_SIZE == 0
+    assert crypto.decrypt(encrypt) == body
+
+
+def test_padding_is_full_block_when_aligned(crypto:WeChatCrypto):
+    body = b"x" * (BLOCK_SIZE * 2 - 20 - len(APPID))
+    assert len(base64.b64decode(crypto.encrypt(body))) == BLOCK_SIZE * 3
+    assert crypto.decrypt(crypto.encrypt(body)) == body
+
+
+def test_decrypt_rejects_other_appid(crypto:WeChatCrypto):
+    other = WeChatCrypto("token", AES_KEY, "wx1111111111111111")
+    with pytest.raises(DecryptError):
+        crypto.decrypt(other.encrypt(b"<xml></xml>"))
+
+
+def test_decrypt_rejects_garbage(crypto:WeChatCrypto):
+    with pytest.raises(DecryptError):
+        crypto.decrypt("not base64!")
+    with pytest.raises(DecryptError):
+        crypto.decrypt(base64.b64encode(b"\0" * 32).decode())
+
+
+def test_signature(crypto:WeChatCrypto):
+    encrypt = crypto.encrypt(b"<xml></xml>")
+    signature = crypto.signature("1700000000", "123", encrypt)
+    assert crypto.verify(signature, "1700000000", "123", encrypt)
+    assert not crypto.verify(signature, "1700000001", "123", encrypt)
+    assert not crypto.verify(None, "1700000000", "123", encrypt)
+    # 非ascii的签名返回False，不抛出TypeError
+    assert not crypto.verify("签名", "1700000000", "123", encrypt)
+
+
+def test_encrypt_reply(crypto:WeChatCrypto):
+    body = "<xml><Content><![CDATA[你好]]></Content></xml>"
+    reply = parse_message(crypto.encrypt_reply(body, "1700000000", "123"))
+    assert reply["TimeStamp"] == "1700000000"
+    assert crypto.verify(reply["MsgSignature"], "1700000000", "123", reply["Encrypt"])
+    assert crypto.decrypt(reply["Encrypt"]) == body.encode()
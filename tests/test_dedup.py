@@ -0,0 +1,123 @@
+import asyncio
+import pytest
+from tools.dedup import MemoryDedupBackend, MessageDeduplicator, SqliteDedupBackend, dedup_key
+
+
+def test_dedup_key():
+    assert dedup_key({"ToUserName": "gh", "FromUserName": "o1", "MsgId": "123", "CreateTime": "1"}) == "gh:123"
+    assert dedup_key({"ToUserName": "gh", "FromUserName": "o1", "CreateTime": "1", "Event": "subscribe"}) == "gh:o1:1"
+
+
+@pytest.mark.parametrize("backend_name", ["memory", "sqlite"])
+def test_backend_claim_complete_release(tmp_path, backend_name):
+    async def main():
+        if backend_name == "memory":
+            backend = MemoryDedupBackend()
+        else:
+            backend = SqliteDedupBackend(str(tmp_path / "dedup.db"))
+        assert await backend.claim("k", 60) == (True, None)
+        # 处理中的消息不能再次抢占，也没有回复
+        assert await backend.claim("k", 60) == (False, None)
+        assert await backend.get("k") == (False, None)
+        await backend.complete("k", "<xml>reply</xml>", 60)
+        assert await backend.claim("k", 60) == (False, "<xml>reply</xml>")
+        assert await backend.get("k") == (True, "<xml>reply</xml>")
+        # 处理失败释放后可以重新处理
+        assert await backend.claim("k2", 60) == (True, None)
+        await backend.release("k2")
+        assert await backend.claim("k2", 60) == (True, None)
+        # 过期的记录可以重新抢占
+        assert await backend.claim("k3", -1) == (True, None)
+        assert await backend.claim("k3", 60) == (True, None)
+        backend.close()
+    asyncio.run(main())
+
+
+def test_sqlite_backend_shared_between_processes(tmp_path):
+    async def main():
+        filename = str(tmp_path / "dedup.db")
+        first, second = SqliteDedupBackend(filename), SqliteDedupBackend(filename)
+        assert await first.claim("k", 60) == (True, None)
+        assert await second.claim("k", 60) == (False, None)
+        await first.complete("k", "reply", 60)
+        assert await second.get("k") == (True, "reply")
+        first.close()
+        second.close()
+    asyncio.run(main())
+
+
+def test_memory_backend_maxsize():
+    async def main():
+        backend = MemoryDedupBackend(maxsize=2)
+        for key in ("a", "b", "c"):
+            await backend.claim(key, 60)
+        assert list(backend._data) == ["b", "c"]
+    asyncio.run(main())
+
+
+def test_retry_waits_for_inflight_reply():
+    async def main():
+        dedup = MessageDeduplicator()
+        calls = []
+        started = asyncio.Event()
+        finish = asyncio.Event()
+
+        async def handler():
+            calls.append(1)
+            started.set()
+            await finish.wait()
+            return "reply"
+
+        first = asyncio.ensure_future(dedup.run("k", handler))
+        await started.wait()
+        retry = asyncio.ensure_future(dedup.run("k", handler))
+        await asyncio.sleep(0)
+        # 第一次请求的连接断开不影响处理，重试拿到同一个回复
+        first.cancel()
+        finish.set()
+        assert await retry == "reply"
+        assert calls == [1]
+        # 处理完成后的重试直接返回缓存的回复
+        assert await dedup.run("k", handler) == "reply"
+        assert calls == [1]
+        assert not dedup._inflight
+    asyncio.run(main())
+
+
+def test_failed_handler_can_be_retried():
+    async def main():
+        dedup = MessageDeduplicator()
+
+        async def fail():
+            raise RuntimeError("boom")
+
+        async def ok():
+            return "reply"
+
+        with pytest.raises(RuntimeError):
+            await dedup.run("k", fail)
+        assert await dedup.run("k", ok) == "reply"
+    asyncio.run(main())
+
+
+def test_wait_remote_worker(tmp_path):
+    async def main():
+        filename = str(tmp_path / "dedup.db")
+        worker1 = MessageDeduplicator(SqliteDedupBackend(filename), wait_timeout=2)
+        worker2 = MessageDeduplicator(SqliteDedupBackend(filename), wait_timeout=2)
+        finish = asyncio.Event()
+
+        async def handler():
+            await finish.wait()
+            return "reply"
+
+        first = asyncio.ensure_future(worker1.run("k", handler))
+        await asyncio.sleep(0.05)
+        # 另一个worker收到重试，轮询等待第一个worker的结果
+        retry = asyncio.ensure_future(worker2.run("k", handler))
+        await asyncio.sleep(0.05)
+        finish.set()
+        assert await asyncio.gather(first, retry) == ["reply", "reply"]
+        worker1.close()
+        worker2.close()
+    asyncio.run(main())
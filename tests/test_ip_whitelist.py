@@ -0,0 +1,54 @@
+import pytest
+from tools.ip_whitelist import IPMatcher, real_client_ip
+
+
+def test_single_addresses():
+    matcher = IPMatcher(["1.2.3.4", " 2001:db8::1 ", "", "5.6.7.8/32"])
+    assert len(matcher) == 3
+    assert "1.2.3.4" in matcher and "5.6.7.8" in matcher
+    assert "1.2.3.5" not in matcher
+    # 非规范格式的IPv6地址
+    assert "2001:DB8:0:0::1" in matcher and "2001:db8::1%eth0" in matcher
+    assert "2001:db8::2" not in matcher
+
+
+def test_cidr_ranges():
+    matcher = IPMatcher(["10.0.0.0/8", "192.168.1.0/24", "172.16.1.5/16", "2001:db8:abcd::/48"])
+    assert "10.255.1.2" in matcher and "192.168.1.200" in matcher
+    assert "192.168.2.1" not in matcher and "11.0.0.1" not in matcher
+    # strict=False，主机位不为0时按网段处理
+    assert "172.16.200.1" in matcher
+    assert "2001:db8:abcd:1::5" in matcher
+    assert "2001:db8:abce::5" not in matcher
+    # IPv4和IPv6的网段互不影响
+    assert "::a00:1" not in matcher
+
+
+def test_ipv4_mapped_addresses():
+    matcher = IPMatcher(["1.2.3.4", "10.0.0.0/8"])
+    assert "::ffff:1.2.3.4" in matcher
+    assert "::ffff:10.1.2.3" in matcher
+    assert "::ffff:11.1.2.3" not in matcher
+
+
+@pytest.mark.parametrize("ip", ["", "abc", "1.2.3", "1.2.3.4.5", "::g", None])
+def test_invalid_addresses(ip):
+    assert ip not in IPMatcher(["0.0.0.0/0", "::/0"])
+
+
+def test_invalid_entry():
+    with pytest.raises(ValueError):
+        IPMatcher(["1.2.3.256"])
+
+
+def test_real_client_ip():
+    proxies = IPMatcher(["127.0.0.1", "10.0.0.0/8"])
+    # 直连时忽略X-Forwarded-For，防止伪造
+    assert real_client_ip("8.8.8.8", "1.2.3.4", proxies) == "8.8.8.8"
+    assert real_client_ip("127.0.0.1", "", proxies) == "127.0.0.1"
+    assert real_client_ip("127.0.0.1", "1.2.3.4", proxies) == "1.2.3.4"
+    # 从右往左跳过可信代理，左边可能被伪造的部分不采用
+    assert real_client_ip("127.0.0.1", "6.6.6.6, 1.2.3.4, 10.0.0.2", proxies) == "1.2.3.4"
+    # 全部是可信代理时取最左边的地址
+    assert real_client_ip("127.0.0.1", "10.0.0.3,10.0.0.2", proxies) == "10.0.0.3"
+    assert real_client_ip("127.0.0.1", "1.2.3.4", IPMatcher()) == "127.0.0.1"
@@ -0,0 +1,43 @@
+import os
+import asyncio
+from tools.journal import Journal, list_segments, iter_journal, read_segment
+
+
+def write(directory:str, records:list, **options):
+    '''在事件循环中写入records: [(appid, remote, body, encrypted, received_at)]'''
+    async def main():
+        journal = Journal(str(directory), **options)
+        futures = [journal.append(*record) for record in records]
+        futures = [future for future in futures if future is not None]
+        results = await asyncio.gather(*futures)
+        journal.close()
+        return results
+    return asyncio.run(main())
+
+
+def test_append_and_iterate(tmp_path):
+    records = [("", "1.2.3.4", b"<xml>%d</xml>" % i, i % 2 == 0, 1000.0 + i) for i in range(10)]
+    assert write(tmp_path, records, fsync=True) == [True] * 10
+    result = list(iter_journal(str(tmp_path)))
+    assert [(r.appid, r.remote, r.body, r.encrypted, r.time) for r in result] == records
+    # [start, end)
+    assert [r.time for r in iter_journal(str(tmp_path), 1003, 1006)] == [1003, 1004, 1005]
+
+
+def test_rotation_and_merge(tmp_path):
+    write(tmp_path, [("wx1", "", b"a" * 100, False, 1000.0 + i) for i in range(10)], name="w0", segment_size=300, max_batch=2)
+    write(tmp_path, [("wx2", "", b"b" * 100, False, 1000.5 + i) for i in range(10)], name="w1", segment_size=300, max_batch=2)
+    segments = list_segments(str(tmp_path))
+    assert sorted(segments) == ["w0", "w1"]
+    assert len(segments["w0"]) > 1
+    times = [r.time for r in iter_journal(str(tmp_path))]
+    assert times == sorted(times) and len(times) == 20
+    assert [r.time for r in iter_journal(str(tmp_path), 1008)] == [1008, 1008.5, 1009, 1009.5]
+
+
+def test_truncated_tail_is_ignored(tmp_path):
+    write(tmp_path, [("", "", b"<xml>%d</xml>" % i, False, 1000.0 + i) for i in range(3)])
+    path, = list_segments(str(tmp_path))["journal"]
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 3)
+    assert [r.body for r in read_segment(path)] == [b"<xml>0</xml>", b"<xml>1</xml>"]
@@ -0,0 +1,51 @@
+import asyncio
+from tools.media_cache import MediaCache
+from tools.material_library import MaterialLibrary
+
+
+class FakeBizApi:
+    '''只有素材库同步用到的接口'''
+    def __init__(self, media_cache:MediaCache, items:list) -> None:
+        self.media_cache = media_cache
+        self.items = items
+
+    async def get_material_count(self):
+        return {"image_count": len(self.items)}
+
+    async def batchget_material(self, material_type:str, offset:int=0, count:int=20):
+        items = self.items if material_type == "image" else []
+        return {"item": items[offset:offset + count], "total_count": len(items)}
+
+
+def test_deleted_material_is_forgotten_by_media_cache(tmp_path):
+    async def main():
+        cache = MediaCache(str(tmp_path / "media.db"))
+        image = tmp_path / "a.jpg"
+        image.write_bytes(b"jpg")
+
+        async def upload():
+            return {"media_id": "m1", "url": "http://mmbiz/m1"}
+
+        await cache.get_or_upload("material", "image", str(image), upload)
+        ba = FakeBizApi(cache, [{"media_id": "m1", "name": "a.jpg", "update_time": 1},
+                                {"media_id": "m2", "name": "b.jpg", "update_time": 2}])
+        library = MaterialLibrary(ba, str(tmp_path / "material.db"))
+        await library.sync(["image"])
+        assert library.find_by_hash(await cache.file_hash(str(image))).media_id == "m1"
+        # m1在后台被删除，同步后素材缓存不能再返回它
+        ba.items = ba.items[1:]
+        await library.sync(["image"])
+        assert library.get("m1") is None
+        assert cache.hashes("material") == {}
+        calls = []
+
+        async def upload_again():
+            calls.append(1)
+            return {"media_id": "m3"}
+
+        assert (await cache.get_or_upload("material", "image", str(image), upload_again))["media_id"] == "m3"
+        assert calls == [1]
+        library.close()
+        cache.close()
+        assert MediaCache(str(tmp_path / "media.db")).hashes("material") == {"m3": await cache.file_hash(str(image))}
+    asyncio.run(main())
@@ -0,0 +1,59 @@
+import time
+import asyncio
+import sqlite3
+from tools.media_cache import MediaCache, TMP_MEDIA_TTL
+
+
+def make_upload(calls:list, data:dict):
+    async def upload():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return dict(data)
+    return upload
+
+
+def test_hit_returns_same_data_as_miss(tmp_path):
+    async def main():
+        path = tmp_path / "a.jpg"
+        path.write_bytes(b"jpg")
+        calls = []
+        upload = make_upload(calls, {"type": "image", "media_id": "M1", "created_at": int(time.time())})
+        cache = MediaCache(str(tmp_path / "media.db"))
+        # 并发上传同一个文件只上传一次
+        first, second = await asyncio.gather(cache.get_or_upload("tmp", "image", str(path), upload),
+                                             cache.get_or_upload("tmp", "image", str(path), upload))
+        hit = await cache.get_or_upload("tmp", "image", str(path), upload)
+        assert calls == [1]
+        assert first == second == hit and hit["type"] == "image" and "created_at" in hit
+        first["media_id"] = "changed"
+        assert (await cache.get_or_upload("tmp", "image", str(path), upload))["media_id"] == "M1"
+        cache.close()
+        reopened = MediaCache(str(tmp_path / "media.db"))
+        assert await reopened.get_or_upload("tmp", "image", str(path), upload) == hit
+        assert calls == [1]
+    asyncio.run(main())
+
+
+def test_expired_tmp_media_is_uploaded_again(tmp_path):
+    async def main():
+        path = tmp_path / "a.jpg"
+        path.write_bytes(b"jpg")
+        calls = []
+        cache = MediaCache(str(tmp_path / "media.db"))
+        old = {"type": "image", "media_id": "OLD", "created_at": time.time() - TMP_MEDIA_TTL - 1}
+        await cache.get_or_upload("tmp", "image", str(path), make_upload(calls, old))
+        data = await cache.get_or_upload("tmp", "image", str(path), make_upload(calls, {"media_id": "NEW"}))
+        assert data["media_id"] == "NEW" and len(calls) == 2
+    asyncio.run(main())
+
+
+def test_legacy_cache_file(tmp_path):
+    filename = str(tmp_path / "media.db")
+    conn = sqlite3.connect(filename)
+    conn.execute("CREATE TABLE media (hash TEXT, media_type TEXT, kind TEXT, media_id TEXT, url TEXT, created_at REAL, "
+                 "PRIMARY KEY (hash, media_type, kind))")
+    conn.execute("INSERT INTO media VALUES ('h', 'image', 'material', 'M', 'http://u', 0)")
+    conn.commit()
+    conn.close()
+    cache = MediaCache(filename)
+    assert cache._lookup(("h", "image", "material")) == {"media_id": "M", "url": "http://u"}
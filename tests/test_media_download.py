@@ -0,0 +1,24 @@
+import asyncio
+from tools.media_download import MediaDownloader
+
+
+def test_concurrent_downloads_to_different_paths(tmp_path):
+    async def main():
+        downloader = MediaDownloader(None)
+        calls = []
+
+        async def chunks():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            yield b"abc"
+            yield b"def"
+
+        downloader.iter_media = lambda media_id: chunks()
+        first, second = tmp_path / "a.jpg", tmp_path / "sub" / "b.jpg"
+        paths = await asyncio.gather(downloader.download("M", str(first)), downloader.download("M", str(second)))
+        assert paths == [str(first), str(second)]
+        # 合并为一次下载，第二个路径是复制的
+        assert len(calls) == 1
+        assert first.read_bytes() == second.read_bytes() == b"abcdef"
+        assert sorted(p.name for p in tmp_path.rglob("*")) == ["a.jpg", "b.jpg", "sub"]
+    asyncio.run(main())
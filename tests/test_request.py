@@ -0,0 +1,129 @@
+import asyncio
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from tools.request import CircuitBreaker, HttpClient, RetryBudget, create_session
+from tools.errors import CircuitOpenError, SystemBusyError, UpstreamError
+
+
+class MockServer:
+    '''按mode返回: "503"、"slow"(5秒后返回)、"busy"(errcode -1)、"ok"'''
+    def __init__(self) -> None:
+        self.mode = "ok"
+        self.hits = 0
+
+    async def handle(self, request:web.Request):
+        self.hits += 1
+        if self.mode == "503":
+            return web.Response(status=503)
+        if self.mode == "slow":
+            await asyncio.sleep(5)
+        if self.mode == "busy":
+            return web.json_response({"errcode": -1, "errmsg": "system error"})
+        return web.json_response({"errcode": 0})
+
+
+def run_with_server(test, **client_options):
+    '''启动本地服务，调用test(client, mock, url)'''
+    async def main():
+        mock = MockServer()
+        app = web.Application()
+        app.router.add_route("*", "/api", mock.handle)
+        server = TestServer(app)
+        await server.start_server()
+        client = HttpClient(create_session(), **dict({"backoff_base": 0.001}, **client_options))
+        try:
+            await test(client, mock, str(server.make_url("/api")))
+        finally:
+            await client.session.close()
+            await server.close()
+    asyncio.run(main())
+
+
+def test_breaker_opens_and_half_opens(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("tools.request.time.monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    breaker.on_failure()
+    assert breaker.allow()
+    breaker.on_failure()
+    assert not breaker.allow()
+    now[0] += 10
+    # 只放行一个试探请求
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.on_failure()
+    assert not breaker.allow()
+    now[0] += 10
+    assert breaker.allow()
+    breaker.on_success()
+    assert breaker.allow() and breaker.allow()
+
+
+def test_cancelled_probe_does_not_keep_breaker_open():
+    async def test(client:HttpClient, mock:MockServer, url:str):
+        mock.mode = "503"
+        for _ in range(2):
+            with pytest.raises(UpstreamError):
+                await client.request("GET", url)
+        with pytest.raises(CircuitOpenError):
+            await client.request("GET", url)
+        await asyncio.sleep(0.06)
+        mock.mode = "slow"
+        probe = asyncio.ensure_future(client.request("GET", url))
+        await asyncio.sleep(0.05)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        # 取消的试探请求不算失败，熔断器没有重新计时，下一个请求直接试探
+        mock.mode = "ok"
+        assert await client.request("GET", url) == '{"errcode": 0}'
+        breaker = client.breaker(url.split("/")[2])
+        assert breaker.opened_at is None
+    run_with_server(test, max_retries=0, failure_threshold=2, reset_timeout=0.05)
+
+
+def test_retry_budget_exhaustion():
+    budget = RetryBudget(ratio=0.5, min_tokens=2)
+    assert budget.withdraw() and budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+    for _ in range(100):
+        budget.deposit()
+    assert budget.tokens == 2
+
+
+def test_retries_stop_when_budget_exhausted():
+    async def test(client:HttpClient, mock:MockServer, url:str):
+        mock.mode = "503"
+        client.budget(url.split("//")[1]).tokens = 1
+        with pytest.raises(UpstreamError):
+            await client.request("GET", url)
+        # 第一次请求加上预算内的一次重试
+        assert mock.hits == 2
+    run_with_server(test, max_retries=3, failure_threshold=100)
+
+
+def test_post_is_not_retried_after_5xx():
+    async def test(client:HttpClient, mock:MockServer, url:str):
+        mock.mode = "503"
+        with pytest.raises(UpstreamError):
+            await client.request("POST", url, post_data=b"{}")
+        assert mock.hits == 1
+        with pytest.raises(UpstreamError):
+            await client.request("POST", url, post_data=b"{}", idempotent=True)
+        assert mock.hits == 1 + 4
+    run_with_server(test, max_retries=3, failure_threshold=100)
+
+
+def test_system_busy_retries_use_budget():
+    async def test(client:HttpClient, mock:MockServer, url:str):
+        mock.mode = "busy"
+        client.budget(url.split("//")[1]).tokens = 1
+        with pytest.raises(SystemBusyError):
+            await client.request_json("POST", url, post_data=b"{}")
+        assert mock.hits == 2
+    run_with_server(test, max_retries=3)
@@ -0,0 +1,115 @@
+import asyncio
+import pytest
+from tools.router import MessageRouter, PrefixTrie
+
+
+def named(name:str):
+    async def handler(ba, request_data):
+        return name
+    handler.__name__ = name
+    return handler
+
+
+def text(content:str):
+    return {"MsgType": "text", "Content": content}
+
+
+def event(name:str, key:str=None):
+    return {"MsgType": "event", "Event": name, "EventKey": key}
+
+
+def resolve(router:MessageRouter, request_data):
+    handler = router.resolve(request_data)
+    return handler and handler.__name__
+
+
+def test_prefix_trie_longest_prefix():
+    trie = PrefixTrie()
+    for prefix in ("天", "天气", "天气预报"):
+        trie.insert(prefix, prefix)
+    assert trie.longest_prefix("天气预报北京") == "天气预报"
+    assert trie.longest_prefix("天气北京") == "天气"
+    assert trie.longest_prefix("天") == "天"
+    assert trie.longest_prefix("地") is None
+    assert len(trie) == 3 and dict(trie.items()) == {"天": "天", "天气": "天气", "天气预报": "天气预报"}
+
+
+def test_keyword_precedence():
+    router = MessageRouter()
+    router.add_msg("text", named("text"))
+    router.add_keyword("天气", named("weather"), prefix=True)
+    router.add_keyword("天气预报", named("forecast"), prefix=True)
+    router.add_keyword("天气预报北京", named("exact"))
+    router.compile()
+    # 完全匹配 > 最长前缀 > 消息类型
+    assert resolve(router, text("天气预报北京")) == "exact"
+    assert resolve(router, text("天气预报上海")) == "forecast"
+    assert resolve(router, text("天气")) == "weather"
+    assert resolve(router, text("你好")) == "text"
+    assert resolve(router, {"MsgType": "text"}) == "text"
+    assert resolve(router, {"MsgType": "image"}) is None
+
+
+def test_event_precedence():
+    router = MessageRouter()
+    router.add_msg("event", named("any_event"))
+    router.add_event("subscribe", named("subscribe"))
+    router.add_event("subscribe", named("scene"), key="qrscene_", prefix=True)
+    router.add_event("subscribe", named("scene_vip"), key="qrscene_vip", prefix=True)
+    router.add_event("subscribe", named("scene_1"), key="qrscene_1")
+    router.compile()
+    # Event+EventKey > EventKey最长前缀 > Event > 消息类型
+    assert resolve(router, event("subscribe", "qrscene_1")) == "scene_1"
+    assert resolve(router, event("subscribe", "qrscene_vip_2")) == "scene_vip"
+    assert resolve(router, event("subscribe", "qrscene_2")) == "scene"
+    assert resolve(router, event("subscribe", "other")) == "subscribe"
+    assert resolve(router, event("subscribe")) == "subscribe"
+    assert resolve(router, event("unsubscribe")) == "any_event"
+
+
+def test_include_overrides_existing_routes():
+    router, other = MessageRouter(), MessageRouter()
+    router.add_keyword("帮助", named("old_help"))
+    router.add_keyword("天气", named("old_weather"), prefix=True)
+    router.add_event("CLICK", named("old_click"), key="K", prefix=True)
+    other.add_keyword("帮助", named("new_help"))
+    other.add_keyword("天气", named("new_weather"), prefix=True)
+    other.add_event("CLICK", named("new_click"), key="K", prefix=True)
+    other.add_msg("image", named("image"))
+    router.include(other)
+    router.compile()
+    assert resolve(router, text("帮助")) == "new_help"
+    assert resolve(router, text("天气北京")) == "new_weather"
+    assert resolve(router, event("CLICK", "K1")) == "new_click"
+    assert resolve(router, {"MsgType": "image"}) == "image"
+
+
+def test_middleware_order():
+    router, other = MessageRouter(), MessageRouter()
+    calls = []
+
+    def middleware(name:str):
+        async def wrapped(ba, request_data, handler):
+            calls.append(name)
+            result = await handler(ba, request_data)
+            calls.append("/" + name)
+            return result
+        return wrapped
+
+    async def handler(ba, request_data):
+        calls.append("handler")
+        return {"MsgType": "text"}
+
+    handler.reply_mode = "sync"
+    router.add_middleware(middleware("outer"))
+    other.add_middleware(middleware("inner"))
+    router.add_keyword("a", handler, prefix=True)
+    router.include(other)
+    router.compile()
+    router.compile()
+    wrapped = router.resolve(text("abc"))
+    assert wrapped.reply_mode == "sync"
+    assert asyncio.run(wrapped(None, text("abc"))) == {"MsgType": "text"}
+    assert calls == ["outer", "inner", "handler", "/inner", "/outer"]
+    with pytest.raises(RuntimeError):
+        router.add_msg("image", handler)
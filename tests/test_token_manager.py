@@ -0,0 +1,80 @@
+import asyncio
+from tools.biz_api import BizApi
+from tools.errors import TokenInvalidError
+from tools.token_manager import AccessTokenManager
+
+
+class FakeClient:
+    '''模拟HttpClient.request_json: 每次获取token返回新的token，其他接口按token是否失效返回'''
+    def __init__(self) -> None:
+        self.session = None
+        self.token_calls = 0
+        self.api_calls = []
+        self.revoked = set()
+
+    async def request_json(self, method:str, url:str, params:dict=None, post_data=None, idempotent:bool=None):
+        if url.endswith("/cgi-bin/token"):
+            self.token_calls += 1
+            await asyncio.sleep(0.01)
+            return {"access_token": f"TOKEN{self.token_calls}", "expires_in": 7200}
+        self.api_calls.append(params["access_token"])
+        if params["access_token"] in self.revoked:
+            raise TokenInvalidError(40001, "invalid credential")
+        return {"errcode": 0}
+
+
+def test_concurrent_get_fetches_once(tmp_path):
+    async def main():
+        client = FakeClient()
+        manager = AccessTokenManager(client, "wx1", "secret", str(tmp_path / "token.json"))
+        results = await asyncio.gather(*(manager.get() for _ in range(20)))
+        assert client.token_calls == 1
+        assert {data["access_token"] for data in results} == {"TOKEN1"}
+        assert (await manager.get())["access_token"] == "TOKEN1"
+        assert client.token_calls == 1
+        await manager.close()
+    asyncio.run(main())
+
+
+def test_invalidate_only_refreshes_current_token(tmp_path):
+    async def main():
+        client = FakeClient()
+        manager = AccessTokenManager(client, "wx1", "secret", str(tmp_path / "token.json"))
+        await manager.get()
+        # 已经被替换掉的token失效，不重新获取
+        assert (await manager.invalidate("OLD"))["access_token"] == "TOKEN1"
+        assert client.token_calls == 1
+        results = await asyncio.gather(*(manager.invalidate("TOKEN1") for _ in range(5)))
+        assert {data["access_token"] for data in results} == {"TOKEN2"}
+        assert client.token_calls == 2
+        await manager.close()
+    asyncio.run(main())
+
+
+def test_processes_share_cache_file(tmp_path):
+    async def main():
+        client = FakeClient()
+        cache_file = str(tmp_path / "token.json")
+        first = AccessTokenManager(client, "wx1", "secret", cache_file)
+        second = AccessTokenManager(client, "wx1", "secret", cache_file)
+        await first.get()
+        # 另一个进程从缓存文件中拿到同一个token
+        assert (await second.get())["access_token"] == "TOKEN1"
+        assert client.token_calls == 1
+        # 被接口判定失效的token即使还在缓存文件中也不再采用
+        assert (await second.invalidate("TOKEN1"))["access_token"] == "TOKEN2"
+        await first.close()
+        await second.close()
+    asyncio.run(main())
+
+
+def test_request_api_retries_once_after_token_invalid(tmp_path):
+    async def main():
+        client = FakeClient()
+        ba = BizApi("wx1", "secret", client=client, log_dir=str(tmp_path))
+        await ba.get_access_token()
+        client.revoked.add("TOKEN1")
+        assert await ba.request_api("GET", "http://api/cgi-bin/getcallbackip") == {"errcode": 0}
+        assert client.api_calls == ["TOKEN1", "TOKEN2"]
+        await ba.close()
+    asyncio.run(main())
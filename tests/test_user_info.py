@@ -0,0 +1,105 @@
+import asyncio
+import pytest
+from tools.user_info import UserInfoLoader
+
+
+class FakeBizApi:
+    '''记录每次batchget的openid列表，o_前缀以外的openid视为无效'''
+    def __init__(self) -> None:
+        self.calls = []
+        self.error = None
+        self.release = None
+
+    async def batch_get_user_info(self, openids:list, lang:str="zh_CN"):
+        self.calls.append(list(openids))
+        number = len(self.calls)
+        if self.release is not None:
+            await self.release.wait()
+        if self.error:
+            raise self.error
+        return [{"openid": openid, "subscribe": 1, "nickname": f"{openid}#{number}"}
+                for openid in openids if openid.startswith("o_")]
+
+
+def test_concurrent_loads_are_batched():
+    async def main():
+        ba = FakeBizApi()
+        loader = UserInfoLoader(ba, max_batch=3)
+        openids = ["o_1", "o_2", "o_1", "o_3", "o_4", "bad"]
+        infos = await loader.load_many(openids)
+        # 同一个openid只查询一次，每批最多max_batch个
+        assert ba.calls == [["o_1", "o_2", "o_3"], ["o_4", "bad"]]
+        assert [info and info["openid"] for info in infos] == ["o_1", "o_2", "o_1", "o_3", "o_4", None]
+        assert infos[0] is infos[2]
+        # 之后命中缓存，无效的openid不缓存
+        assert await loader.load("o_1") is infos[0]
+        assert await loader.load("bad") is None
+        assert ba.calls[2:] == [["bad"]]
+    asyncio.run(main())
+
+
+def test_cache_ttl_and_maxsize():
+    async def main():
+        ba = FakeBizApi()
+        loader = UserInfoLoader(ba, ttl=0.01, maxsize=2)
+        await loader.load_many(["o_1", "o_2", "o_3"])
+        assert list(loader._cache) == ["o_2", "o_3"]
+        await asyncio.sleep(0.02)
+        assert (await loader.load("o_2"))["nickname"] == "o_2#2"
+        assert len(ba.calls) == 2
+    asyncio.run(main())
+
+
+def test_invalidate():
+    async def main():
+        ba = FakeBizApi()
+        loader = UserInfoLoader(ba)
+        first = await loader.load("o_1")
+        loader.invalidate("o_1")
+        second = await loader.load("o_1")
+        assert first["nickname"] == "o_1#1" and second["nickname"] == "o_1#2"
+
+        # 查询期间被invalidate，结果返回给调用者但不缓存
+        loader.invalidate("o_1")
+        ba.release = asyncio.Event()
+        pending = asyncio.ensure_future(loader.load("o_1"))
+        await asyncio.sleep(0.02)
+        loader.invalidate("o_1")
+        again = asyncio.ensure_future(loader.load("o_1"))
+        await asyncio.sleep(0.02)
+        ba.release.set()
+        assert (await pending)["nickname"] == "o_1#3"
+        assert (await again)["nickname"] == "o_1#4"
+        assert (await loader.load("o_1"))["nickname"] == "o_1#4"
+        assert len(ba.calls) == 4
+    asyncio.run(main())
+
+
+def test_error_is_not_cached():
+    async def main():
+        ba = FakeBizApi()
+        ba.error = RuntimeError("busy")
+        loader = UserInfoLoader(ba)
+        results = await asyncio.gather(loader.load("o_1"), loader.load("o_2"), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert ba.calls == [["o_1", "o_2"]]
+        ba.error = None
+        assert (await loader.load("o_1"))["openid"] == "o_1"
+    asyncio.run(main())
+
+
+def test_cancelled_caller_does_not_affect_batch():
+    async def main():
+        ba = FakeBizApi()
+        ba.release = asyncio.Event()
+        loader = UserInfoLoader(ba)
+        first = asyncio.ensure_future(loader.load("o_1"))
+        second = asyncio.ensure_future(loader.load("o_1"))
+        await asyncio.sleep(0.02)
+        first.cancel()
+        ba.release.set()
+        assert (await second)["openid"] == "o_1"
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        assert len(ba.calls) == 1
+    asyncio.run(main())
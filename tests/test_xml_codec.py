@@ -0,0 +1,65 @@
+import pytest
+import xmltodict
+from tools.xml_codec import XMLParseError, parse_message, unparse_reply
+
+
+_BASE = {"ToUserName": "o<&>1", "FromUserName": "gh_123456", "CreateTime": 1700000000}
+_ARTICLE = {"Title": "标题", "Description": "描述", "PicUrl": None, "Url": "https://example.com/?a=1&b=2"}
+REPLIES = [
+    {"xml": {**_BASE, "MsgType": "text", "Content": "你好 <b> & \"quote\" 'single'\n换行"}},
+    {"xml": {**_BASE, "MsgType": "text", "Content": ""}},
+    {"xml": {**_BASE, "MsgType": "text", "Content": None}},
+    {"xml": {**_BASE, "MsgType": "image", "Image": {"MediaId": "media_id_123"}}},
+    {"xml": {**_BASE, "MsgType": "voice", "Voice": {"MediaId": "media_id_123"}}},
+    {"xml": {**_BASE, "MsgType": "video", "Video": {"Title": "标题", "Description": "a&b", "MediaId": "m"}}},
+    {"xml": {**_BASE, "MsgType": "news", "ArticleCount": 1, "Articles": {"item": _ARTICLE}}},
+    {"xml": {**_BASE, "MsgType": "news", "ArticleCount": 2, "Articles": {"item": [_ARTICLE, {**_ARTICLE, "Title": "二"}]}}},
+    # 以下结构不符合模板，回退到xmltodict
+    {"xml": {**_BASE, "MsgType": "text", "Content": 1.5}},
+    {"xml": {**_BASE, "MsgType": "text", "Content": True}},
+    {"xml": {"FromUserName": "gh", "ToUserName": "o1", "CreateTime": 1, "MsgType": "text", "Content": "order"}},
+    {"xml": {**_BASE, "MsgType": "image", "Image": {"MediaId": "m", "Extra": "x"}}},
+    {"xml": {**_BASE, "MsgType": "transfer_customer_service"}},
+]
+
+
+@pytest.mark.parametrize("data", REPLIES)
+def test_unparse_reply_same_as_xmltodict(data):
+    assert unparse_reply(data) == xmltodict.unparse(data)
+
+
+REQUESTS = [
+    b'<xml><ToUserName><![CDATA[gh_123456]]></ToUserName><FromUserName><![CDATA[o1]]></FromUserName>'
+    b'<CreateTime>1700000000</CreateTime><MsgType><![CDATA[text]]></MsgType>'
+    b'<Content><![CDATA[ hello <world> & you ]]></Content><MsgId>23456789012345678</MsgId></xml>',
+    b'<xml><ToUserName><![CDATA[gh_123456]]></ToUserName><FromUserName><![CDATA[o1]]></FromUserName>'
+    b'<CreateTime>1700000000</CreateTime><MsgType><![CDATA[event]]></MsgType><Event><![CDATA[subscribe]]></Event>'
+    b'<EventKey><![CDATA[]]></EventKey></xml>',
+    '<xml><ToUserName>gh</ToUserName><FromUserName>o1</FromUserName><CreateTime>1</CreateTime>'
+    '<MsgType>event</MsgType><Event>pic_sysphoto</Event><SendPicsInfo><Count>2</Count><PicList>'
+    '<item><PicMd5Sum>a</PicMd5Sum></item><item><PicMd5Sum>b</PicMd5Sum></item></PicList></SendPicsInfo></xml>',
+]
+
+
+@pytest.mark.parametrize("body", REQUESTS)
+def test_parse_message_same_as_xmltodict(body):
+    expected = xmltodict.parse(body)["xml"]
+    msg = parse_message(body)
+    assert msg.to_dict() == dict(expected)
+    for key, value in expected.items():
+        assert msg[key] == value and msg.get(key) == value and key in msg
+
+
+def test_message_dict_api():
+    msg = parse_message(REQUESTS[0])
+    assert msg["Content"] == "hello <world> & you"
+    assert "Event" not in msg and msg.get("Event") is None and msg.get("Other", 1) == 1
+    with pytest.raises(KeyError):
+        msg["Event"]
+    msg["Other"] = "x"
+    assert msg["Other"] == "x" and msg.to_dict()["Other"] == "x"
+
+
+def test_parse_error():
+    with pytest.raises(XMLParseError):
+        parse_message(b"<xml><Content></xml>")
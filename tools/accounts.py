@@ -0,0 +1,87 @@
+import asyncio
+from typing import Dict
+from loguru import logger
+from .biz_api import BizApi
+from .crypto import WeChatCrypto
+from .request import HttpClient, create_session
+
+
+class AccountRegistry:
+    '''多公众号管理，所有公众号共用一个连接池
+    accounts: {appid: {"secret": ..., "token": ..., "aes_key": ..., "original_id": "gh_xxx"}}，token不填时使用default_token
+    BizApi在第一次收到该公众号的消息或被调用时才创建，启动耗时和内存不随公众号数量增长
+    配置了"warm_up": True的公众号在启动后由warm_up在后台提前创建和预热
+    '''
+    def __init__(self, accounts:Dict[str, dict], default_token:str=None, http_options:dict=None,
+                 api_base:str="https://api.weixin.qq.com", log_dir:str=None) -> None:
+        self.accounts = dict(accounts)
+        self.default_token = default_token
+        self.api_base = api_base
+        self.log_dir = log_dir
+        self.session = create_session(**(http_options or {}))
+        self.client = HttpClient(self.session)
+        self._apis:Dict[str, BizApi] = {}
+        self._cryptos:Dict[str, WeChatCrypto] = {}
+        # 回调消息的ToUserName是公众号原始id
+        self._original_ids = {conf["original_id"]: appid for appid, conf in self.accounts.items() if conf.get("original_id")}
+
+    def __contains__(self, appid:str):
+        return appid in self.accounts
+
+    def token(self, appid:str):
+        '''该公众号在后台配置的服务器令牌(Token)，未配置的公众号返回None'''
+        conf = self.accounts.get(appid)
+        if conf is None:
+            return None
+        return conf.get("token") or self.default_token
+
+    def get(self, appid:str) -> BizApi:
+        '''获取公众号的BizApi，未配置的公众号返回None'''
+        ba = self._apis.get(appid)
+        if ba is None:
+            conf = self.accounts.get(appid)
+            if conf is None:
+                return None
+            ba = self._apis[appid] = BizApi(appid, conf["secret"], conf.get("aes_key"), client=self.client, api_base=self.api_base,
+                                             log_dir=self.log_dir)
+            logger.info(f"加载公众号: {appid}")
+        return ba
+
+    def crypto(self, appid:str) -> WeChatCrypto:
+        '''安全模式的加解密器，没有配置aes_key的公众号返回None'''
+        if appid in self._cryptos:
+            return self._cryptos[appid]
+        conf = self.accounts.get(appid) or {}
+        aes_key = conf.get("aes_key")
+        crypto = self._cryptos[appid] = WeChatCrypto(self.token(appid), aes_key, appid) if aes_key else None
+        return crypto
+
+    async def warm_up(self, concurrency:int=8):
+        '''预热配置了"warm_up": True的公众号(见BizApi.warm_up)，同时最多concurrency个
+        失败只记录日志，不影响其他公众号和服务就绪，之后第一次使用时再获取access_token
+        '''
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def warm(appid):
+            async with semaphore:
+                try:
+                    await self.get(appid).warm_up()
+                except Exception as e:
+                    logger.warning(f"预热公众号{appid}失败: {e!r}")
+
+        await asyncio.gather(*(warm(appid) for appid, conf in self.accounts.items() if conf.get("warm_up")))
+
+    def find(self, original_id:str) -> BizApi:
+        '''按原始id(回调消息中的ToUserName)查找公众号
+        公共回调地址按default_token校验签名，所以只查找没有单独配置令牌的公众号
+        '''
+        appid = self._original_ids.get(original_id)
+        if appid is None or self.token(appid) != self.default_token:
+            return None
+        return self.get(appid)
+
+    async def close(self):
+        for ba in self._apis.values():
+            await ba.close()
+        self._apis.clear()
+        await self.session.close()
@@ -0,0 +1,111 @@
+'''回调消息的准入控制
+微信5秒内收不到回复会重试，处理排队超过时限只会让重试把负载放大，所以过载时立即回复，不再排队
+1. 同时处理的消息数不超过max_concurrent，超出的最多max_waiting个等待queue_timeout秒，其余立即按过载处理
+2. 每个openid一个令牌桶(rate条/秒，突发burst条)，桶放在最多max_users个的LRU中，内存不随用户数增长
+'''
+import time
+import asyncio
+from collections import OrderedDict, deque
+from .metrics import ADMISSION
+
+
+class AdmissionController:
+    '''max_concurrent或user_rate为0时不限制；被拒绝的消息回复reply_text，没有设置时回复success
+    reject_early拒绝的消息还没有解析，总是回复success
+    '''
+    def __init__(self, max_concurrent:int=200, max_waiting:int=200, queue_timeout:float=0.5,
+                 user_rate:float=1, user_burst:float=10, max_users:int=100000, reply_text:str=None) -> None:
+        self.reply_text = reply_text
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_users = max_users
+        self.active = 0
+        self._waiters = deque()
+        # openid -> (令牌数, 更新时间)
+        self._buckets = OrderedDict()
+
+    def reject_early(self) -> bool:
+        '''在解密和解析消息之前调用，处理名额和等待队列都满时返回True'''
+        if self.max_concurrent and self.active >= self.max_concurrent and len(self._waiters) >= self.max_waiting:
+            ADMISSION.labels("shed_early").inc()
+            return True
+        return False
+
+    def allow_user(self, openid:str) -> bool:
+        '''openid的令牌桶中还有令牌时消耗一个并返回True'''
+        if not self.user_rate or not openid:
+            return True
+        now = time.monotonic()
+        item = self._buckets.pop(openid, None)
+        if item is None:
+            tokens = self.user_burst
+        else:
+            tokens = min(self.user_burst, item[0] + (now - item[1]) * self.user_rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # 重新插入到末尾，最久没有消息的用户先被淘汰(淘汰后再来消息相当于桶是满的)
+        self._buckets[openid] = (tokens, now)
+        if len(self._buckets) > self.max_users:
+            self._buckets.popitem(last=False)
+        if not allowed:
+            ADMISSION.labels("rate_limited").inc()
+        return allowed
+
+    async def acquire(self) -> bool:
+        '''获取处理名额，queue_timeout秒内没有拿到返回False，拿到后需要调用release'''
+        if not self.max_concurrent:
+            return True
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+            ADMISSION.labels("admitted").inc()
+            return True
+        if len(self._waiters) >= self.max_waiting:
+            ADMISSION.labels("shed_busy").inc()
+            return False
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        handle = loop.call_later(self.queue_timeout, _expire, waiter)
+        try:
+            admitted = await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled() and waiter.result():
+                # 名额已经转交给这个等待者，但它被取消了
+                self.release()
+            else:
+                _discard(self._waiters, waiter)
+            raise
+        finally:
+            handle.cancel()
+        if not admitted:
+            # 超时的等待者还在队列中
+            _discard(self._waiters, waiter)
+        ADMISSION.labels("admitted" if admitted else "shed_timeout").inc()
+        return admitted
+
+    def release(self):
+        '''名额直接转交给最早的等待者，没有等待者时归还'''
+        if not self.max_concurrent:
+            return
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+
+def _expire(waiter:asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(False)
+
+
+def _discard(waiters:deque, waiter:asyncio.Future):
+    try:
+        waiters.remove(waiter)
+    except ValueError:
+        pass
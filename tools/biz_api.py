@@ -1,166 +1,186 @@
 import os
 import json
+import asyncio
 import time
-import aiohttp
-import aiofiles
+import threading
 from loguru import logger
 from hashlib import md5
-from .request import aiohttp_request
+from .request import HttpClient, create_session
+from .errors import WeChatError, TokenInvalidError
+from .upload import get_file_size, check_upload_file, build_upload_form
+from .token_manager import AccessTokenManager
+from .user_info import UserInfoLoader
+from .metrics import UPLOAD_BYTES, UPLOAD_LATENCY, UPLOAD_SIZE
 
 
 class BizApi:
-    def __init__(self, appid:str, secret:str, aes_key:str=None) -> None:
+    def __init__(self, appid:str, secret:str, aes_key:str=None, max_concurrent_uploads:int=4, http_options:dict=None,
+                 api_base:str="https://api.weixin.qq.com", client:HttpClient=None, log_dir:str=None) -> None:
         self.appid = appid
         self.secret = secret
         self.aes_key = aes_key
-        client_timeout = aiohttp.ClientTimeout(total=15)
-        self.session = aiohttp.ClientSession(timeout=client_timeout)
+        # 接口地址前缀，压测时可指向本地模拟的微信服务器
+        self.api_base = api_base.rstrip("/")
+        # 多个公众号可以传入同一个client共用连接池，由创建者负责关闭
+        self._own_session = client is None
+        if client is None:
+            client = HttpClient(create_session(**(http_options or {})))
+        self.client = client
+        self.session = client.session
         curdir = os.path.dirname(os.path.dirname(__file__))
-        self.access_token_data = {}
-        self.access_token_file = os.path.join(curdir, "log", md5(f"{appid}{secret}".encode()).hexdigest() + '.json')
-    
+        # access_token和白名单的缓存文件、文件锁、素材缓存都在log_dir下，默认为项目的log目录
+        self.log_dir = log_dir or os.path.join(curdir, "log")
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.access_token_file = os.path.join(self.log_dir, md5(f"{appid}{secret}".encode()).hexdigest() + '.json')
+        self.token_manager = AccessTokenManager(self.client, appid, secret, self.access_token_file, api_base=self.api_base)
+        self.upload_semaphore = asyncio.Semaphore(max_concurrent_uploads)
+        self.user_info = UserInfoLoader(self)
+        # 素材缓存、素材库、下载在第一次使用时才导入和创建(打开sqlite并载入索引)，warm_up可以提前在线程池中创建
+        self._media_cache = None
+        self._materials = None
+        self._downloader = None
+        self._init_lock = threading.Lock()
+
+    @property
+    def media_cache(self):
+        if self._media_cache is None:
+            with self._init_lock:
+                if self._media_cache is None:
+                    from .media_cache import MediaCache
+                    self._media_cache = MediaCache(os.path.join(self.log_dir, f"media_{self.appid}.db"))
+        return self._media_cache
+
+    @property
+    def materials(self):
+        if self._materials is None:
+            with self._init_lock:
+                if self._materials is None:
+                    from .material_library import MaterialLibrary
+                    self._materials = MaterialLibrary(self, os.path.join(self.log_dir, f"material_{self.appid}.db"))
+        return self._materials
+
+    @property
+    def downloader(self):
+        if self._downloader is None:
+            from .media_download import MediaDownloader
+            self._downloader = MediaDownloader(self)
+        return self._downloader
+
+    async def warm_up(self):
+        '''获取access_token，同时在线程池中载入素材缓存和素材库的索引，启动时调用'''
+        loop = asyncio.get_running_loop()
+        token_data, *_ = await asyncio.gather(
+            self.get_access_token(),
+            loop.run_in_executor(None, lambda: self.media_cache),
+            loop.run_in_executor(None, lambda: self.materials),
+        )
+        if not token_data:
+            raise WeChatError("获取access_token失败")
+
     async def close(self):
-        self.session.close()
+        await self.token_manager.close()
+        if self._media_cache is not None:
+            self._media_cache.close()
+        if self._materials is not None:
+            self._materials.close()
+        if self._own_session:
+            await self.session.close()
 
     async def get_access_token(self):
-        if self.access_token_data and self.access_token_data.get("expires_at", 0) > int(time.time()):
-            return self.access_token_data
-        if not os.path.exists(self.access_token_file):
-            return await self.get_access_token_from_net()
-        else:
-            return await self.get_access_token_from_file()
-        
-    async def get_access_token_from_net(self):
-        url = "https://api.weixin.qq.com/cgi-bin/token"
-        params = {
-            "grant_type": "client_credential",
-            "appid": self.appid,
-            "secret": self.secret
-        }
-        text = await aiohttp_request(self.session, "GET", url, params=params)
-        if text:
-            data = json.loads(text)
-            if data.get("access_token"):
-                async with aiofiles.open(self.access_token_file, 'w', encoding='utf-8') as fw:
-                    await fw.write(text)
-                self.access_token_data = data
-                return data
-            else:
-                logger.warning(f"获取access_token失败,响应内容: {text}！")
-        else:
-            logger.warning("获取access_token时请求失败！")
+        return await self.token_manager.get()
 
-    async def get_access_token_from_file(self):
-        async with aiofiles.open(self.access_token_file, 'r') as f:
-            access_token_str = await f.read()
-            data = json.loads(access_token_str)
-            if data.get("expires_at", 0) > int(time.time()):
-                self.access_token_data = data
-                return data
-        return await self.get_access_token_from_net()
-    
-    async def upload_tmp_image(self, image_path:str):
-        '''图片仅支持jpg/png格式，大小必须在1MB以下'''
+    async def request_api(self, method:str, url:str, params:dict=None, post_data=None, idempotent:bool=None):
+        '''调用需要access_token的接口，返回解析后的json，出错时抛出WeChatError的子类
+        token失效(40001/40014/42001)时自动刷新并重试一次
+        post_data为FormData时只能发送一次，可以传入返回请求体的函数以便重试时重新构建
+        只读取数据的POST接口传入idempotent=True，超时和5xx时也重试，见HttpClient
+        '''
         token_data = await self.get_access_token()
         if not token_data:
+            raise WeChatError("获取access_token失败")
+        access_token = token_data["access_token"]
+        _params = {"access_token": access_token}
+        if params:
+            _params.update(params)
+        try:
+            return await self.client.request_json(method, url, params=_params, post_data=post_data, idempotent=idempotent)
+        except TokenInvalidError as e:
+            logger.warning(f"access_token已失效，刷新后重试: {e}")
+        token_data = await self.token_manager.invalidate(access_token)
+        if not token_data:
+            raise WeChatError("获取access_token失败")
+        _params["access_token"] = token_data["access_token"]
+        return await self.client.request_json(method, url, params=_params, post_data=post_data, idempotent=idempotent)
+    
+    async def upload_file(self, kind:str, url:str, media_type:str, path:str, params:dict=None, fields:dict=None):
+        '''上传文件的公共流程: 校验格式和大小 -> 查素材缓存 -> 限制并发数的流式上传
+        kind为素材缓存的类型，见MediaCache
+        '''
+        size = await get_file_size(path)
+        if size is None:
+            logger.info(f"给定文件路径({path})不存在")
             return
-        if not os.path.exists(image_path):
-            logger.info(f"给定图片路径({image_path})不存在")
-            return
-        if not image_path.endswith(".jpg") and not image_path.endswith(".png"):
-            logger.info(f"给定的图片不是jpg/png后缀")
+        rule = "img" if kind == "img" else media_type
+        if not check_upload_file(rule, path, size):
             return
-        if os.path.getsize(image_path) >= 1024 * 1024:
+        async def upload():
+            async with self.upload_semaphore:
+                start = time.perf_counter()
+                data = await self.request_api("POST", url, params=params,
+                    post_data=lambda: build_upload_form(media_type, path, size, fields))
+                UPLOAD_LATENCY.labels(media_type).observe(time.perf_counter() - start)
+                UPLOAD_BYTES.labels(media_type).inc(size)
+                UPLOAD_SIZE.labels(media_type).observe(size)
+                return data
+        return await self.media_cache.get_or_upload(kind, media_type, path, upload)
+
+    async def upload_tmp_image(self, image_path:str):
+        '''图片仅支持jpg/png格式，大小必须在1MB以下，超过1MB时上传为永久素材'''
+        size = await get_file_size(image_path)
+        if size is not None and size >= 1024 * 1024:
             return await self.upload_media("image", image_path)
-        access_token = token_data["access_token"]
-        url = "https://api.weixin.qq.com/cgi-bin/media/uploadimg"
-        params = {
-            "access_token": access_token
-        }
-        post_data = aiohttp.FormData()
-        post_data.add_field('file',
-                    open(image_path, 'rb'),
-                    filename=os.path.basename(image_path),
-                    content_type=f'image/{image_path[-3:]}')
-        text = await aiohttp_request(self.session, "POST", url, params=params, post_data=post_data)
-        logger.debug(text)
-        data = json.loads(text)
-        return data.get('url')
+        url = f"{self.api_base}/cgi-bin/media/uploadimg"
+        data = await self.upload_file("img", url, "image", image_path)
+        if data:
+            return data.get('url')
     
     async def upload_tmp_media(self, media_type:str, media_path:str):
         '''未通过企业认证的订阅号没有上传临时素材的权限'''
-        token_data = await self.get_access_token()
-        if not token_data:
-            return
-        if not os.path.exists(media_path):
-            logger.info(f"给定文件路径({media_path})不存在")
-            return
-        access_token = token_data["access_token"]
-        url = "https://api.weixin.qq.com/cgi-bin/media/upload"
+        url = f"{self.api_base}/cgi-bin/media/upload"
         params = {
-            "access_token": access_token,
             "type": media_type
         }
-        post_data = aiohttp.FormData()
-        if media_type == "image":
-            post_data.add_field('file',
-                        open(media_path, 'rb'),
-                        filename=os.path.basename(media_path),
-                        content_type=f'image/{media_path[-3:]}')
-        elif media_type == "voice": #2M，播放长度不超过60s，mp3/wma/wav/amr格式
-            post_data.add_field('file',
-                        open(media_path, 'rb'),
-                        filename=os.path.basename(media_path),
-                        content_type=f'audio/mp3')
-        elif media_type == "video": # 10MB，支持MP4格式
-            post_data.add_field('file',
-                        open(media_path, 'rb'),
-                        filename=os.path.basename(media_path),
-                        content_type=f'video/mp4')
-        text = await aiohttp_request(self.session, "POST", url, params=params, post_data=post_data)
-        logger.debug(text)
-        data = json.loads(text)
-        return data
+        return await self.upload_file("tmp", url, media_type, media_path, params=params)
     
     async def upload_media(self, media_type:str, media_path:str, title=None, introduction=None):
         '''上传视频时需要title和introduction'''
-        token_data = await self.get_access_token()
-        if not token_data:
-            return
-        if not os.path.exists(media_path):
-            logger.info(f"给定文件路径({media_path})不存在")
-            return
-        access_token = token_data["access_token"]
-        url = "https://api.weixin.qq.com/cgi-bin/material/add_material"
-        params = {
-            "access_token": access_token,
-            "type": media_type
-        }
-        post_data = aiohttp.FormData()
-        if media_type == "image":
-            post_data.add_field('file',
-                        open(media_path, 'rb'),
-                        filename=os.path.basename(media_path),
-                        content_type=f'image/{media_path[-3:]}')
-        elif media_type == "voice": #2M，播放长度不超过60s，mp3/wma/wav/amr格式
-            post_data.add_field('file',
-                        open(media_path, 'rb'),
-                        filename=os.path.basename(media_path),
-                        content_type=f'audio/mp3')
-        elif media_type == "video": # 10MB，支持MP4格式
+        fields = None
+        if media_type == "video":
             if not title or not introduction:
                 logger.warning("上传视频需指定标题和简介")
                 return
-            post_data.add_field('file',
-                        open(media_path, 'rb'),
-                        filename=os.path.basename(media_path),
-                        content_type=f'video/mp4')
-            post_data.add_field("description", json.dumps({"title": title, "introduction": introduction}))
-        text = await aiohttp_request(self.session, "POST", url, params=params, post_data=post_data)
-        logger.debug(text)
-        data = json.loads(text)
-        return data
+            fields = {"description": json.dumps({"title": title, "introduction": introduction})}
+        url = f"{self.api_base}/cgi-bin/material/add_material"
+        params = {
+            "type": media_type
+        }
+        return await self.upload_file("material", url, media_type, media_path, params=params, fields=fields)
     
+    async def get_material_count(self) -> dict:
+        '''永久素材总数: {"voice_count", "video_count", "image_count", "news_count"}'''
+        url = f"{self.api_base}/cgi-bin/material/get_materialcount"
+        return await self.request_api("POST", url, idempotent=True)
+
+    async def batchget_material(self, material_type:str, offset:int=0, count:int=20) -> dict:
+        '''分页获取永久素材列表，count最多20'''
+        url = f"{self.api_base}/cgi-bin/material/batchget_material"
+        post_data = json.dumps({"type": material_type, "offset": offset, "count": count}).encode()
+        return await self.request_api("POST", url, post_data=post_data, idempotent=True)
+
+    async def download_media(self, media_id:str, path:str, overwrite:bool=False):
+        '''下载用户发来的图片、语音、视频(MediaId/ThumbMediaId)到path，流式写入不占用内存'''
+        return await self.downloader.download(media_id, path, overwrite)
+
     async def reply(self, _type:str, request_data:dict, **kwargs):
         '''回复消息，回复图片、语音或视频时需先上传到素材
         _type取值有: "text"、"image"、"voice"、"video"、"articles"
@@ -243,32 +263,98 @@ class BizApi:
         }
         return data
     
+    async def send_custom_message(self, payload:dict):
+        '''通过客服消息接口发送消息，用户48小时内与公众号有过互动才能发送'''
+        url = f"{self.api_base}/cgi-bin/message/custom/send"
+        post_data = json.dumps(payload, ensure_ascii=False).encode()
+        return await self.request_api("POST", url, post_data=post_data)
+
+    async def send_mass_message(self, openids:list, message:dict):
+        '''按openid列表群发，每次2到10000个openid
+        message为不含touser的消息内容，如{"msgtype": "text", "text": {"content": "..."}}
+        '''
+        url = f"{self.api_base}/cgi-bin/message/mass/send"
+        post_data = json.dumps(dict(message, touser=list(openids)), ensure_ascii=False).encode()
+        return await self.request_api("POST", url, post_data=post_data)
+
+    async def send_template_message(self, payload:dict):
+        '''发送模板消息，payload包含touser、template_id、data，可选url、miniprogram'''
+        url = f"{self.api_base}/cgi-bin/message/template/send"
+        post_data = json.dumps(payload, ensure_ascii=False).encode()
+        return await self.request_api("POST", url, post_data=post_data)
+
+    async def send_reply(self, response_data:dict):
+        '''将reply生成的被动回复数据转换为客服消息发送，用于异步回复'''
+        data = response_data["xml"]
+        msg_type = data["MsgType"]
+        payload = {"touser": data["ToUserName"], "msgtype": msg_type}
+        if msg_type == "text":
+            payload["text"] = {"content": data["Content"]}
+        elif msg_type in ("image", "voice"):
+            payload[msg_type] = {"media_id": data[msg_type.capitalize()]["MediaId"]}
+        elif msg_type == "video":
+            video = data["Video"]
+            payload["video"] = {
+                "media_id": video["MediaId"],
+                "title": video["Title"],
+                "description": video["Description"]
+            }
+        elif msg_type == "news":
+            item = data["Articles"]["item"]
+            payload["news"] = {
+                "articles": [{
+                    "title": item["Title"],
+                    "description": item["Description"],
+                    "url": item["Url"],
+                    "picurl": item["PicUrl"] or ""
+                }]
+            }
+        else:
+            logger.warning(f"不支持通过客服消息发送的消息类型: {msg_type}")
+            return
+        return await self.send_custom_message(payload)
+    
+    async def get_user_info(self, openid:str) -> dict:
+        '''获取用户信息，与同一时间的其他查询合并请求，结果有缓存'''
+        return await self.user_info.load(openid)
+
+    async def batch_get_user_info(self, openids:list, lang:str="zh_CN") -> list:
+        '''批量获取用户信息，每次最多100个openid'''
+        url = f"{self.api_base}/cgi-bin/user/info/batchget"
+        payload = {"user_list": [{"openid": openid, "lang": lang} for openid in openids]}
+        post_data = json.dumps(payload).encode()
+        data = await self.request_api("POST", url, post_data=post_data, idempotent=True)
+        return data.get("user_info_list", [])
+
+    async def iter_followers(self, next_openid:str=None):
+        '''逐个返回关注者的openid，按next_openid分页(每页最多10000个)，返回当前页时已经在请求下一页'''
+        url = f"{self.api_base}/cgi-bin/user/get"
+
+        async def get_page(next_openid):
+            return await self.request_api("GET", url, params={"next_openid": next_openid} if next_openid else None)
+
+        page = await get_page(next_openid)
+        next_page = None
+        try:
+            while page:
+                openids = (page.get("data") or {}).get("openid") or []
+                next_openid = page.get("next_openid")
+                next_page = asyncio.ensure_future(get_page(next_openid)) if openids and next_openid else None
+                for openid in openids:
+                    yield openid
+                page = await next_page if next_page else None
+        finally:
+            if next_page and not next_page.done():
+                next_page.cancel()
+
     async def get_callback_whitelist(self):
         '''获取微信发送数据过来的ip列表'''
-        token_data = await self.get_access_token()
-        if not token_data:
-            return
-        access_token = token_data["access_token"]
-        url = "https://api.weixin.qq.com/cgi-bin/getcallbackip"
-        params = {
-            "access_token": access_token,
-        }
-        text = await aiohttp_request(self.session, "GET", url, params=params)
-        logger.debug(text)
-        data = json.loads(text)
+        url = f"{self.api_base}/cgi-bin/getcallbackip"
+        data = await self.request_api("GET", url)
         return data.get("ip_list", [])
     
     async def get_api_whitelist(self):
         '''获取api.weixin.qq.com的ip列表'''
-        token_data = await self.get_access_token()
-        if not token_data:
-            return
-        access_token = token_data["access_token"]
-        url = "https://api.weixin.qq.com/cgi-bin/get_api_domain_ip"
-        params = {
-            "access_token": access_token,
-        }
-        text = await aiohttp_request(self.session, "GET", url, params=params)
-        logger.debug(text)
-        data = json.loads(text)
+        url = f"{self.api_base}/cgi-bin/get_api_domain_ip"
+        data = await self.request_api("GET", url)
         return data.get("ip_list", [])
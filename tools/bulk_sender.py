@@ -0,0 +1,272 @@
+'''批量发送消息: 按openid列表群发、模板消息、客服消息
+接收者可以是普通或异步的可迭代对象，按接口允许的数量分批，不需要一次全部放到内存中
+每个接口独立的令牌桶限制QPS，本地记录每日调用次数，达到配额时停止任务
+进度定期保存到sqlite，任务中断后用同一个job_id和同样顺序的接收者重新调用即可继续
+'''
+import time
+import json
+import asyncio
+import sqlite3
+import threading
+from typing import AsyncIterable, AsyncIterator, Dict, Iterable, NamedTuple, Union
+from loguru import logger
+from .biz_api import BizApi
+from .errors import WeChatApiError, QuotaExceededError
+
+
+BULK_APIS = {
+    # method: BizApi中的方法，batch: 每次请求最多的openid数，min_batch: 最少的openid数
+    "mass": {"method": "send_mass_message", "batch": 10000, "min_batch": 2},
+    "template": {"method": "send_template_message", "batch": 1, "min_batch": 1},
+    "custom": {"method": "send_custom_message", "batch": 1, "min_batch": 1},
+}
+
+DEFAULT_QPS = {"mass": 1, "template": 50, "custom": 50}
+
+
+class SendResult(NamedTuple):
+    index: int          # 批次序号，同样的接收者顺序下是固定的
+    openids: list
+    ok: bool
+    errcode: int = 0
+    errmsg: str = ""
+    data: dict = None   # 接口返回的内容，如群发的msg_id
+
+
+class TokenBucket:
+    '''令牌桶，rate为每秒补充的令牌数，capacity为允许的突发请求数'''
+    def __init__(self, rate:float, capacity:float=None) -> None:
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        # 等待中的调用者按先后顺序拿到令牌
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class BulkCheckpoint:
+    '''批量任务的进度和每日调用次数
+    进度只保存连续完成的批次数(watermark)和它之后已完成的批次，数据量与并发数相当，与接收者数量无关
+    '''
+    def __init__(self, filename:str) -> None:
+        self.conn = sqlite3.connect(filename, timeout=5, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS bulk_job "
+            "(job_id TEXT PRIMARY KEY, watermark INTEGER, done TEXT, sent INTEGER, failed INTEGER, updated_at REAL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS bulk_quota (appid TEXT, api TEXT, day TEXT, used INTEGER, PRIMARY KEY (appid, api, day))"
+        )
+        self._lock = threading.Lock()
+
+    def load(self, job_id:str):
+        with self._lock:
+            row = self.conn.execute("SELECT watermark, done, sent, failed FROM bulk_job WHERE job_id=?", (job_id,)).fetchone()
+        if row is None:
+            return 0, set(), 0, 0
+        return row[0], set(json.loads(row[1])), row[2], row[3]
+
+    def save(self, job_id:str, watermark:int, done:set, sent:int, failed:int):
+        with self._lock:
+            self.conn.execute(
+                "REPLACE INTO bulk_job (job_id, watermark, done, sent, failed, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, watermark, json.dumps(sorted(done)), sent, failed, time.time())
+            )
+
+    def quota_used(self, appid:str, api:str, day:str):
+        with self._lock:
+            row = self.conn.execute("SELECT used FROM bulk_quota WHERE appid=? AND api=? AND day=?", (appid, api, day)).fetchone()
+        return row[0] if row else 0
+
+    def save_quota(self, appid:str, api:str, day:str, used:int):
+        with self._lock:
+            self.conn.execute("REPLACE INTO bulk_quota (appid, api, day, used) VALUES (?, ?, ?, ?)", (appid, api, day, used))
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+class _Progress:
+    def __init__(self, watermark:int, done:set, sent:int, failed:int) -> None:
+        self.watermark = watermark
+        self.done = done
+        self.sent = sent
+        self.failed = failed
+
+    def is_done(self, index:int):
+        return index < self.watermark or index in self.done
+
+    def mark(self, result:SendResult):
+        if result.ok:
+            self.sent += len(result.openids)
+        else:
+            self.failed += len(result.openids)
+        self.done.add(result.index)
+        while self.watermark in self.done:
+            self.done.remove(self.watermark)
+            self.watermark += 1
+
+
+async def _iterate(recipients:Union[Iterable[str], AsyncIterable[str]]):
+    if hasattr(recipients, "__aiter__"):
+        async for openid in recipients:
+            yield openid
+    else:
+        for openid in recipients:
+            yield openid
+
+
+async def _chunks(recipients, size:int, min_size:int):
+    '''按size分批，最后一批不足min_size时从上一批借几个'''
+    prev, chunk = None, []
+    async for openid in _iterate(recipients):
+        chunk.append(openid)
+        if len(chunk) == size:
+            if prev:
+                yield prev
+            prev, chunk = chunk, []
+    if prev:
+        if chunk and len(chunk) < min_size:
+            need = min_size - len(chunk)
+            prev, chunk = prev[:-need], prev[-need:] + chunk
+        yield prev
+    if chunk:
+        yield chunk
+
+
+class BulkSender:
+    '''批量发送消息，所有任务共用BizApi的连接池
+    qps和daily_quota按接口(mass/template/custom)设置，daily_quota为本地计数的每日调用次数上限
+    同一批次可能在中断前已经发出但还没保存进度，恢复后会再发一次
+    '''
+    def __init__(self, ba:BizApi, checkpoint_file:str, qps:Dict[str, float]=None, daily_quota:Dict[str, int]=None,
+                 concurrency:int=8, checkpoint_interval:float=2) -> None:
+        self.ba = ba
+        self.store = BulkCheckpoint(checkpoint_file)
+        qps = dict(DEFAULT_QPS, **(qps or {}))
+        self.buckets = {api: TokenBucket(rate) for api, rate in qps.items()}
+        self.daily_quota = daily_quota or {}
+        self.concurrency = concurrency
+        self.checkpoint_interval = checkpoint_interval
+        self._quota_used = {}
+
+    async def send(self, job_id:str, api:str, recipients:Union[Iterable[str], AsyncIterable[str]],
+                   message:dict) -> AsyncIterator[SendResult]:
+        '''发送并逐个返回每个批次的结果，已完成的批次跳过
+        message为不含touser的消息内容，模板消息为{"template_id": ..., "data": ...}
+        配额用完或接口不可用时停止任务，保存进度后抛出异常
+        '''
+        conf = BULK_APIS[api]
+        loop = asyncio.get_running_loop()
+        progress = _Progress(*await loop.run_in_executor(None, self.store.load, job_id))
+        if progress.watermark:
+            logger.info(f"批量任务({job_id})从第{progress.watermark}批继续")
+        jobs = asyncio.Queue(self.concurrency * 2)
+        results = asyncio.Queue(self.concurrency * 2)
+        # worker出现的停止任务的异常(配额用完、接口不可用)
+        errors = []
+
+        async def produce():
+            index = 0
+            try:
+                async for chunk in _chunks(recipients, conf["batch"], conf["min_batch"]):
+                    if not progress.is_done(index):
+                        await jobs.put((index, chunk))
+                    index += 1
+            except Exception as e:
+                # 读取接收者出错
+                errors.append(e)
+            for _ in range(self.concurrency):
+                await jobs.put(None)
+
+        async def work():
+            while not errors:
+                item = await jobs.get()
+                if item is None:
+                    break
+                try:
+                    result = await self._send(api, conf, item[0], item[1], message)
+                except Exception as e:
+                    errors.append(e)
+                    break
+                await results.put(result)
+            # 结束标记
+            await results.put(None)
+
+        producer = asyncio.ensure_future(produce())
+        workers = [asyncio.ensure_future(work()) for _ in range(self.concurrency)]
+        saved_at = time.monotonic()
+        try:
+            running = len(workers)
+            while running:
+                result = await results.get()
+                if result is None:
+                    running -= 1
+                    continue
+                progress.mark(result)
+                if time.monotonic() - saved_at > self.checkpoint_interval:
+                    await self._save(job_id, progress)
+                    saved_at = time.monotonic()
+                yield result
+        finally:
+            producer.cancel()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(producer, *workers, return_exceptions=True)
+            await self._save(job_id, progress)
+        if errors:
+            logger.warning(f"批量任务({job_id})停止: {errors[0]!r}，已发送{progress.sent}，失败{progress.failed}")
+            raise errors[0]
+        logger.info(f"批量任务({job_id})完成，已发送{progress.sent}，失败{progress.failed}")
+
+    def close(self):
+        self.store.close()
+
+    async def _send(self, api:str, conf:dict, index:int, chunk:list, message:dict):
+        self._take_quota(api)
+        await self.buckets[api].acquire()
+        method = getattr(self.ba, conf["method"])
+        try:
+            if conf["batch"] > 1:
+                data = await method(chunk, message)
+            else:
+                data = await method(dict(message, touser=chunk[0]))
+        except QuotaExceededError:
+            raise
+        except WeChatApiError as e:
+            # 用户未关注、超过48小时未互动等，记为失败，继续发送其他批次
+            return SendResult(index, chunk, False, e.errcode, e.errmsg)
+        return SendResult(index, chunk, True, 0, "ok", data)
+
+    def _take_quota(self, api:str):
+        quota = self.daily_quota.get(api)
+        if not quota:
+            return
+        key = (api, time.strftime("%Y%m%d"))
+        used = self._quota_used.get(key)
+        if used is None:
+            # 每天只查询一次，同步查询避免并发的worker各自读到旧的计数
+            used = self.store.quota_used(self.ba.appid, *key)
+        if used >= quota:
+            raise QuotaExceededError(45009, f"{api}今日已调用{used}次，达到配额{quota}")
+        self._quota_used[key] = used + 1
+
+    async def _save(self, job_id:str, progress:_Progress):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.store.save, job_id, progress.watermark, set(progress.done),
+                                   progress.sent, progress.failed)
+        for (api, day), used in list(self._quota_used.items()):
+            await loop.run_in_executor(None, self.store.save_quota, self.ba.appid, api, day, used)
@@ -0,0 +1,91 @@
+'''公众号安全模式的消息加解密
+密文格式: base64(AES-256-CBC(16字节随机串 + 4字节网络序的消息长度 + 消息 + appid + PKCS#7填充(按32字节)))
+密钥为EncodingAESKey补上"="后base64解码的32字节，iv为密钥的前16字节
+'''
+import os
+import hmac
+import time
+import binascii
+from hashlib import sha1
+from xml.sax.saxutils import escape
+
+
+
+BLOCK_SIZE = 32
+
+_REPLY = ('<xml><Encrypt><![CDATA[%s]]></Encrypt><MsgSignature><![CDATA[%s]]></MsgSignature>'
+          '<TimeStamp>%s</TimeStamp><Nonce><![CDATA[%s]]></Nonce></xml>')
+
+
+class DecryptError(ValueError):
+    pass
+
+
+class WeChatCrypto:
+    '''一个公众号的加解密器，密钥和Cipher在创建时解析一次，每条消息只创建加解密上下文'''
+    def __init__(self, token:str, encoding_aes_key:str, appid:str) -> None:
+        # 只有安全模式需要，明文模式不用安装，也不在启动时导入
+        try:
+            from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        except ImportError:
+            raise RuntimeError("安全模式需要安装cryptography: pip install cryptography")
+        key = binascii.a2b_base64(encoding_aes_key + "=")
+        if len(key) != 32:
+            raise ValueError("EncodingAESKey应为43个字符")
+        self.token = token
+        self.appid = appid.encode()
+        self._cipher = Cipher(algorithms.AES(key), modes.CBC(key[:16]))
+
+    def signature(self, timestamp:str, nonce:str, encrypt:str) -> str:
+        return sha1("".join(sorted((self.token, timestamp, nonce, encrypt))).encode()).hexdigest()
+
+    def verify(self, msg_signature:str, timestamp:str, nonce:str, encrypt:str) -> bool:
+        # 比较bytes，msg_signature中有非ascii字符时compare_digest比较str会抛出TypeError
+        return hmac.compare_digest(self.signature(timestamp, nonce, encrypt).encode(), (msg_signature or "").encode())
+
+    def decrypt(self, encrypt:str) -> bytes:
+        '''解密消息中的Encrypt字段，返回明文xml，appid不一致或格式错误时抛出DecryptError'''
+        try:
+            data = binascii.a2b_base64(encrypt)
+            decryptor = self._cipher.decryptor()
+            plain = decryptor.update(data) + decryptor.finalize()
+        except ValueError as e:
+            raise DecryptError(f"解密失败: {e}")
+        # 用memoryview按偏移取各部分，不复制中间结果
+        view = memoryview(plain)
+        size = len(plain)
+        pad = plain[-1] if size else 0
+        if not 0 < pad <= BLOCK_SIZE or size - pad < 20:
+            raise DecryptError("填充错误")
+        end = size - pad
+        msg_len = int.from_bytes(view[16:20], "big")
+        if 20 + msg_len > end or view[20 + msg_len:end] != self.appid:
+            raise DecryptError("appid不一致")
+        return view[20:20 + msg_len].tobytes()
+
+    def encrypt(self, body) -> str:
+        '''加密回复的xml，返回base64字符串'''
+        if isinstance(body, str):
+            body = body.encode()
+        msg_len = len(body)
+        size = 20 + msg_len + len(self.appid)
+        pad = BLOCK_SIZE - size % BLOCK_SIZE
+        # 随机串、长度、消息、appid和填充直接写入同一个缓冲区
+        buf = bytearray(size + pad)
+        buf[:16] = os.urandom(16)
+        buf[16:20] = msg_len.to_bytes(4, "big")
+        buf[20:20 + msg_len] = body
+        buf[20 + msg_len:size] = self.appid
+        buf[size:] = bytes((pad,)) * pad
+        encryptor = self._cipher.encryptor()
+        data = encryptor.update(buf) + encryptor.finalize()
+        return binascii.b2a_base64(data, newline=False).decode()
+
+    def encrypt_reply(self, body, timestamp:str=None, nonce:str=None) -> str:
+        '''生成加密后的被动回复xml'''
+        timestamp = timestamp or str(int(time.time()))
+        nonce = nonce or binascii.hexlify(os.urandom(8)).decode()
+        encrypt = self.encrypt(body)
+        signature = self.signature(timestamp, nonce, encrypt)
+        # nonce来自已通过签名校验的请求，是微信生成的数字串
+        return _REPLY % (encrypt, signature, escape(timestamp), nonce)
@@ -0,0 +1,173 @@
+import time
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, Tuple
+from loguru import logger
+
+
+def dedup_key(request_data:dict):
+    '''普通消息使用MsgId去重，事件消息没有MsgId，使用FromUserName+CreateTime'''
+    msgid = request_data.get("MsgId")
+    if msgid:
+        return f'{request_data.get("ToUserName")}:{msgid}'
+    return f'{request_data.get("ToUserName")}:{request_data.get("FromUserName")}:{request_data.get("CreateTime")}'
+
+
+class MemoryDedupBackend:
+    '''进程内的去重缓存，超过maxsize时淘汰最久未使用的记录'''
+    def __init__(self, maxsize:int=10000) -> None:
+        self.maxsize = maxsize
+        # key -> [过期时间, 回复内容, 是否处理完成]
+        self._data = OrderedDict()
+
+    async def claim(self, key:str, ttl:float) -> Tuple[bool, Optional[str]]:
+        '''抢占处理权，返回(是否抢占成功, 已有的回复内容)'''
+        now = time.time()
+        item = self._data.get(key)
+        if item and item[0] > now:
+            self._data.move_to_end(key)
+            return False, item[1] if item[2] else None
+        self._data[key] = [now + ttl, None, False]
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return True, None
+
+    async def complete(self, key:str, reply:str, ttl:float):
+        self._data[key] = [time.time() + ttl, reply, True]
+
+    async def release(self, key:str):
+        self._data.pop(key, None)
+
+    async def get(self, key:str) -> Tuple[bool, Optional[str]]:
+        '''返回(是否处理完成, 回复内容)'''
+        item = self._data.get(key)
+        if item and item[0] > time.time():
+            return item[2], item[1]
+        return False, None
+
+    def close(self):
+        self._data.clear()
+
+
+class SqliteDedupBackend:
+    '''基于sqlite文件的去重缓存，同一台机器上的多个worker进程可以共享'''
+    def __init__(self, filename:str, cleanup_interval:int=1000) -> None:
+        self.conn = sqlite3.connect(filename, timeout=5, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS msg_dedup "
+            "(key TEXT PRIMARY KEY, expires_at REAL, reply TEXT, done INTEGER)"
+        )
+        self.cleanup_interval = cleanup_interval
+        self._lock = threading.Lock()
+        self._ops = 0
+
+    async def claim(self, key:str, ttl:float) -> Tuple[bool, Optional[str]]:
+        return await asyncio.get_running_loop().run_in_executor(None, self._claim, key, ttl)
+
+    async def complete(self, key:str, reply:str, ttl:float):
+        await asyncio.get_running_loop().run_in_executor(None, self._execute,
+            "UPDATE msg_dedup SET expires_at=?, reply=?, done=1 WHERE key=?", (time.time() + ttl, reply, key))
+
+    async def release(self, key:str):
+        await asyncio.get_running_loop().run_in_executor(None, self._execute,
+            "DELETE FROM msg_dedup WHERE key=?", (key,))
+
+    async def get(self, key:str) -> Tuple[bool, Optional[str]]:
+        return await asyncio.get_running_loop().run_in_executor(None, self._get, key)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def _execute(self, sql:str, args:tuple):
+        with self._lock:
+            self.conn.execute(sql, args)
+
+    def _claim(self, key:str, ttl:float):
+        now = time.time()
+        with self._lock:
+            self._ops += 1
+            if self._ops % self.cleanup_interval == 0:
+                self.conn.execute("DELETE FROM msg_dedup WHERE expires_at < ?", (now,))
+            cur = self.conn.execute(
+                "INSERT OR IGNORE INTO msg_dedup VALUES (?, ?, NULL, 0)", (key, now + ttl))
+            if cur.rowcount == 1:
+                return True, None
+            # 已过期的记录可以重新抢占，带上过期条件避免多个进程同时抢到
+            cur = self.conn.execute(
+                "UPDATE msg_dedup SET expires_at=?, reply=NULL, done=0 WHERE key=? AND expires_at < ?",
+                (now + ttl, key, now))
+            if cur.rowcount == 1:
+                return True, None
+            row = self.conn.execute("SELECT reply, done FROM msg_dedup WHERE key=?", (key,)).fetchone()
+        if row and row[1]:
+            return False, row[0]
+        return False, None
+
+    def _get(self, key:str):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT reply, done FROM msg_dedup WHERE key=? AND expires_at >= ?", (key, time.time())).fetchone()
+        if row:
+            return bool(row[1]), row[0]
+        return False, None
+
+
+class MessageDeduplicator:
+    '''微信在5秒内没有收到回复会重试3次，同一条消息只处理一次
+    处理中收到的重试会等待第一次处理的结果，处理完成后收到的重试直接返回缓存的回复
+    '''
+    def __init__(self, backend=None, ttl:float=60, wait_timeout:float=4.5) -> None:
+        self.backend = backend or MemoryDedupBackend()
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self._inflight = {}
+
+    async def run(self, key:str, handler:Callable[[], Awaitable[str]]) -> str:
+        task = self._inflight.get(key)
+        if task is None:
+            # 处理放在独立的task中，第一次请求的连接断开也不会中断处理，重试可以拿到结果
+            task = asyncio.ensure_future(self._run(key, handler))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_done(key, t))
+        else:
+            logger.info(f"消息({key})正在处理中，等待第一次处理的结果")
+        return await asyncio.shield(task)
+
+    def close(self):
+        self.backend.close()
+
+    def _on_done(self, key:str, task:asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            task.exception()
+
+    async def _run(self, key:str, handler:Callable[[], Awaitable[str]]):
+        claimed, reply = await self.backend.claim(key, self.ttl)
+        if not claimed:
+            logger.info(f"消息({key})已被处理，返回缓存的回复")
+            if reply is None:
+                reply = await self._wait_remote(key)
+            return reply
+        try:
+            reply = await handler()
+        except BaseException:
+            await self.backend.release(key)
+            raise
+        await self.backend.complete(key, reply, self.ttl)
+        return reply
+
+    async def _wait_remote(self, key:str):
+        '''其他worker进程正在处理，轮询等待其处理结果'''
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+            done, reply = await self.backend.get(key)
+            if done:
+                return reply
+        return "success"
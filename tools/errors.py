@@ -0,0 +1,54 @@
+class WeChatError(Exception):
+    '''调用微信接口出错的基类'''
+
+
+class UpstreamError(WeChatError):
+    '''网络错误、超时或HTTP状态码不是200，重试后仍然失败'''
+    def __init__(self, url:str, reason:str, status:int=None) -> None:
+        super().__init__(f"{reason}, url: {url}")
+        self.url = url
+        self.reason = reason
+        self.status = status
+
+
+class CircuitOpenError(UpstreamError):
+    '''接口所在主机连续失败，熔断期间直接失败不再请求'''
+
+
+class WeChatApiError(WeChatError):
+    '''接口返回了非0的errcode'''
+    def __init__(self, errcode:int, errmsg:str="", data:dict=None) -> None:
+        super().__init__(f"errcode: {errcode}, errmsg: {errmsg}")
+        self.errcode = errcode
+        self.errmsg = errmsg
+        self.data = data
+
+
+class SystemBusyError(WeChatApiError):
+    '''-1 系统繁忙，可以稍后重试'''
+
+
+class TokenInvalidError(WeChatApiError):
+    '''access_token无效、不是最新或已过期'''
+
+
+class QuotaExceededError(WeChatApiError):
+    '''接口调用次数超过限制'''
+
+
+ERRCODE_EXCEPTIONS = {
+    -1: SystemBusyError,
+    40001: TokenInvalidError,
+    40014: TokenInvalidError,
+    42001: TokenInvalidError,
+    45009: QuotaExceededError,
+    45011: QuotaExceededError,
+}
+
+
+def raise_for_errcode(data:dict):
+    '''errcode非0时抛出对应类型的异常'''
+    errcode = data.get("errcode")
+    if errcode:
+        exc_class = ERRCODE_EXCEPTIONS.get(errcode, WeChatApiError)
+        raise exc_class(errcode, data.get("errmsg", ""), data)
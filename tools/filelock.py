@@ -0,0 +1,42 @@
+import os
+import asyncio
+from contextlib import asynccontextmanager
+
+try:
+    import fcntl
+except ImportError: # windows下没有fcntl，不做进程间加锁
+    fcntl = None
+
+
+def _acquire(path:str):
+    if fcntl is None:
+        return None
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+
+def _release(fd):
+    if fd is None:
+        return
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+@asynccontextmanager
+async def file_lock(path:str):
+    '''基于flock的进程间互斥锁，同一台机器上的多个worker进程用来协调只让一个进程请求接口
+    在线程池中等待锁，不阻塞事件循环
+    '''
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(None, _acquire, path)
+    try:
+        fd = await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # 等待期间被取消，线程拿到锁后立即释放
+        future.add_done_callback(lambda f: f.cancelled() or f.exception() or _release(f.result()))
+        raise
+    try:
+        yield
+    finally:
+        await loop.run_in_executor(None, _release, fd)
@@ -0,0 +1,84 @@
+import socket
+import ipaddress
+from typing import Iterable
+
+_IPV4_MAPPED_PREFIX = b"\x00" * 10 + b"\xff\xff"
+
+
+class IPMatcher:
+    '''编译后的ip白名单，支持单个地址和CIDR网段，兼容IPv6
+    单个地址放在frozenset中，请求的远程地址一般是规范格式，先按字符串直接查找
+    网段按前缀长度分组，每组是右移后的网络号集合，查找次数等于不同前缀长度的个数(通常只有几个)
+    '''
+    __slots__ = ("_strings", "_packed", "_networks", "_size")
+
+    def __init__(self, entries:Iterable[str]=()) -> None:
+        strings, packed = set(), set()
+        networks = {4: {}, 6: {}}
+        size = 0
+        for entry in entries:
+            entry = str(entry).strip()
+            if not entry:
+                continue
+            network = ipaddress.ip_network(entry, strict=False)
+            size += 1
+            if network.prefixlen == network.max_prefixlen:
+                address = network.network_address
+                strings.add(str(address))
+                packed.add(address.packed)
+                continue
+            shift = network.max_prefixlen - network.prefixlen
+            networks[network.version].setdefault(shift, set()).add(int(network.network_address) >> shift)
+        self._strings = frozenset(strings)
+        self._packed = frozenset(packed)
+        # {ip版本: ((右移位数, 网络号集合), ...)}
+        self._networks = {version: tuple((shift, frozenset(nets)) for shift, nets in groups.items())
+                          for version, groups in networks.items()}
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, ip:str):
+        if ip in self._strings:
+            return True
+        packed = _pack(ip)
+        if packed is None:
+            return False
+        if packed in self._packed:
+            return True
+        value = int.from_bytes(packed, "big")
+        for shift, nets in self._networks[4 if len(packed) == 4 else 6]:
+            if value >> shift in nets:
+                return True
+        return False
+
+
+def _pack(ip:str):
+    '''ip地址转为网络字节序，比ipaddress.ip_address快很多；无效地址返回None'''
+    try:
+        return socket.inet_pton(socket.AF_INET, ip)
+    except (OSError, TypeError):
+        pass
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, ip.split("%", 1)[0])
+    except (OSError, TypeError, AttributeError):
+        return None
+    # 双栈监听时IPv4客户端的地址是::ffff:a.b.c.d
+    if packed[:12] == _IPV4_MAPPED_PREFIX:
+        return packed[12:]
+    return packed
+
+
+def real_client_ip(remote:str, forwarded_for:str, trusted_proxies:IPMatcher):
+    '''remote是可信的反向代理时，从X-Forwarded-For中取真实客户端地址
+    从右往左跳过可信代理，第一个不可信的地址就是客户端，左边的部分可能被客户端伪造，不采用
+    '''
+    if not forwarded_for or not trusted_proxies or remote not in trusted_proxies:
+        return remote
+    client = remote
+    for ip in reversed(forwarded_for.split(",")):
+        client = ip.strip()
+        if client not in trusted_proxies:
+            break
+    return client
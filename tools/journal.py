@@ -0,0 +1,221 @@
+'''回调消息日志(journal): 只追加的二进制文件，记录每条回调的消息体和元数据，用于重新处理和回放(见replay.py)
+记录格式: 20字节的头部(消息体长度、crc32、接收时间、flags、appid长度、ip长度) + appid + 来源ip + 消息体
+写入: 请求处理中只把编码好的记录放入队列，后台线程把上一次写入期间积累的记录合并为一次write(和fsync)
+文件超过segment_size后换新文件，文件名为{name}-{第一条记录的毫秒时间戳}.wjl，进程每次启动都从新文件开始
+读取: mmap整个文件，按头部中的长度跳过不在时间范围内的记录；进程崩溃时写了一半的记录在读取时丢弃
+'''
+import os
+import mmap
+import time
+import zlib
+import heapq
+import queue
+import struct
+import asyncio
+import threading
+from typing import Iterator, List, NamedTuple
+from loguru import logger
+from .metrics import JOURNAL_RECORDS
+
+
+SUFFIX = ".wjl"
+FLAG_ENCRYPTED = 1
+
+# 消息体长度, crc32(头部之后的全部内容)
+_PREFIX = struct.Struct("<II")
+# 接收时间, flags, appid长度, ip长度
+_META = struct.Struct("<dHBB")
+HEADER_SIZE = _PREFIX.size + _META.size
+_STOP = object()
+
+
+class JournalRecord(NamedTuple):
+    time: float
+    appid: str          # 回调地址中的appid，默认回调地址为空
+    remote: str
+    encrypted: bool     # 是否为安全模式，body都是解密后的明文
+    body: bytes
+
+
+def encode_record(record:JournalRecord) -> bytes:
+    appid = record.appid.encode()
+    remote = record.remote.encode()
+    meta = _META.pack(record.time, FLAG_ENCRYPTED if record.encrypted else 0, len(appid), len(remote))
+    crc = zlib.crc32(record.body, zlib.crc32(remote, zlib.crc32(appid, zlib.crc32(meta))))
+    return b"".join((_PREFIX.pack(len(record.body), crc), meta, appid, remote, record.body))
+
+
+def read_segment(path:str, start:float=None, end:float=None) -> Iterator[JournalRecord]:
+    '''按顺序读取一个文件中接收时间在[start, end)内的记录'''
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset = 0
+            while offset + HEADER_SIZE <= size:
+                body_len, crc = _PREFIX.unpack_from(mm, offset)
+                received_at, flags, appid_len, remote_len = _META.unpack_from(mm, offset + _PREFIX.size)
+                record_end = offset + HEADER_SIZE + appid_len + remote_len + body_len
+                if record_end > size:
+                    logger.warning(f"{path}的最后一条记录不完整，已忽略")
+                    return
+                if end is not None and received_at >= end:
+                    return
+                if start is not None and received_at < start:
+                    offset = record_end
+                    continue
+                data = mm[offset + _PREFIX.size:record_end]
+                if zlib.crc32(data) != crc:
+                    logger.warning(f"{path}在{offset}处的记录校验失败，停止读取该文件")
+                    return
+                pos = _META.size
+                appid = data[pos:pos + appid_len].decode()
+                pos += appid_len
+                remote = data[pos:pos + remote_len].decode()
+                pos += remote_len
+                yield JournalRecord(received_at, appid, remote, bool(flags & FLAG_ENCRYPTED), data[pos:])
+                offset = record_end
+
+
+def list_segments(directory:str) -> dict:
+    '''返回{name: [按时间排序的文件路径]}'''
+    segments = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(SUFFIX):
+            continue
+        name, _, first_ms = filename[:-len(SUFFIX)].rpartition("-")
+        if name and first_ms.isdigit():
+            segments.setdefault(name, []).append((int(first_ms), os.path.join(directory, filename)))
+    return {name: [path for _, path in sorted(items)] for name, items in segments.items()}
+
+
+def iter_journal(directory:str, start:float=None, end:float=None) -> Iterator[JournalRecord]:
+    '''按接收时间顺序读取目录中所有进程(worker)写的记录'''
+    streams = []
+    for name, paths in list_segments(directory).items():
+        if start is not None:
+            # 下一个文件的第一条记录早于start时，这个文件中没有需要的记录(文件名中的时间精确到毫秒)
+            firsts = [_first_time(path) for path in paths]
+            paths = [path for i, path in enumerate(paths) if i + 1 == len(paths) or firsts[i + 1] + 0.001 > start]
+        if end is not None:
+            paths = [path for path in paths if _first_time(path) < end]
+        streams.append(_chain(paths, start, end))
+    return heapq.merge(*streams, key=lambda record: record.time)
+
+
+def _first_time(path:str) -> float:
+    return int(os.path.basename(path)[:-len(SUFFIX)].rpartition("-")[2]) / 1000
+
+
+def _chain(paths:List[str], start:float, end:float):
+    for path in paths:
+        yield from read_segment(path, start, end)
+
+
+class Journal:
+    '''一个进程的回调消息日志，多进程时每个worker使用不同的name
+    fsync为True时每次写入后fsync，append返回写入完成的future，回复微信之前等待它；否则只保证写入到操作系统
+    队列满(磁盘跟不上)时丢弃记录并计数，不阻塞请求处理
+    '''
+    def __init__(self, directory:str, name:str="journal", segment_size:int=64 * 1024 * 1024, fsync:bool=False,
+                 queue_size:int=10000, max_batch:int=1000) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = name
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.max_batch = max_batch
+        self.queue = queue.Queue(queue_size)
+        self._fd = None
+        self._size = 0
+        self._thread = threading.Thread(target=self._run, name="journal-writer", daemon=True)
+        self._thread.start()
+
+    def append(self, appid:str, remote:str, body:bytes, encrypted:bool=False, received_at:float=None) -> asyncio.Future:
+        record = JournalRecord(received_at or time.time(), appid or "", remote or "", encrypted, body)
+        future = asyncio.get_running_loop().create_future() if self.fsync else None
+        try:
+            self.queue.put_nowait((encode_record(record), future))
+        except queue.Full:
+            JOURNAL_RECORDS.labels("dropped").inc()
+            return None
+        return future
+
+    def close(self):
+        '''写完队列中已有的记录后关闭文件'''
+        try:
+            self.queue.put((_STOP, None), timeout=5)
+        except queue.Full:
+            logger.warning("回调消息日志队列已满，关闭时丢弃未写入的记录")
+        self._thread.join(timeout=10)
+
+    def _run(self):
+        running = True
+        while running:
+            items = [self.queue.get()]
+            # 上一次写入期间积累的记录合并为一次写入
+            while len(items) < self.max_batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if any(data is _STOP for data, _ in items):
+                running = False
+                items = [item for item in items if item[0] is not _STOP]
+            ok = True
+            if items:
+                try:
+                    self._write(b"".join(data for data, _ in items))
+                    JOURNAL_RECORDS.labels("written").inc(len(items))
+                except OSError:
+                    logger.exception("写入回调消息日志失败")
+                    JOURNAL_RECORDS.labels("failed").inc(len(items))
+                    ok = False
+                    # 文件末尾可能有写了一半的记录，之后写到新文件
+                    self._close_segment()
+            futures = [future for _, future in items if future is not None]
+            if futures:
+                try:
+                    futures[0].get_loop().call_soon_threadsafe(_resolve, futures, ok)
+                except RuntimeError:
+                    # 事件循环已关闭
+                    pass
+        self._close_segment()
+
+    def _write(self, data:bytes):
+        if self._fd is None or self._size + len(data) > self.segment_size:
+            self._rotate(_META.unpack_from(data, _PREFIX.size)[0])
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]
+        if self.fsync:
+            os.fsync(self._fd)
+        self._size += len(data)
+
+    def _close_segment(self):
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+
+    def _rotate(self, first_time:float):
+        self._close_segment()
+        first_ms = int(first_time * 1000)
+        while True:
+            path = os.path.join(self.directory, f"{self.name}-{first_ms:013d}{SUFFIX}")
+            try:
+                self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o644)
+                break
+            except FileExistsError:
+                first_ms += 1
+        self._size = 0
+        logger.info(f"回调消息日志写入新文件: {path}")
+
+
+def _resolve(futures:List[asyncio.Future], ok:bool):
+    for future in futures:
+        if not future.done():
+            future.set_result(ok)
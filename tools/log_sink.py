@@ -0,0 +1,175 @@
+'''日志输出
+文本格式(默认): loguru的文件sink，在调用logger的协程中同步格式化和写文件
+json格式: 事件循环中只把记录放入有界队列，由后台线程格式化为json并批量写文件，队列满时丢弃并计数
+按类别采样: 调用处用logger.bind(category=..., data=...)标记类别，较大的内容放在data中，被采样写出时才格式化
+每条记录只采样一次: LogSampler.patch作为logger的patcher把结果记在记录中，各个输出的filter读取同一个结果
+'''
+import json
+import time
+import queue
+import random
+import threading
+import traceback
+from typing import Dict
+from collections.abc import Mapping
+from .metrics import LOG_RECORDS
+
+
+TEXT_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
+)
+
+# WARNING及以上的记录不采样
+_ALWAYS_LEVEL = 30
+_STOP = object()
+# 后台线程每格式化多少条记录让出一次GIL
+_YIELD_EVERY = 20
+# patch的采样结果在extra中的键，不写到日志中
+_SAMPLED = "_sampled"
+
+
+def text_format(record:dict):
+    '''loguru默认的格式，带data时附在消息后面'''
+    if "data" in record["extra"]:
+        return TEXT_FORMAT + " | {extra[data]}\n{exception}"
+    return TEXT_FORMAT + "\n{exception}"
+
+
+class LogSampler:
+    '''按类别采样，rates为{类别: 保留比例}，没有配置的类别全部保留
+    有多个输出时用logger.configure(patcher=sampler.patch)，再把sampler作为每个输出的filter，
+    所有输出写出同样的记录；没有设置patcher时filter自己采样，只适合一个输出
+    '''
+    def __init__(self, rates:Dict[str, float]=None) -> None:
+        self.rates = dict(rates or {})
+
+    def patch(self, record:dict):
+        record["extra"][_SAMPLED] = self._sample(record)
+
+    def __call__(self, record:dict) -> bool:
+        sampled = record["extra"].get(_SAMPLED)
+        if sampled is None:
+            return self._sample(record)
+        return sampled
+
+    def _sample(self, record:dict) -> bool:
+        if record["level"].no >= _ALWAYS_LEVEL:
+            return True
+        rate = self.rates.get(record["extra"].get("category"), 1)
+        if rate >= 1 or random.random() < rate:
+            return True
+        LOG_RECORDS.labels("sampled_out").inc()
+        return False
+
+
+class BackgroundJsonSink:
+    '''loguru的sink，每行一个json对象，文件按天切分: {filename}.{YYYY-MM-DD}
+    write只把记录放入队列；后台线程攒够batch_size条或等待flush_interval秒后写一次，ERROR及以上立即写
+    data等传给logger的对象在写出之前不要再修改
+    '''
+    def __init__(self, filename:str, queue_size:int=10000, batch_size:int=500, flush_interval:float=1.0) -> None:
+        self.filename = filename
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(queue_size)
+        self._file = None
+        self._day = None
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, message):
+        try:
+            self.queue.put_nowait(message.record)
+        except queue.Full:
+            LOG_RECORDS.labels("dropped").inc()
+
+    def stop(self):
+        '''logger.remove时调用，写完队列中已有的记录'''
+        try:
+            self.queue.put(_STOP, timeout=self.flush_interval)
+        except queue.Full:
+            pass
+        self._thread.join(timeout=5)
+
+    def _run(self):
+        running = True
+        while running:
+            records = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(records) < self.batch_size and records[-1] is not _STOP and self._can_wait(records[-1]):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    records.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if records[-1] is _STOP:
+                records.pop()
+                running = False
+            try:
+                self._write(records)
+            except Exception:
+                traceback.print_exc()
+        if self._file:
+            self._file.close()
+
+    @staticmethod
+    def _can_wait(record):
+        return record["level"].no < 40
+
+    def _write(self, records:list):
+        if not records:
+            return
+        day = time.strftime("%Y-%m-%d")
+        if day != self._day:
+            if self._file:
+                self._file.close()
+            self._file = open(f"{self.filename}.{day}", "a", encoding="utf-8")
+            self._day = day
+        lines = []
+        for i, record in enumerate(records):
+            if i and i % _YIELD_EVERY == 0:
+                # 主动释放GIL，不让事件循环线程等满切换间隔(默认5ms)
+                time.sleep(0)
+            try:
+                lines.append(self._format(record))
+            except Exception as e:
+                lines.append(json.dumps({"time": record["time"].isoformat(), "level": record["level"].name,
+                                         "message": record["message"], "format_error": repr(e)}, ensure_ascii=False))
+        self._file.write("\n".join(lines) + "\n")
+        self._file.flush()
+        LOG_RECORDS.labels("written").inc(len(lines))
+
+    @staticmethod
+    def _format(record:dict):
+        extra = dict(record["extra"])
+        extra.pop(_SAMPLED, None)
+        item = {
+            "time": record["time"].isoformat(),
+            "level": record["level"].name,
+            "category": extra.pop("category", ""),
+            "message": record["message"],
+            "name": record["name"],
+            "function": record["function"],
+            "line": record["line"],
+            "pid": record["process"].id,
+        }
+        if extra:
+            item["extra"] = extra
+        exception = record["exception"]
+        if exception:
+            item["exception"] = "".join(traceback.format_exception(exception.type, exception.value, exception.traceback))
+        return json.dumps(item, ensure_ascii=False, default=_to_json)
+
+
+def _to_json(value):
+    '''data中json不支持的对象: WeChatMessage等有to_dict的对象和映射输出为对象，其他输出为字符串'''
+    if hasattr(value, "to_dict"):
+        return value.to_dict()
+    if isinstance(value, Mapping):
+        return dict(value)
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).decode("utf-8", "replace")
+    return str(value)
@@ -0,0 +1,209 @@
+'''永久素材库的本地索引
+素材列表保存在sqlite中，启动时载入内存，按media_id、名称、文件哈希查找不需要调用接口
+增量同步: 素材列表按更新时间倒序返回，只读取比上次同步更新的部分；总数对不上(有删除)时该类型全量同步
+'''
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+from typing import AsyncIterator, Dict, Iterable, List, NamedTuple
+from loguru import logger
+
+
+MATERIAL_TYPES = ("image", "voice", "video", "news")
+PAGE_SIZE = 20
+
+
+class Material(NamedTuple):
+    media_id: str
+    type: str
+    name: str           # 图文素材为第一篇文章的标题
+    url: str
+    update_time: int
+    content_hash: str   # 通过本程序上传的素材才有，见MediaCache
+
+
+class MaterialLibrary:
+    '''内存中只保存查找用的字段，图文素材的正文只在sqlite中，用get_news读取'''
+    def __init__(self, ba, filename:str) -> None:
+        self.ba = ba
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(filename, timeout=5, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS material (media_id TEXT PRIMARY KEY, type TEXT, name TEXT, url TEXT, "
+            "update_time INTEGER, content_hash TEXT, content TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS material_name ON material (type, name)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS material_hash ON material (content_hash)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS material_sync (type TEXT PRIMARY KEY, last_update INTEGER, synced_at REAL)"
+        )
+        self._lock = threading.Lock()
+        self._sync_lock = asyncio.Lock()
+        self._by_id:Dict[str, Material] = {}
+        self._by_name:Dict[tuple, Material] = {}
+        self._by_hash:Dict[str, Material] = {}
+        rows = self.conn.execute(
+            "SELECT media_id, type, name, url, update_time, content_hash FROM material ORDER BY update_time")
+        for row in rows:
+            self._add(Material(*row))
+        self._last_update = dict(self.conn.execute("SELECT type, last_update FROM material_sync"))
+
+    def get(self, media_id:str) -> Material:
+        return self._by_id.get(media_id)
+
+    def find(self, name:str, material_type:str=None) -> Material:
+        '''按名称查找，同名时返回最近更新的'''
+        if material_type:
+            return self._by_name.get((material_type, name))
+        for material_type in MATERIAL_TYPES:
+            material = self._by_name.get((material_type, name))
+            if material:
+                return material
+
+    def find_by_hash(self, content_hash:str) -> Material:
+        return self._by_hash.get(content_hash)
+
+    async def find_by_file(self, path:str) -> Material:
+        '''本地文件是否已经是永久素材'''
+        return self._by_hash.get(await self.ba.media_cache.file_hash(path))
+
+    def items(self, material_type:str=None) -> Iterable[Material]:
+        return (m for m in list(self._by_id.values()) if material_type is None or m.type == material_type)
+
+    async def get_news(self, media_id:str) -> List[dict]:
+        '''图文素材的文章列表(news_item)'''
+        loop = asyncio.get_running_loop()
+        row = await loop.run_in_executor(None, self._query_one, "SELECT content FROM material WHERE media_id=?", (media_id,))
+        return json.loads(row[0]) if row and row[0] else []
+
+    async def iter_remote(self, material_type:str) -> AsyncIterator[dict]:
+        '''逐个返回素材库中的素材，每次请求一页(20个)，用完当前页才请求下一页'''
+        offset = 0
+        while True:
+            data = await self.ba.batchget_material(material_type, offset, PAGE_SIZE)
+            items = data.get("item") or []
+            for item in items:
+                yield item
+            offset += len(items)
+            if not items or offset >= data.get("total_count", 0):
+                break
+
+    async def sync(self, types:Iterable[str]=MATERIAL_TYPES, full:bool=False) -> Dict[str, int]:
+        '''同步素材库，返回各类型新增或更新的素材数'''
+        async with self._sync_lock:
+            counts = await self.ba.get_material_count()
+            hashes = self.ba.media_cache.hashes("material")
+            changed = {}
+            for material_type in types:
+                remote_count = counts.get(f"{material_type}_count", 0)
+                changed[material_type] = await self._sync_type(material_type, remote_count, hashes, full)
+            return changed
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    async def _sync_type(self, material_type:str, remote_count:int, hashes:dict, full:bool):
+        last_update = self._last_update.get(material_type, 0)
+        local_ids = {m.media_id for m in self._by_id.values() if m.type == material_type}
+        if not full and last_update:
+            rows = []
+            remote = self.iter_remote(material_type)
+            try:
+                async for item in remote:
+                    row = self._parse(material_type, item, hashes)
+                    # 同一秒内更新的素材可能在上次同步之后，相等的也重新保存
+                    if row[0].update_time < last_update:
+                        break
+                    rows.append(row)
+            finally:
+                await remote.aclose()
+            await self._save(material_type, rows, ())
+            if len(local_ids | {row[0].media_id for row in rows}) == remote_count:
+                return len(rows)
+            logger.info(f"{material_type}素材数量与本地不一致，全量同步")
+        rows = []
+        async for item in self.iter_remote(material_type):
+            rows.append(self._parse(material_type, item, hashes))
+        deleted = local_ids - {row[0].media_id for row in rows}
+        await self._save(material_type, rows, deleted)
+        logger.info(f"全量同步{material_type}素材: {len(rows)}个，删除{len(deleted)}个")
+        return len(rows)
+
+    def _parse(self, material_type:str, item:dict, hashes:dict):
+        '''返回(Material, 图文正文json)'''
+        content = None
+        if material_type == "news":
+            articles = (item.get("content") or {}).get("news_item") or [{}]
+            name, url = articles[0].get("title"), articles[0].get("url")
+            content = json.dumps(articles, ensure_ascii=False)
+        else:
+            name, url = item.get("name"), item.get("url")
+        media_id = item["media_id"]
+        material = Material(media_id, material_type, name, url, int(item.get("update_time") or 0), hashes.get(media_id))
+        return material, content
+
+    async def _save(self, material_type:str, rows:list, deleted:Iterable[str]):
+        last_update = max([self._last_update.get(material_type, 0)] + [row[0].update_time for row in rows])
+        loop = asyncio.get_running_loop()
+        deleted = list(deleted)
+        await loop.run_in_executor(None, self._write, material_type, rows, deleted, last_update)
+        if deleted:
+            # 在公众号后台删除的素材，素材缓存中对应的media_id也不能再用
+            await self.ba.media_cache.forget(*deleted)
+        for media_id in deleted:
+            self._remove(media_id)
+        for material, _ in sorted(rows, key=lambda row: row[0].update_time):
+            old = self._by_id.get(material.media_id)
+            if old == material:
+                continue
+            if old is not None and (old.name, old.content_hash) != (material.name, material.content_hash):
+                self._remove(old.media_id)
+            self._add(material)
+        self._last_update[material_type] = last_update
+
+    def _write(self, material_type:str, rows:list, deleted:list, last_update:int):
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany("REPLACE INTO material VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                      [tuple(material) + (content,) for material, content in rows])
+                self.conn.executemany("DELETE FROM material WHERE media_id=?", [(media_id,) for media_id in deleted])
+                self.conn.execute("REPLACE INTO material_sync VALUES (?, ?, ?)", (material_type, last_update, time.time()))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _query_one(self, sql:str, params:tuple):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def _add(self, material:Material):
+        self._by_id[material.media_id] = material
+        if material.name:
+            # 同名的保留最近更新的
+            key = (material.type, material.name)
+            current = self._by_name.get(key)
+            if current is None or current.media_id == material.media_id or current.update_time <= material.update_time:
+                self._by_name[key] = material
+        if material.content_hash:
+            self._by_hash[material.content_hash] = material
+
+    def _remove(self, media_id:str):
+        material = self._by_id.pop(media_id, None)
+        if material is None:
+            return
+        key = (material.type, material.name)
+        if self._by_name.get(key) is material:
+            del self._by_name[key]
+            # 同名的其他素材补上
+            others = [m for m in self._by_id.values() if (m.type, m.name) == key]
+            if others:
+                self._by_name[key] = max(others, key=lambda m: m.update_time)
+        if material.content_hash and self._by_hash.get(material.content_hash) is material:
+            del self._by_hash[material.content_hash]
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from typing import Awaitable, Callable, Optional
+from loguru import logger
+from .metrics import MEDIA_CACHE
+
+
+# 临时素材有效期3天，提前1小时视为过期
+TMP_MEDIA_TTL = 3 * 86400 - 3600
+
+
+class MediaCache:
+    '''按文件内容哈希缓存上传得到的media_id/url，避免重复上传同一个文件
+    kind取值: "tmp"临时素材(3天后过期)、"material"永久素材、"img"图文消息内的图片(返回url，永久有效)
+    文件的mtime和大小没有变化时直接使用上次计算的哈希
+    缓存上传接口返回的完整json，命中和上传时返回同样的内容
+    '''
+    def __init__(self, filename:str) -> None:
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(filename, timeout=5, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS media "
+            "(hash TEXT, media_type TEXT, kind TEXT, media_id TEXT, url TEXT, created_at REAL, data TEXT, "
+            "PRIMARY KEY (hash, media_type, kind))"
+        )
+        if "data" not in {row[1] for row in self.conn.execute("PRAGMA table_info(media)")}:
+            # 旧版本的缓存文件没有data列，这些记录命中时只返回media_id和url
+            self.conn.execute("ALTER TABLE media ADD COLUMN data TEXT")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_stat (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT)"
+        )
+        self._lock = threading.Lock()
+        self._index = {}
+        for row in self.conn.execute("SELECT hash, media_type, kind, media_id, url, created_at, data FROM media"):
+            data = json.loads(row[6]) if row[6] else {"media_id": row[3], "url": row[4]}
+            self._index[row[:3]] = row[3:6] + (data,)
+        self._stats = {}
+        for row in self.conn.execute("SELECT path, mtime, size, hash FROM file_stat"):
+            self._stats[row[0]] = row[1:]
+        self._inflight = {}
+
+    async def get_or_upload(self, kind:str, media_type:str, path:str, upload:Callable[[], Awaitable[Optional[dict]]]):
+        '''缓存命中时返回缓存的上传结果，否则调用upload上传并缓存结果，每次返回新的dict
+        同一个文件的并发上传会合并为一次请求
+        '''
+        file_hash = await self.file_hash(path)
+        key = (file_hash, media_type, kind)
+        cached = self._lookup(key)
+        if cached:
+            logger.debug(f"素材缓存命中: {path} -> {cached}")
+            MEDIA_CACHE.labels("hit").inc()
+            return cached
+        MEDIA_CACHE.labels("miss").inc()
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._upload(key, upload))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key, None))
+        data = await asyncio.shield(task)
+        # 合并的上传共用同一个结果，复制一份，调用者修改时互不影响
+        return dict(data) if data else data
+
+    async def file_hash(self, path:str) -> str:
+        '''文件内容的sha256，文件没有变化时使用上次的结果'''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._file_hash, path)
+
+    def hashes(self, kind:str) -> dict:
+        '''{media_id: 文件哈希}，用于给从素材库同步的素材关联本地文件'''
+        return {value[0]: key[0] for key, value in self._index.items() if key[2] == kind and value[0]}
+
+    async def forget(self, *media_ids:str):
+        '''素材在公众号后台被删除后调用，移除对应的缓存
+        索引只在事件循环中修改，线程池中只执行sqlite的删除
+        '''
+        media_ids = set(media_ids)
+        for key in [key for key, value in self._index.items() if value[0] in media_ids]:
+            del self._index[key]
+        await asyncio.get_running_loop().run_in_executor(None, self._delete, list(media_ids))
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def _lookup(self, key:tuple):
+        value = self._index.get(key)
+        if not value:
+            return
+        media_id, url, created_at, data = value
+        if key[2] == "tmp" and created_at + TMP_MEDIA_TTL < time.time():
+            return
+        return dict(data)
+
+    async def _upload(self, key:tuple, upload:Callable[[], Awaitable[Optional[dict]]]):
+        data = await upload()
+        if not data or not (data.get("media_id") or data.get("url")):
+            return data
+        # 临时素材接口返回的created_at为上传时间，其他接口没有返回时使用当前时间
+        value = (data.get("media_id"), data.get("url"), float(data.get("created_at") or time.time()), dict(data))
+        self._index[key] = value
+        await asyncio.get_running_loop().run_in_executor(None, self._save, key, value)
+        return data
+
+    def _save(self, key:tuple, value:tuple):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              key + value[:3] + (json.dumps(value[3], ensure_ascii=False),))
+
+    def _delete(self, media_ids:list):
+        with self._lock:
+            self.conn.executemany("DELETE FROM media WHERE media_id=?", [(media_id,) for media_id in media_ids])
+
+    def _file_hash(self, path:str):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stat = self._stats.get(path)
+        if stat and stat[0] == st.st_mtime and stat[1] == st.st_size:
+            return stat[2]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        file_hash = sha.hexdigest()
+        self._stats[path] = (st.st_mtime, st.st_size, file_hash)
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO file_stat VALUES (?, ?, ?, ?)",
+                (path, st.st_mtime, st.st_size, file_hash))
+        return file_hash
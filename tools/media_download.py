@@ -0,0 +1,132 @@
+import os
+import json
+import asyncio
+import shutil
+import aiofiles
+from contextlib import asynccontextmanager, suppress
+from typing import AsyncIterator, Awaitable, Callable
+from loguru import logger
+from aiohttp import ClientResponse
+from .errors import WeChatError, UpstreamError, TokenInvalidError, raise_for_errcode
+from .metrics import DOWNLOAD_BYTES
+
+
+# 微信接口出错时返回json，素材内容是image/jpeg、audio/amr等
+_JSON_TYPES = ("application/json", "text/plain")
+
+
+class MediaDownloader:
+    '''下载用户发来的图片、语音、视频(/cgi-bin/media/get)和图片消息的PicUrl
+    按chunk_size分块读取，不把整个文件放到内存中，同时下载的数量不超过max_concurrent
+    写文件时先写临时文件再重命名，同一个MediaId的并发下载合并为一次，保存到其他路径的调用者在下载完成后复制一份
+    '''
+    def __init__(self, ba, max_concurrent:int=4, chunk_size:int=64 * 1024) -> None:
+        self.ba = ba
+        self.chunk_size = chunk_size
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self._inflight = {}
+
+    async def iter_media(self, media_id:str) -> AsyncIterator[bytes]:
+        '''逐块返回素材内容，视频消息的素材从接口返回的video_url下载
+        迭代期间占用一个并发名额，读取慢时会影响其他下载
+        '''
+        async with self.semaphore:
+            async with self._open_media(media_id) as resp:
+                async for chunk in resp.content.iter_chunked(self.chunk_size):
+                    DOWNLOAD_BYTES.labels("media").inc(len(chunk))
+                    yield chunk
+
+    async def iter_url(self, url:str) -> AsyncIterator[bytes]:
+        '''逐块返回不需要access_token的链接的内容，如图片消息的PicUrl'''
+        async with self.semaphore:
+            async with self.ba.client.stream("GET", url) as resp:
+                async for chunk in resp.content.iter_chunked(self.chunk_size):
+                    DOWNLOAD_BYTES.labels("url").inc(len(chunk))
+                    yield chunk
+
+    async def download(self, media_id:str, path:str, overwrite:bool=False) -> str:
+        '''下载素材到path，返回文件路径；同一个MediaId正在下载时等待那次下载的结果'''
+        return await self._download(media_id, lambda: self.iter_media(media_id), path, overwrite)
+
+    async def download_url(self, url:str, path:str, overwrite:bool=False) -> str:
+        return await self._download(url, lambda: self.iter_url(url), path, overwrite)
+
+    async def download_to(self, media_id:str, sink:Callable[[bytes], Awaitable]) -> int:
+        '''把素材内容逐块交给sink(如上传到对象存储)，返回总字节数'''
+        size = 0
+        async for chunk in self.iter_media(media_id):
+            await sink(chunk)
+            size += len(chunk)
+        return size
+
+    async def _download(self, key:str, chunks:Callable[[], AsyncIterator[bytes]], path:str, overwrite:bool):
+        if not overwrite and os.path.exists(path):
+            return path
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(self._write_file(chunks, path))
+            task.add_done_callback(lambda t: self._inflight.pop(key, None))
+        downloaded = await asyncio.shield(task)
+        if os.path.abspath(downloaded) != os.path.abspath(path):
+            await asyncio.get_running_loop().run_in_executor(None, _copy_file, downloaded, path)
+        return path
+
+    async def _write_file(self, chunks:Callable[[], AsyncIterator[bytes]], path:str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_file = f"{path}.{os.getpid()}.{id(chunks)}.tmp"
+        size = 0
+        try:
+            async with aiofiles.open(tmp_file, "wb") as fw:
+                async for chunk in chunks():
+                    await fw.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp_file, path)
+        except BaseException:
+            with suppress(OSError):
+                os.remove(tmp_file)
+            raise
+        logger.info(f"下载完成: {path}, 大小: {size}")
+        return path
+
+    @asynccontextmanager
+    async def _open_media(self, media_id:str) -> ClientResponse:
+        url = f"{self.ba.api_base}/cgi-bin/media/get"
+        for attempt in range(2):
+            token_data = await self.ba.get_access_token()
+            if not token_data:
+                raise WeChatError("获取access_token失败")
+            params = {"access_token": token_data["access_token"], "media_id": media_id}
+            async with self.ba.client.stream("GET", url, params=params) as resp:
+                if resp.content_type not in _JSON_TYPES:
+                    yield resp
+                    return
+                text = await resp.text()
+            try:
+                data = json.loads(text)
+            except ValueError:
+                raise UpstreamError(url, f"响应不是json: {text[:200]}")
+            if data.get("video_url"):
+                async with self.ba.client.stream("GET", data["video_url"]) as resp:
+                    yield resp
+                return
+            try:
+                raise_for_errcode(data)
+            except TokenInvalidError as e:
+                if attempt:
+                    raise
+                logger.warning(f"access_token已失效，刷新后重试: {e}")
+                await self.ba.token_manager.invalidate(token_data["access_token"])
+                continue
+            raise UpstreamError(url, f"响应中没有素材内容: {text[:200]}")
+
+
+def _copy_file(src:str, dst:str):
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    tmp_file = f"{dst}.{os.getpid()}.copy.tmp"
+    try:
+        shutil.copyfile(src, tmp_file)
+        os.replace(tmp_file, dst)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(tmp_file)
+        raise
@@ -0,0 +1,172 @@
+'''进程内的监控指标，输出Prometheus文本格式
+直方图的桶在创建时预先分配，记录一次只有一次二分查找和几次加法，不产生新对象
+'''
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Tuple
+
+
+# 默认的耗时桶(秒)，覆盖1ms到微信5秒超时
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 2 * 1024 * 1024, 5 * 1024 * 1024, 10 * 1024 * 1024)
+
+
+def _escape(value:str):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names:Tuple[str, ...], values:tuple, extra:str=""):
+    items = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        items.append(extra)
+    return "{" + ",".join(items) + "}" if items else ""
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds:tuple) -> None:
+        self.bounds = bounds
+        # 最后一个桶是+Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value:float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount:float=1):
+        self.value += amount
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name:str, documentation:str, labelnames:Tuple[str, ...]=()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        '''按标签值获取子指标，同一组标签值只在第一次使用时创建'''
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        '''创建一组标签值对应的子指标'''
+
+    @abstractmethod
+    def _render_child(self, values:tuple, child):
+        '''返回一个子指标的各行文本'''
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount:float=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, values:tuple, child:_CounterChild):
+        yield f"{self.name}{_format_labels(self.labelnames, values)} {child.value}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name:str, documentation:str, labelnames:Tuple[str, ...]=(), buckets:tuple=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value:float):
+        self.labels().observe(value)
+
+    def _render_child(self, values:tuple, child:_HistogramChild):
+        total = 0
+        counts = list(child.counts)
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            total += count
+            le = 'le="%s"' % bound
+            yield f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {total}"
+        yield f"{self.name}_sum{_format_labels(self.labelnames, values)} {child.sum}"
+        yield f"{self.name}_count{_format_labels(self.labelnames, values)} {total}"
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics = {}
+
+    def counter(self, name:str, documentation:str, labelnames:Tuple[str, ...]=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name:str, documentation:str, labelnames:Tuple[str, ...]=(), buckets:tuple=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric:_Metric):
+        # 同名指标只注册一次，重复导入模块时返回已有的
+        return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+REQUEST_LATENCY = registry.histogram(
+    "wechat_callback_duration_seconds", "回调请求经过全部中间件和处理函数的耗时", ("msg_type", "event"))
+REQUESTS = registry.counter(
+    "wechat_callback_requests_total", "回调请求数", ("msg_type", "event", "status"))
+UPSTREAM_LATENCY = registry.histogram(
+    "wechat_upstream_duration_seconds", "调用微信接口的耗时(包含重试)", ("endpoint",))
+UPSTREAM_CALLS = registry.counter(
+    "wechat_upstream_calls_total", "调用微信接口的次数", ("endpoint", "outcome"))
+TOKEN_CACHE = registry.counter(
+    "wechat_access_token_total", "access_token缓存命中、未命中和刷新的次数", ("result",))
+UPLOAD_BYTES = registry.counter(
+    "wechat_upload_bytes_total", "上传的素材字节数", ("media_type",))
+UPLOAD_SIZE = registry.histogram(
+    "wechat_upload_size_bytes", "上传的素材大小", ("media_type",), BYTES_BUCKETS)
+UPLOAD_LATENCY = registry.histogram(
+    "wechat_upload_duration_seconds", "上传素材的耗时", ("media_type",))
+MEDIA_CACHE = registry.counter(
+    "wechat_media_cache_total", "素材缓存命中和未命中的次数", ("result",))
+DOWNLOAD_BYTES = registry.counter(
+    "wechat_download_bytes_total", "下载的素材字节数", ("source",))
+USER_INFO_CACHE = registry.counter(
+    "wechat_user_info_cache_total", "用户信息缓存命中和未命中的次数", ("result",))
+LOG_RECORDS = registry.counter(
+    "wechat_log_records_total", "日志记录写出、采样丢弃和队列满丢弃的条数", ("result",))
+JOURNAL_RECORDS = registry.counter(
+    "wechat_journal_records_total", "回调消息日志写入、写入失败和队列满丢弃的条数", ("result",))
+ADMISSION = registry.counter(
+    "wechat_admission_total", "回调消息的准入结果: 处理、过载拒绝、等待超时、用户限速", ("result",))
@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+import signal
+import socket
+from typing import Callable
+from loguru import logger
+from aiohttp import web
+
+
+class PreforkServer:
+    '''多进程模式: 主进程监听端口后fork出workers个子进程，子进程共享同一个监听socket
+    reuse_port为True时每个子进程各自用SO_REUSEPORT绑定端口，由内核分配连接
+    子进程异常退出后自动重启；收到SIGTERM/SIGINT时通知所有子进程优雅退出，等待处理中的回调完成
+    app_factory(worker_id)返回每个子进程的Application
+    '''
+    def __init__(self, app_factory:Callable[[int], web.Application], port:int, host:str="0.0.0.0",
+                 workers:int=None, reuse_port:bool=False, shutdown_timeout:float=30) -> None:
+        self.app_factory = app_factory
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.reuse_port = reuse_port
+        self.shutdown_timeout = shutdown_timeout
+        self._sock = None
+        self._children = {}
+        self._stopping = False
+
+    def run(self):
+        if not hasattr(os, "fork"):
+            logger.warning("当前系统不支持fork，使用单进程模式")
+            web.run_app(self.app_factory(0), host=self.host, port=self.port)
+            return
+        if not self.reuse_port:
+            self._sock = self._bind()
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGALRM, self._on_kill)
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+        logger.info(f"主进程({os.getpid()})已启动{self.workers}个worker，监听{self.host}:{self.port}")
+        self._supervise()
+
+    def _bind(self):
+        sock = socket.socket(socket.AF_INET6 if ":" in self.host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(1024)
+        sock.setblocking(False)
+        return sock
+
+    def _spawn(self, worker_id:int):
+        pid = os.fork()
+        if pid:
+            self._children[pid] = (worker_id, time.monotonic())
+            return
+        # 子进程
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            app = self.app_factory(worker_id)
+            if self._sock is not None:
+                web.run_app(app, sock=self._sock, shutdown_timeout=self.shutdown_timeout, print=None)
+            else:
+                web.run_app(app, host=self.host, port=self.port, reuse_port=True,
+                            shutdown_timeout=self.shutdown_timeout, print=None)
+        except BaseException:
+            logger.exception(f"worker {worker_id} 异常退出")
+            code = 1
+        finally:
+            # os._exit不执行atexit，先移除日志sink，写完后台线程中的日志
+            logger.remove()
+            sys.stdout.flush()
+            os._exit(code)
+
+    def _supervise(self):
+        crash_delay = 1
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            worker_id, started = self._children.pop(pid, (None, 0))
+            if self._stopping or worker_id is None:
+                continue
+            logger.warning(f"worker {worker_id}({pid})退出，状态码: {status}，重新启动")
+            # 启动后很快又退出说明在反复崩溃，逐步拉长重启间隔
+            crash_delay = min(crash_delay * 2, 30) if time.monotonic() - started < 5 else 1
+            time.sleep(crash_delay)
+            if not self._stopping:
+                self._spawn(worker_id)
+        logger.info("所有worker已退出")
+
+    def _on_stop(self, signum, frame):
+        if self._stopping:
+            return
+        self._stopping = True
+        logger.info(f"收到信号{signum}，通知worker优雅退出")
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        # 超时后强制结束还没退出的worker
+        signal.alarm(int(self.shutdown_timeout) + 10)
+
+    def _on_kill(self, signum, frame):
+        for pid in list(self._children):
+            logger.warning(f"worker({pid})退出超时，强制结束")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
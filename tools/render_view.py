@@ -1,10 +1,16 @@
-import xmltodict
-from aiohttp.web import View
 from aiohttp import web
 from aiohttp.web_request import Request
 from aiohttp.web_response import Response
 from loguru import logger
 from .biz_api import BizApi
+from .accounts import AccountRegistry
+from .errors import WeChatError
+from .crypto import DecryptError, WeChatCrypto
+from .admission import AdmissionController
+from .dedup import MessageDeduplicator, dedup_key
+from .reply_queue import ReplyQueue
+from .router import MessageRouter, router as default_router
+from .xml_codec import WeChatMessage, XMLParseError, parse_message, unparse_reply
 
 
 class MsgType:
@@ -18,37 +24,162 @@ class MsgType:
     event = "event"
 
 
-class RenderApiView(View):
-    def __init__(self, request: Request) -> None:
-        super().__init__(request)
-        self.ba:BizApi = self.request.app["ba"]
+def sync_reply(func):
+    '''标记处理函数始终被动回复，即使开启了异步回复'''
+    func.reply_mode = "sync"
+    return func
 
-    async def get(self):
-        echostr = self.request.query.get("echostr")
+
+def deferred_reply(func):
+    '''标记处理函数在有异步回复队列时先回复success，处理结果通过客服消息发送'''
+    func.reply_mode = "deferred"
+    return func
+
+
+class RenderApiView:
+    '''公众号消息回调接口，启动时只创建一次，消息通过MessageRouter分发到处理函数
+    reply_xxx_msg为各消息类型的默认处理函数，传入的router中注册的处理函数优先
+    '''
+    def __init__(self, router:MessageRouter=None) -> None:
+        self.router = MessageRouter()
+        self.register_default_handlers()
+        self.router.include(router or default_router)
+
+    def register_default_handlers(self):
+        for msg_type in (MsgType.text, MsgType.image, MsgType.voice, MsgType.video,
+                         MsgType.shortvideo, MsgType.location, MsgType.link, MsgType.event):
+            self.router.add_msg(msg_type, getattr(self, f"reply_{msg_type}_msg"))
+        self.router.add_event("subscribe", self.reply_subscribe_event)
+        self.router.add_event("unsubscribe", self.reply_unsubscribe_event)
+
+    def setup(self, app:web.Application, path:str):
+        '''path为默认公众号的回调地址，path/{appid}为多公众号各自的回调地址'''
+        for _path in (path, path.rstrip("/") + "/{appid}"):
+            app.router.add_get(_path, self.get)
+            app.router.add_post(_path, self.post)
+        app.on_startup.append(self.on_startup)
+
+    async def on_startup(self, app:web.Application):
+        self.router.compile()
+
+    async def get(self, request:Request):
+        echostr = request.query.get("echostr")
         return Response(body=echostr, status=200)
 
-    async def post(self) :
+    async def post(self, request:Request):
         '''POST请求'''
-        if not self.request.can_read_body:
+        if not request.body_exists:
             raise web.HTTPForbidden(
                 reason='Invalid post_data',
             )
-        text = await self.request.text()
-        request_data = xmltodict.parse(text)['xml']
-        logger.debug(request_data)
-        msg_type = request_data['MsgType']
-        reply_func = getattr(self, f"reply_{msg_type}_msg")
-        if not reply_func:
-            body = "success"
-        else:
-            response_data = await reply_func(request_data)
-            if response_data:
-                body = xmltodict.unparse(response_data)
+        crypto:WeChatCrypto = request.get("crypto")
+        try:
+            if crypto:
+                # 安全模式，verify_middleware已经校验过msg_signature
+                body = crypto.decrypt(request["encrypt"])
             else:
-                body = "success"
+                body = await request.read()
+        except DecryptError as e:
+            logger.warning(f"消息解密失败: {e}")
+            raise web.HTTPBadRequest(
+                reason='Invalid encrypted message',
+            )
+        journal = request.app.get("journal")
+        committed = None
+        if journal:
+            # 在去重之前记录，微信的重试也会被记录下来
+            committed = journal.append(request.match_info.get("appid"), request.get("remote_ip") or request.remote,
+                                       body, encrypted=crypto is not None)
+        admission:AdmissionController = request.app.get("admission")
+        if admission and admission.reject_early():
+            # 过载时记录日志后不解析、不处理，立即回复，不等到微信超时重试
+            # 总是回复success: OVERLOAD_REPLY的文本回复需要解析消息(收发双方)，安全模式还要加密，正是这里要省掉的工作
+            if committed is not None:
+                await committed
+            return Response(body="success", status=200, content_type="text/xml")
+        try:
+            request_data = parse_message(body)
+        except XMLParseError:
+            raise web.HTTPBadRequest(
+                reason='Invalid xml',
+            )
+        # 消息内容只在被采样写出时才格式化
+        logger.bind(category="body", data=request_data).debug("收到消息")
+        # 供metrics_middleware按消息类型统计耗时
+        request["msg_type"] = request_data.get("MsgType") or ""
+        request["event"] = request_data.get("Event") or ""
+        request["ba"] = self.get_biz_api(request, request_data)
+        if request["event"] in ("subscribe", "unsubscribe"):
+            # 关注状态变了，缓存的用户信息失效
+            request["ba"].user_info.invalidate(request_data["FromUserName"])
+        dedup:MessageDeduplicator = request.app.get("dedup")
+        if dedup:
+            body = await dedup.run(dedup_key(request_data), lambda: self.render_reply(request, request_data))
+        else:
+            body = await self.render_reply(request, request_data)
+        if crypto and body != "success":
+            body = crypto.encrypt_reply(body, request.query.get("timestamp"), request.query.get("nonce"))
+        if committed is not None:
+            # JOURNAL_FSYNC: 消息写入磁盘后才回复，与处理消息同时进行
+            await committed
         return Response(body=body, status=200, content_type="text/xml")
 
-    async def reply_text_msg(self, request_data:dict):
+    def get_biz_api(self, request:Request, request_data:WeChatMessage) -> BizApi:
+        '''按回调地址中的appid或消息的ToUserName找到对应的公众号，都没有时使用默认公众号'''
+        accounts:AccountRegistry = request.app.get("accounts")
+        if accounts is None:
+            return request.app["ba"]
+        appid = request.match_info.get("appid")
+        if appid is not None:
+            # verify_middleware已经拦截了未配置的appid
+            return accounts.get(appid)
+        return accounts.find(request_data.get("ToUserName")) or request.app["ba"]
+
+    async def render_reply(self, request:Request, request_data:WeChatMessage):
+        '''经过准入控制后调用处理函数，被拒绝的回复也会被去重缓存，微信的重试直接拿到同样的回复'''
+        ba:BizApi = request["ba"]
+        admission:AdmissionController = request.app.get("admission")
+        if admission is None:
+            return await self.dispatch(ba, request_data, request.app.get("reply_queue"))
+        if not admission.allow_user(request_data.get("FromUserName")) or not await admission.acquire():
+            return await self.overload_reply(ba, request_data, admission.reply_text)
+        try:
+            return await self.dispatch(ba, request_data, request.app.get("reply_queue"))
+        finally:
+            admission.release()
+
+    async def overload_reply(self, ba:BizApi, request_data:WeChatMessage, text:str=None):
+        '''过载或限速时的回复'''
+        if not text or not request_data.get("FromUserName"):
+            return "success"
+        return unparse_reply(await ba.reply("text", request_data, text=text))
+
+    async def dispatch(self, ba:BizApi, request_data:WeChatMessage, reply_queue:ReplyQueue=None):
+        '''调用对应的处理函数，返回回复的xml文本，没有处理函数时回复success'''
+        reply_func = self.router.resolve(request_data)
+        if reply_func is None:
+            return "success"
+        if reply_queue and getattr(reply_func, "reply_mode", "deferred") == "deferred":
+            if reply_queue.submit(lambda: self.deferred_reply(ba, reply_func, request_data)):
+                return "success"
+        try:
+            response_data = await reply_func(ba, request_data)
+        except WeChatError as e:
+            # 上游接口故障或熔断时直接回复success，避免超时后微信重试
+            logger.warning(f"处理消息时调用微信接口失败: {e}")
+            return "success"
+        if response_data:
+            return unparse_reply(response_data)
+        return "success"
+
+    async def deferred_reply(self, ba:BizApi, reply_func, request_data:WeChatMessage):
+        '''在异步回复队列的worker中执行，处理结果通过客服消息接口发送'''
+        response_data = await reply_func(ba, request_data)
+        if response_data:
+            await ba.send_reply(response_data)
+
+    @sync_reply
+    async def reply_text_msg(self, ba:BizApi, request_data:WeChatMessage):
         '''处理文本消息内容'''
         content = request_data["Content"]
         # 非事件消息都有msgid，可用于去重
@@ -59,41 +190,41 @@ class RenderApiView(View):
         idx = request_data.get("Idx")
         logger.info(f"公众号接收到文本消息, 消息内容: {content}")
         # 回复文本消息
-        response_data = await self.ba.reply("text", request_data, text=content)
+        response_data = await ba.reply("text", request_data, text=content)
         return response_data
     
-    async def reply_image_msg(self, request_data:dict):
+    async def reply_image_msg(self, ba:BizApi, request_data:WeChatMessage):
         '''处理图片消息内容'''
         pic_url = request_data["PicUrl"]
         media_id = request_data["MediaId"]
         logger.info(f"公众号接收到图片消息, 图片链接: {pic_url}")
-        response_data = await self.ba.reply("image", request_data, media_id=media_id)
+        response_data = await ba.reply("image", request_data, media_id=media_id)
         return response_data
 
-    async def reply_voice_msg(self, request_data:dict):
+    async def reply_voice_msg(self, ba:BizApi, request_data:WeChatMessage):
         '''处理语音消息内容'''
         media_id = request_data["MediaId"]
         format = request_data["Format"]
         recognition = request_data["Recognition"]
         logger.info(f"公众号接收到语音消息")
-        response_data = await self.ba.reply("voice", request_data, media_id=media_id)
+        response_data = await ba.reply("voice", request_data, media_id=media_id)
         return response_data
 
-    async def reply_video_msg(self, request_data:dict):
+    async def reply_video_msg(self, ba:BizApi, request_data:WeChatMessage):
         '''处理视频消息内容'''
         media_id = request_data["MediaId"]
         # 视频消息缩略图的媒体id，可以调用多媒体文件下载接口拉取数据
         ThumbMediaId = request_data["ThumbMediaId"]
         logger.info(f"公众号接收到视频消息")
         # 测试这样发送视频失败
-        response_data = await self.ba.reply("video", request_data, title="原视频", introduction="简介", media_id=media_id)
+        response_data = await ba.reply("video", request_data, title="原视频", introduction="简介", media_id=media_id)
         return response_data
     
-    async def reply_shortvideo_msg(self, request_data:dict):
+    async def reply_shortvideo_msg(self, ba:BizApi, request_data:WeChatMessage):
         '''处理短视频消息内容'''
         pass
 
-    async def reply_location_msg(self, request_data:dict):
+    async def reply_location_msg(self, ba:BizApi, request_data:WeChatMessage):
         '''处理位置消息内容'''
         x = request_data["Location_X"]
         y = request_data["Location_Y"]
@@ -101,20 +232,28 @@ class RenderApiView(View):
         label = request_data["Label"]
         logger.info(f"公众号接收到地理位置消息，地点: {label}")
 
-    async def reply_link_msg(self, request_data:dict):
+    @sync_reply
+    async def reply_link_msg(self, ba:BizApi, request_data:WeChatMessage):
         '''处理链接消息内容'''
         title = request_data["Title"]
         description = request_data["Description"]
         url = request_data["Url"]
         logger.info(f"公众号接收到链接消息，链接地址: {url}")
-        response_data = await self.ba.reply("articles", request_data, title=title, description=description, url=url)
+        response_data = await ba.reply("articles", request_data, title=title, description=description, url=url)
         return response_data
 
-    async def reply_event_msg(self, request_data:dict):
-        '''处理事件消息内容: 订阅号的事件主要是关注和取关'''
+    async def reply_event_msg(self, ba:BizApi, request_data:WeChatMessage):
+        '''处理没有单独注册处理函数的事件消息'''
         event = request_data["Event"]
         user = request_data["FromUserName"]
-        if event == "subscribe": # 关注
-            logger.info(f"用户({user})关注了公众号")
-        elif event == "unsubscribe": # 取消关注
-            logger.info(f"用户({user})取关了公众号")
+        logger.info(f"用户({user})触发了事件: {event}")
+
+    async def reply_subscribe_event(self, ba:BizApi, request_data:WeChatMessage):
+        '''关注事件'''
+        user = request_data["FromUserName"]
+        logger.info(f"用户({user})关注了公众号")
+
+    async def reply_unsubscribe_event(self, ba:BizApi, request_data:WeChatMessage):
+        '''取消关注事件'''
+        user = request_data["FromUserName"]
+        logger.info(f"用户({user})取关了公众号")
@@ -0,0 +1,48 @@
+import asyncio
+from typing import Awaitable, Callable
+from loguru import logger
+
+
+class ReplyQueue:
+    '''异步回复队列: 先给微信服务器回复success，耗时的处理(如上传素材)由worker完成后通过客服消息接口发送
+    队列有长度上限，满了之后submit返回False，由调用方改为同步处理
+    '''
+    def __init__(self, workers:int=4, maxsize:int=1000) -> None:
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize)
+        self._tasks = []
+        self._closing = False
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, job:Callable[[], Awaitable]) -> bool:
+        if self._closing:
+            return False
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            logger.warning(f"异步回复队列已满({self.queue.maxsize})")
+            return False
+        return True
+
+    async def close(self, timeout:float=30):
+        '''停止接收新任务，等待队列中的任务处理完成'''
+        self._closing = True
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"异步回复队列关闭时还有{self.queue.qsize()}个任务未完成")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await job()
+            except Exception:
+                logger.exception("异步回复任务出现异常")
+            finally:
+                self.queue.task_done()
@@ -1,32 +1,265 @@
+import json
+import time
+import random
 import asyncio
+from contextlib import asynccontextmanager
 from loguru import logger
 from typing import Literal, Any
-from aiohttp import ClientSession, ClientConnectorError
-
-
-async def aiohttp_request(
-    session:ClientSession, 
-    method:Literal['GET', 'POST'],
-    url:str, 
-    params:dict=None,
-    post_data:Any=None, 
-    retry:int=0
-):
-    if retry > 3:
-        return {}
-    try:
-        async with session.request(method, url, params=params, data=post_data) as resp:
-            text = await resp.text()
-            if resp.status == 200:
-                return text
-            else:
-                logger.debug(f"url: {url}, status: {resp.status}")
-                asyncio.sleep(retry+1)
-                return await aiohttp_request(session, method, url, params, post_data, retry+1)
-    except (ClientConnectorError, TimeoutError):
-        logger.warning(f'url: {url}, data: {post_data}')
-        await asyncio.sleep(2)
-        return await aiohttp_request(session, method, url, params, post_data, retry+1)
-    except:
-        logger.exception("aiohttp_request出现异常")
-        return None
\ No newline at end of file
+from urllib.parse import urlsplit
+from aiohttp import ClientSession, ClientError, ClientConnectorError, ClientResponse, ClientTimeout, TCPConnector
+from .errors import UpstreamError, CircuitOpenError, SystemBusyError, raise_for_errcode
+from .metrics import UPSTREAM_CALLS, UPSTREAM_LATENCY
+
+
+# 这些状态码可以重试，其他非200状态码直接失败
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# 流式下载不限制总时长，只限制建立连接和两次读取之间的间隔
+STREAM_TIMEOUT = ClientTimeout(total=None, sock_connect=10, sock_read=30)
+
+
+def create_session(timeout:float=15, limit:int=100, limit_per_host:int=30,
+                   ttl_dns_cache:int=300, keepalive_timeout:float=30) -> ClientSession:
+    '''创建连接池参数可配置的ClientSession'''
+    connector = TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        ttl_dns_cache=ttl_dns_cache,
+        keepalive_timeout=keepalive_timeout,
+    )
+    return ClientSession(connector=connector, timeout=ClientTimeout(total=timeout))
+
+
+class RetryBudget:
+    '''重试预算: 每个请求存入ratio个令牌，每次重试消耗1个，避免上游故障时重试把请求量放大数倍'''
+    def __init__(self, ratio:float=0.2, min_tokens:float=10) -> None:
+        self.ratio = ratio
+        self.max_tokens = min_tokens
+        self.tokens = min_tokens
+
+    def deposit(self):
+        self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self):
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class CircuitBreaker:
+    '''熔断器: 连续失败failure_threshold次后打开，reset_timeout秒后放行一个试探请求，成功则关闭'''
+    def __init__(self, failure_threshold:int=5, reset_timeout:float=30) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if self._probing or time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        self._probing = True
+        return True
+
+    def on_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def on_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        '''试探请求被取消，既不算成功也不算失败，下一个请求重新试探'''
+        self._probing = False
+
+
+class HttpClient:
+    '''调用微信接口的http客户端
+    失败时指数退避加随机抖动重试，每个接口有独立的重试预算，每个主机有独立的熔断器
+    idempotent默认GET为True、POST为False；非幂等的请求只在连接没有建立(请求还没有发出)时重试，
+    超时和5xx时微信可能已经处理了请求(如发送消息)，重试会重复执行
+    '''
+    def __init__(self, session:ClientSession, max_retries:int=3, backoff_base:float=0.5, backoff_max:float=8,
+                 retry_ratio:float=0.2, failure_threshold:int=5, reset_timeout:float=30) -> None:
+        self.session = session
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_ratio = retry_ratio
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._budgets = {}
+        self._breakers = {}
+
+    def breaker(self, host:str) -> CircuitBreaker:
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            breaker = self._breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return breaker
+
+    def budget(self, endpoint:str) -> RetryBudget:
+        budget = self._budgets.get(endpoint)
+        if budget is None:
+            budget = self._budgets[endpoint] = RetryBudget(self.retry_ratio)
+        return budget
+
+    async def request(
+        self,
+        method:Literal['GET', 'POST'],
+        url:str,
+        params:dict=None,
+        post_data:Any=None,
+        idempotent:bool=None,
+    ) -> str:
+        '''返回响应文本，失败时抛出UpstreamError
+        post_data为FormData时只能发送一次，可以传入返回请求体的函数，每次重试重新构建
+        '''
+        budget = self.budget(_endpoint(url))
+        budget.deposit()
+        return await self._request(method, url, params, post_data, idempotent, budget)
+
+    async def _request(self, method:str, url:str, params:dict, post_data:Any, idempotent:bool, budget:RetryBudget) -> str:
+        if idempotent is None:
+            idempotent = method == "GET"
+        breaker = self.breaker(urlsplit(url).netloc)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise CircuitOpenError(url, "熔断中，暂停请求")
+            # allow和这里之间没有await，熔断器打开时通过的就是试探请求
+            probe = breaker.opened_at is not None
+            data = post_data() if callable(post_data) else post_data
+            status = None
+            try:
+                async with self.session.request(method, url, params=params, data=data) as resp:
+                    status = resp.status
+                    text = await resp.text()
+                if status == 200:
+                    breaker.on_success()
+                    return text
+                reason, retryable = self._on_status(breaker, status)
+                retryable = retryable and idempotent
+            except (ClientError, asyncio.TimeoutError) as e:
+                breaker.on_failure()
+                reason = f"{type(e).__name__}: {e}"
+                retryable = idempotent or isinstance(e, ClientConnectorError)
+            finally:
+                if probe:
+                    breaker.release_probe()
+            if not retryable or attempt >= self.max_retries or not budget.withdraw():
+                logger.warning(f"请求失败({reason})，已重试{attempt}次, url: {url}")
+                raise UpstreamError(url, reason, status)
+            attempt += 1
+            await asyncio.sleep(self.backoff(attempt))
+            logger.debug(f"第{attempt}次重试({reason}), url: {url}")
+
+    @asynccontextmanager
+    async def stream(self, method:Literal['GET', 'POST'], url:str, params:dict=None,
+                     timeout:ClientTimeout=STREAM_TIMEOUT) -> ClientResponse:
+        '''返回还没有读取响应体的200响应，由调用者分块读取，适合下载大文件
+        只在收到响应头之前重试，读取响应体时出错直接抛出ClientError
+        '''
+        breaker = self.breaker(urlsplit(url).netloc)
+        budget = self.budget(_endpoint(url))
+        budget.deposit()
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise CircuitOpenError(url, "熔断中，暂停请求")
+            probe = breaker.opened_at is not None
+            status = None
+            try:
+                resp = await self.session.request(method, url, params=params, timeout=timeout)
+                status = resp.status
+                if status == 200:
+                    breaker.on_success()
+                    break
+                resp.release()
+                reason, retryable = self._on_status(breaker, status)
+            except (ClientError, asyncio.TimeoutError) as e:
+                breaker.on_failure()
+                reason = f"{type(e).__name__}: {e}"
+                retryable = True
+            finally:
+                if probe:
+                    breaker.release_probe()
+            if not retryable or attempt >= self.max_retries or not budget.withdraw():
+                logger.warning(f"请求失败({reason})，已重试{attempt}次, url: {url}")
+                raise UpstreamError(url, reason, status)
+            attempt += 1
+            await asyncio.sleep(self.backoff(attempt))
+            logger.debug(f"第{attempt}次重试({reason}), url: {url}")
+        try:
+            yield resp
+        finally:
+            # 没有读完的响应会关闭连接，不放回连接池
+            resp.release()
+
+    def _on_status(self, breaker:CircuitBreaker, status:int):
+        '''非200响应，返回(失败原因, 是否可以重试)'''
+        if status < 500:
+            # 4xx说明主机正常，不计入熔断
+            breaker.on_success()
+        else:
+            breaker.on_failure()
+        return f"status: {status}", status in RETRY_STATUS
+
+    async def request_json(
+        self,
+        method:Literal['GET', 'POST'],
+        url:str,
+        params:dict=None,
+        post_data:Any=None,
+        idempotent:bool=None,
+    ) -> dict:
+        '''返回解析后的json，errcode非0时抛出WeChatApiError及其子类，系统繁忙(-1)时重试'''
+        endpoint = urlsplit(url).path
+        start = time.perf_counter()
+        try:
+            data = await self._request_json(method, url, params, post_data, idempotent)
+        except Exception as e:
+            UPSTREAM_CALLS.labels(endpoint, type(e).__name__).inc()
+            raise
+        finally:
+            UPSTREAM_LATENCY.labels(endpoint).observe(time.perf_counter() - start)
+        UPSTREAM_CALLS.labels(endpoint, "ok").inc()
+        return data
+
+    async def _request_json(self, method:str, url:str, params:dict, post_data:Any, idempotent:bool) -> dict:
+        budget = self.budget(_endpoint(url))
+        budget.deposit()
+        attempt = 0
+        while True:
+            text = await self._request(method, url, params, post_data, idempotent, budget)
+            logger.bind(category="response", data=text).debug(f"接口响应: {url}")
+            try:
+                data = json.loads(text)
+            except ValueError:
+                raise UpstreamError(url, f"响应不是json: {text[:200]}")
+            try:
+                raise_for_errcode(data)
+            except SystemBusyError:
+                # 微信明确返回了系统繁忙，请求没有被执行，非幂等的请求也可以重试，同样消耗重试预算
+                if attempt >= self.max_retries or not budget.withdraw():
+                    raise
+                attempt += 1
+                await asyncio.sleep(self.backoff(attempt))
+                continue
+            return data
+
+    def backoff(self, attempt:int):
+        '''指数退避，full jitter'''
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+def _endpoint(url:str):
+    '''重试预算按主机和路径区分'''
+    parts = urlsplit(url)
+    return parts.netloc + parts.path
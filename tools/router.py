@@ -0,0 +1,189 @@
+import functools
+from typing import Awaitable, Callable, Optional
+from loguru import logger
+
+
+# 处理函数: async def handler(ba:BizApi, request_data) -> 回复数据或None
+Handler = Callable[..., Awaitable[Optional[dict]]]
+# 中间件: async def middleware(ba:BizApi, request_data, handler) -> 回复数据或None
+Middleware = Callable[..., Awaitable[Optional[dict]]]
+
+
+class PrefixTrie:
+    '''前缀树，查找与给定字符串匹配的最长前缀，耗时只与匹配的前缀长度有关，与注册的数量无关'''
+    _VALUE = object()
+
+    def __init__(self) -> None:
+        self.root = {}
+
+    def __len__(self):
+        return sum(1 for _ in self.items())
+
+    def insert(self, prefix:str, value):
+        node = self.root
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        node[self._VALUE] = value
+
+    def longest_prefix(self, text:str):
+        node = self.root
+        value = node.get(self._VALUE)
+        for ch in text:
+            node = node.get(ch)
+            if node is None:
+                break
+            value = node.get(self._VALUE, value)
+        return value
+
+    def items(self, node:dict=None, prefix:str=""):
+        node = self.root if node is None else node
+        for key, child in node.items():
+            if key is self._VALUE:
+                yield prefix, child
+            else:
+                yield from self.items(child, prefix + key)
+
+    def map_values(self, func:Callable):
+        '''对所有值调用func并替换，用于给处理函数套上中间件'''
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for key, child in node.items():
+                if key is self._VALUE:
+                    node[key] = func(child)
+                else:
+                    stack.append(child)
+
+
+class MessageRouter:
+    '''消息处理函数的注册表，启动时调用compile()套上中间件，之后每条消息只需几次dict查找
+
+    @router.msg("image")                         按MsgType
+    @router.event("subscribe")                   按Event
+    @router.event("CLICK", key="V1001_TODAY")    按Event+EventKey
+    @router.event("subscribe", key="qrscene_", prefix=True)  按EventKey前缀
+    @router.keyword("帮助")                      文本消息内容完全匹配
+    @router.keyword("天气", prefix=True)         文本消息内容前缀匹配，多个前缀匹配时取最长的
+    '''
+    def __init__(self) -> None:
+        self._msg_handlers = {}
+        self._event_handlers = {}
+        self._event_key_tries = {}
+        self._keywords = {}
+        self._keyword_trie = PrefixTrie()
+        self._middlewares = []
+        self._compiled = False
+
+    def msg(self, msg_type:str):
+        return lambda func: self.add_msg(msg_type, func)
+
+    def event(self, event:str, key:str=None, prefix:bool=False):
+        return lambda func: self.add_event(event, func, key=key, prefix=prefix)
+
+    def keyword(self, word:str, prefix:bool=False):
+        return lambda func: self.add_keyword(word, func, prefix=prefix)
+
+    def middleware(self, func:Middleware):
+        self.add_middleware(func)
+        return func
+
+    def add_msg(self, msg_type:str, handler:Handler):
+        self._check_not_compiled()
+        self._msg_handlers[msg_type] = handler
+        return handler
+
+    def add_event(self, event:str, handler:Handler, key:str=None, prefix:bool=False):
+        self._check_not_compiled()
+        if prefix:
+            self._event_key_tries.setdefault(event, PrefixTrie()).insert(key or "", handler)
+        else:
+            self._event_handlers[(event, key)] = handler
+        return handler
+
+    def add_keyword(self, word:str, handler:Handler, prefix:bool=False):
+        self._check_not_compiled()
+        if prefix:
+            self._keyword_trie.insert(word, handler)
+        else:
+            self._keywords[word] = handler
+        return handler
+
+    def add_middleware(self, middleware:Middleware):
+        '''中间件按注册顺序从外到内执行'''
+        self._check_not_compiled()
+        self._middlewares.append(middleware)
+
+    def include(self, other:"MessageRouter"):
+        '''合并另一个路由表的处理函数和中间件，已有的同名路由会被覆盖'''
+        self._check_not_compiled()
+        self._msg_handlers.update(other._msg_handlers)
+        self._event_handlers.update(other._event_handlers)
+        for event, trie in other._event_key_tries.items():
+            for key, handler in trie.items():
+                self.add_event(event, handler, key=key, prefix=True)
+        self._keywords.update(other._keywords)
+        for word, handler in other._keyword_trie.items():
+            self._keyword_trie.insert(word, handler)
+        self._middlewares.extend(other._middlewares)
+
+    def compile(self):
+        '''给所有处理函数套上中间件，只执行一次'''
+        if self._compiled:
+            return
+        self._compiled = True
+        logger.info(f"消息路由: {len(self._msg_handlers)}个消息类型, {len(self._event_handlers)}个事件, "
+                    f"{len(self._keywords) + len(self._keyword_trie)}个关键词, {len(self._middlewares)}个中间件")
+        if not self._middlewares:
+            return
+        wrap = self._wrap
+        self._msg_handlers = {key: wrap(value) for key, value in self._msg_handlers.items()}
+        self._event_handlers = {key: wrap(value) for key, value in self._event_handlers.items()}
+        self._keywords = {key: wrap(value) for key, value in self._keywords.items()}
+        self._keyword_trie.map_values(wrap)
+        for trie in self._event_key_tries.values():
+            trie.map_values(wrap)
+
+    def resolve(self, request_data) -> Optional[Handler]:
+        '''查找消息对应的处理函数，没有时返回None'''
+        msg_type = request_data.get("MsgType")
+        if msg_type == "text":
+            content = request_data.get("Content") or ""
+            handler = self._keywords.get(content)
+            if handler is None and self._keyword_trie.root:
+                handler = self._keyword_trie.longest_prefix(content)
+            if handler is not None:
+                return handler
+        elif msg_type == "event":
+            event = request_data.get("Event")
+            key = request_data.get("EventKey")
+            handler = self._event_handlers.get((event, key))
+            if handler is None and key:
+                trie = self._event_key_tries.get(event)
+                if trie is not None:
+                    handler = trie.longest_prefix(key)
+            if handler is None:
+                handler = self._event_handlers.get((event, None))
+            if handler is not None:
+                return handler
+        return self._msg_handlers.get(msg_type)
+
+    def _wrap(self, handler:Handler):
+        for middleware in reversed(self._middlewares):
+            handler = _chain(middleware, handler)
+        return handler
+
+    def _check_not_compiled(self):
+        if self._compiled:
+            raise RuntimeError("MessageRouter已经compile，不能再注册处理函数")
+
+
+def _chain(middleware:Middleware, handler:Handler):
+    # functools.wraps会复制reply_mode等标记
+    @functools.wraps(handler)
+    async def wrapped(ba, request_data):
+        return await middleware(ba, request_data, handler)
+    return wrapped
+
+
+# 默认的路由表，用装饰器注册处理函数，RenderApiView未指定router时使用
+router = MessageRouter()
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import asyncio
+from loguru import logger
+from .request import HttpClient
+from .errors import WeChatError
+from .metrics import TOKEN_CACHE
+from .filelock import file_lock
+
+
+class AccessTokenManager:
+    '''access_token管理
+    1. 同一进程内同时只有一个刷新请求，其他调用者等待同一个结果
+    2. 过期前refresh_ahead秒在后台主动刷新
+    3. 同一台机器上的多个进程通过加锁的缓存文件共享同一个token，避免互相刷新导致对方的token失效
+    '''
+    def __init__(self, client:HttpClient, appid:str, secret:str, cache_file:str, refresh_ahead:int=300,
+                 api_base:str="https://api.weixin.qq.com") -> None:
+        self.client = client
+        self.appid = appid
+        self.secret = secret
+        self.url = f"{api_base}/cgi-bin/token"
+        self.cache_file = cache_file
+        self.lock_file = cache_file + ".lock"
+        self.refresh_ahead = refresh_ahead
+        self.token_data = {}
+        # 最近一次被接口判定为失效的token，共享文件中的同一个token不再采用
+        self._stale_token = None
+        self._refreshing:asyncio.Future = None
+        self._refresh_handle:asyncio.TimerHandle = None
+        self._closed = False
+
+    async def get(self):
+        '''获取access_token数据，未过期时直接返回内存中的缓存'''
+        data = self.token_data
+        if data and data["expires_at"] > time.time():
+            TOKEN_CACHE.labels("hit").inc()
+            return data
+        TOKEN_CACHE.labels("miss").inc()
+        return await self.refresh()
+
+    async def refresh(self):
+        '''刷新access_token，并发调用共享同一个刷新任务'''
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(self._do_refresh())
+        # shield避免某个调用者被取消时连带取消共享的刷新任务
+        return await asyncio.shield(self._refreshing)
+
+    async def invalidate(self, access_token:str):
+        '''接口返回token失效时调用，只有当前缓存的正是该token才会重新获取'''
+        if self.token_data.get("access_token") == access_token:
+            self._stale_token = access_token
+            self.token_data = {}
+        return await self.get()
+
+    async def close(self):
+        self._closed = True
+        if self._refresh_handle:
+            self._refresh_handle.cancel()
+            self._refresh_handle = None
+        if self._refreshing and not self._refreshing.done():
+            await asyncio.shield(self._refreshing)
+
+    async def _do_refresh(self):
+        loop = asyncio.get_running_loop()
+        try:
+            # 拿到锁后先看其他进程是否已经刷新过
+            async with file_lock(self.lock_file):
+                data = await loop.run_in_executor(None, self._read_cache_file)
+                if self._is_fresh(data) and data["access_token"] != self._stale_token:
+                    logger.debug("从共享缓存文件中获取到access_token")
+                    TOKEN_CACHE.labels("refresh_file").inc()
+                else:
+                    data = await self._fetch()
+                    if data:
+                        await loop.run_in_executor(None, self._write_cache_file, data)
+                    TOKEN_CACHE.labels("refresh_network" if data else "refresh_failed").inc()
+        except Exception:
+            logger.exception("刷新access_token出现异常")
+            data = None
+
+        if data:
+            self.token_data = data
+            self._schedule_refresh()
+            return data
+        if self.token_data and self.token_data["expires_at"] > time.time():
+            # 主动刷新失败时旧token仍然可用，稍后再试
+            self._schedule_refresh(30)
+            return self.token_data
+
+    async def _fetch(self):
+        params = {
+            "grant_type": "client_credential",
+            "appid": self.appid,
+            "secret": self.secret
+        }
+        try:
+            data = await self.client.request_json("GET", self.url, params=params)
+        except WeChatError as e:
+            logger.warning(f"获取access_token失败: {e}！")
+            return
+        if not data.get("access_token"):
+            logger.warning(f"获取access_token失败,响应内容: {data}！")
+            return
+        data["expires_at"] = int(time.time()) + int(data.get("expires_in", 7200))
+        logger.info("从网络获取到新的access_token")
+        return data
+
+    def _is_fresh(self, data:dict):
+        return bool(data) and data.get("expires_at", 0) - self.refresh_ahead > time.time()
+
+    def _schedule_refresh(self, delay:float=None):
+        if self._closed:
+            return
+        if delay is None:
+            delay = max(self.token_data["expires_at"] - self.refresh_ahead - time.time(), 30)
+        if self._refresh_handle:
+            self._refresh_handle.cancel()
+        loop = asyncio.get_running_loop()
+        self._refresh_handle = loop.call_later(delay, self._background_refresh)
+
+    def _background_refresh(self):
+        self._refresh_handle = None
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(self._do_refresh())
+
+    def _read_cache_file(self):
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_cache_file(self, data:dict):
+        # 先写临时文件再重命名，其他进程不会读到写了一半的内容
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as fw:
+            json.dump(data, fw)
+        os.replace(tmp_file, self.cache_file)
@@ -0,0 +1,76 @@
+import os
+import asyncio
+import mimetypes
+import aiofiles
+import aiohttp
+from loguru import logger
+from aiohttp.payload import Payload
+
+
+# 各类素材的大小上限和支持的后缀，"img"为图文消息内的图片(uploadimg接口)
+UPLOAD_LIMITS = {
+    "img": (1024 * 1024, (".jpg", ".png")),
+    "image": (10 * 1024 * 1024, (".bmp", ".png", ".jpeg", ".jpg", ".gif")),
+    "voice": (2 * 1024 * 1024, (".mp3", ".wma", ".wav", ".amr")),
+    "video": (10 * 1024 * 1024, (".mp4",)),
+    "thumb": (64 * 1024, (".jpg",)),
+}
+
+DEFAULT_CONTENT_TYPES = {
+    "image": "image/jpeg",
+    "voice": "audio/mp3",
+    "video": "video/mp4",
+    "thumb": "image/jpeg",
+}
+
+
+class AsyncFilePayload(Payload):
+    '''分块异步读取文件的请求体，不会把整个文件读入内存，大小已知所以请求会带上Content-Length'''
+    def __init__(self, path:str, size:int, chunk_size:int=64 * 1024, **kwargs) -> None:
+        super().__init__(path, **kwargs)
+        self._size = size
+        self.chunk_size = chunk_size
+
+    async def write(self, writer) -> None:
+        async with aiofiles.open(self._value, 'rb') as f:
+            while True:
+                chunk = await f.read(self.chunk_size)
+                if not chunk:
+                    break
+                await writer.write(chunk)
+
+    def decode(self, encoding:str="utf-8", errors:str="strict") -> str:
+        raise TypeError("Unable to decode.")
+
+
+async def get_file_size(path:str):
+    '''在线程池中获取文件大小，文件不存在时返回None'''
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, os.path.getsize, path)
+    except OSError:
+        return None
+
+
+def check_upload_file(rule:str, path:str, size:int):
+    '''上传前校验后缀和大小，不符合要求的文件不发送'''
+    max_size, exts = UPLOAD_LIMITS[rule]
+    if not path.lower().endswith(exts):
+        logger.info(f"给定文件({path})格式不支持，{rule}仅支持{'/'.join(exts)}")
+        return False
+    if size > max_size:
+        logger.info(f"给定文件({path})大小为{size}字节，超过{rule}的上限{max_size}字节")
+        return False
+    return True
+
+
+def build_upload_form(media_type:str, path:str, size:int, fields:dict=None):
+    '''构建上传表单，FormData只能发送一次，重试时需要重新构建'''
+    filename = os.path.basename(path)
+    content_type = mimetypes.guess_type(path)[0] or DEFAULT_CONTENT_TYPES.get(media_type, "application/octet-stream")
+    post_data = aiohttp.FormData()
+    post_data.add_field('file',
+                AsyncFilePayload(path, size, content_type=content_type, filename=filename),
+                filename=filename)
+    for name, value in (fields or {}).items():
+        post_data.add_field(name, value)
+    return post_data
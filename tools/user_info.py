@@ -0,0 +1,107 @@
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+from .metrics import USER_INFO_CACHE
+
+
+class UserInfoLoader:
+    '''用户信息查询，短时间内的多次查询合并为一次/cgi-bin/user/info/batchget(每次最多100个openid)
+    结果放在有大小上限的LRU缓存中，ttl秒后过期；用户关注、取关时调用invalidate
+    同一个openid的并发查询共用一个请求
+    '''
+    def __init__(self, ba, batch_window:float=0.005, max_batch:int=100, ttl:float=3600, maxsize:int=10000,
+                 lang:str="zh_CN") -> None:
+        self.ba = ba
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.lang = lang
+        self._cache:OrderedDict = OrderedDict()
+        self._inflight:Dict[str, asyncio.Future] = {}
+        self._queue:List[Tuple[str, asyncio.Future]] = []
+        self._timer:asyncio.TimerHandle = None
+        self._tasks = set()
+
+    async def load(self, openid:str) -> dict:
+        '''获取一个用户的信息，未关注的用户只有subscribe和openid'''
+        info = self._get_cached(openid)
+        if info is not None:
+            USER_INFO_CACHE.labels("hit").inc()
+            return info
+        USER_INFO_CACHE.labels("miss").inc()
+        future = self._inflight.get(openid)
+        if future is None:
+            future = self._enqueue(openid)
+        # shield避免某个调用者被取消时影响同一批次的其他调用者
+        return await asyncio.shield(future)
+
+    async def load_many(self, openids:List[str]) -> List[dict]:
+        return list(await asyncio.gather(*(self.load(openid) for openid in openids)))
+
+    def invalidate(self, openid:str):
+        '''用户信息有变化(关注、取关)时移除缓存，正在进行的查询结果也不再缓存'''
+        self._cache.pop(openid, None)
+        self._inflight.pop(openid, None)
+
+    def _get_cached(self, openid:str):
+        item = self._cache.get(openid)
+        if item is None:
+            return None
+        expires_at, info = item
+        if expires_at < time.monotonic():
+            del self._cache[openid]
+            return None
+        self._cache.move_to_end(openid)
+        return info
+
+    def _enqueue(self, openid:str):
+        loop = asyncio.get_running_loop()
+        future = self._inflight[openid] = loop.create_future()
+        self._queue.append((openid, future))
+        if len(self._queue) >= self.max_batch:
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.batch_window, self._dispatch)
+        return future
+
+    def _dispatch(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        while self._queue:
+            batch, self._queue = self._queue[:self.max_batch], self._queue[self.max_batch:]
+            task = asyncio.ensure_future(self._fetch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _fetch(self, batch:List[Tuple[str, asyncio.Future]]):
+        # invalidate后重新查询的openid可能在同一批次中出现两次
+        openids = list(dict.fromkeys(openid for openid, _ in batch))
+        try:
+            users = await self.ba.batch_get_user_info(openids, self.lang)
+        except Exception as e:
+            for openid, future in batch:
+                if self._inflight.get(openid) is future:
+                    del self._inflight[openid]
+                if not future.done():
+                    future.set_exception(e)
+                    # 没有调用者等待时不输出"exception was never retrieved"
+                    future.exception()
+            return
+        users = {info.get("openid"): info for info in users}
+        expires_at = time.monotonic() + self.ttl
+        for openid, future in batch:
+            # 接口没有返回的是无效的openid，结果为None
+            info = users.get(openid)
+            # 查询期间被invalidate的结果只返回给调用者，不缓存
+            if self._inflight.get(openid) is future:
+                del self._inflight[openid]
+                if info is not None:
+                    self._cache[openid] = (expires_at, info)
+                    self._cache.move_to_end(openid)
+            if not future.done():
+                future.set_result(info)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
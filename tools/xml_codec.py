@@ -0,0 +1,194 @@
+'''微信消息的xml编解码
+解析: 只取xml根节点下的扁平字段，放到带__slots__的WeChatMessage中，用法和xmltodict解析出的dict一致
+生成: 被动回复按消息类型使用预编译的模板，输出与xmltodict.unparse逐字节一致，结构不符合模板时回退到xmltodict
+'''
+import xmltodict
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+
+XMLParseError = ElementTree.ParseError
+
+
+class WeChatMessage:
+    '''微信推送的消息，支持request_data["Content"]、request_data.get("MsgId")等dict的用法'''
+    __slots__ = (
+        "ToUserName", "FromUserName", "CreateTime", "MsgType", "MsgId", "MsgDataId", "Idx",
+        "Content", "PicUrl", "MediaId", "Format", "Recognition", "ThumbMediaId",
+        "Location_X", "Location_Y", "Scale", "Label", "Title", "Description", "Url",
+        "Event", "EventKey", "Ticket", "Latitude", "Longitude", "Precision", "Encrypt",
+        "_extra",
+    )
+    _fields = frozenset(__slots__[:-1])
+
+    def __init__(self) -> None:
+        self._extra = None
+
+    def __getitem__(self, key:str):
+        if key in self._fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key:str, value):
+        if key in self._fields:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key:str):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key:str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        data = {}
+        for key in self.__slots__[:-1]:
+            try:
+                data[key] = getattr(self, key)
+            except AttributeError:
+                pass
+        if self._extra:
+            data.update(self._extra)
+        return data
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+
+def _text(element):
+    # 与xmltodict一致: 去掉首尾空白，空内容为None
+    text = element.text
+    if text:
+        text = text.strip()
+    return text or None
+
+
+def _element_to_dict(element):
+    data = {}
+    for child in element:
+        value = _element_to_dict(child) if len(child) else _text(child)
+        if child.tag in data:
+            if not isinstance(data[child.tag], list):
+                data[child.tag] = [data[child.tag]]
+            data[child.tag].append(value)
+        else:
+            data[child.tag] = value
+    return data
+
+
+def parse_message(body) -> WeChatMessage:
+    '''解析微信推送的xml，body为bytes或str，CDATA由解析器处理'''
+    root = ElementTree.fromstring(body)
+    msg = WeChatMessage()
+    for child in root:
+        msg[child.tag] = _element_to_dict(child) if len(child) else _text(child)
+    return msg
+
+
+def _escape(value):
+    if value is None:
+        return ""
+    if type(value) is str:
+        return escape(value) if ("&" in value or "<" in value or ">" in value) else value
+    if type(value) is int:
+        return str(value)
+    # 其他类型与xmltodict的转换方式不一定一致，交给xmltodict处理
+    raise TypeError(type(value))
+
+
+_HEAD = ('<?xml version="1.0" encoding="utf-8"?>\n<xml><ToUserName>%s</ToUserName>'
+         '<FromUserName>%s</FromUserName><CreateTime>%s</CreateTime><MsgType>%s</MsgType>')
+_BASE_KEYS = ("ToUserName", "FromUserName", "CreateTime", "MsgType")
+
+_TEXT = _HEAD + '<Content>%s</Content></xml>'
+_IMAGE = _HEAD + '<Image><MediaId>%s</MediaId></Image></xml>'
+_VOICE = _HEAD + '<Voice><MediaId>%s</MediaId></Voice></xml>'
+_VIDEO = _HEAD + '<Video><Title>%s</Title><Description>%s</Description><MediaId>%s</MediaId></Video></xml>'
+_NEWS = _HEAD + '<ArticleCount>%s</ArticleCount><Articles>%s</Articles></xml>'
+_NEWS_ITEM = '<item><Title>%s</Title><Description>%s</Description><PicUrl>%s</PicUrl><Url>%s</Url></item>'
+
+_TEXT_KEYS = _BASE_KEYS + ("Content",)
+_IMAGE_KEYS = _BASE_KEYS + ("Image",)
+_VOICE_KEYS = _BASE_KEYS + ("Voice",)
+_VIDEO_KEYS = _BASE_KEYS + ("Video",)
+_NEWS_KEYS = _BASE_KEYS + ("ArticleCount", "Articles")
+_MEDIA_KEYS = ("MediaId",)
+_VIDEO_ITEM_KEYS = ("Title", "Description", "MediaId")
+_NEWS_ITEM_KEYS = ("Title", "Description", "PicUrl", "Url")
+
+
+def _head(data:dict):
+    return (_escape(data["ToUserName"]), _escape(data["FromUserName"]),
+            _escape(data["CreateTime"]), _escape(data["MsgType"]))
+
+
+def _render_text(data:dict):
+    return _TEXT % (*_head(data), _escape(data["Content"]))
+
+
+def _render_media(template:str, key:str, data:dict):
+    media = data[key]
+    if tuple(media) != _MEDIA_KEYS:
+        raise TypeError(key)
+    return template % (*_head(data), _escape(media["MediaId"]))
+
+
+def _render_video(data:dict):
+    video = data["Video"]
+    if tuple(video) != _VIDEO_ITEM_KEYS:
+        raise TypeError("Video")
+    return _VIDEO % (*_head(data), _escape(video["Title"]), _escape(video["Description"]), _escape(video["MediaId"]))
+
+
+def _render_news(data:dict):
+    articles = data["Articles"]
+    if tuple(articles) != ("item",):
+        raise TypeError("Articles")
+    items = articles["item"]
+    if isinstance(items, dict):
+        items = (items,)
+    parts = []
+    for item in items:
+        if tuple(item) != _NEWS_ITEM_KEYS:
+            raise TypeError("item")
+        parts.append(_NEWS_ITEM % (_escape(item["Title"]), _escape(item["Description"]),
+                                   _escape(item["PicUrl"]), _escape(item["Url"])))
+    return _NEWS % (*_head(data), _escape(data["ArticleCount"]), "".join(parts))
+
+
+# MsgType -> (字段顺序, 渲染函数)，字段和顺序都一致时才使用模板
+_RENDERERS = {
+    "text": (_TEXT_KEYS, _render_text),
+    "image": (_IMAGE_KEYS, lambda data: _render_media(_IMAGE, "Image", data)),
+    "voice": (_VOICE_KEYS, lambda data: _render_media(_VOICE, "Voice", data)),
+    "video": (_VIDEO_KEYS, _render_video),
+    "news": (_NEWS_KEYS, _render_news),
+}
+
+
+def unparse_reply(response_data:dict) -> str:
+    '''将BizApi.reply返回的{"xml": {...}}转换为xml文本'''
+    data = response_data.get("xml") if len(response_data) == 1 else None
+    if isinstance(data, dict):
+        renderer = _RENDERERS.get(data.get("MsgType"))
+        if renderer and tuple(data) == renderer[0]:
+            try:
+                return renderer[1](data)
+            except (TypeError, KeyError, AttributeError):
+                pass
+    return xmltodict.unparse(response_data)
@@ -1,43 +1,166 @@
 import sys
 import os
+import time
 import asyncio
 import settings
 from loguru import logger
 from aiohttp import web
-from tools.biz_api import BizApi
+from tools.accounts import AccountRegistry
 from tools.render_view import RenderApiView
+from tools.reply_queue import ReplyQueue
+from tools.admission import AdmissionController
+from tools.dedup import MessageDeduplicator, MemoryDedupBackend, SqliteDedupBackend
+from tools.log_sink import LogSampler, text_format
 from aiohttp.web import Application
 from middleware.verify import VerifyMiddleware
-from middleware.whitelist import whitelist_middleware
+from middleware.whitelist import CallbackWhitelist, whitelist_middleware
+from middleware.metrics import metrics_middleware, metrics_handler
 
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 
+def create_accounts(api_base:str=None) -> AccountRegistry:
+    '''默认公众号和settings.ACCOUNTS中的公众号，replay.py也用它'''
+    accounts = {settings.APPID: {"secret": settings.SECRET, "aes_key": getattr(settings, "AES_KEY", None)}}
+    accounts.update(getattr(settings, "ACCOUNTS", {}))
+    return AccountRegistry(
+        accounts, default_token=settings.TOKEN,
+        http_options=getattr(settings, "HTTP_OPTIONS", None),
+        api_base=api_base or getattr(settings, "API_BASE", "https://api.weixin.qq.com"),
+        log_dir=getattr(settings, "LOG_DIR", None)
+    )
+
+
 async def on_startup_tasks(app: Application):
-    app["ba"] = BizApi(settings.APPID, settings.SECRET, getattr(settings, "AES_key", None))
+    app["accounts"] = create_accounts()
+    # 默认公众号，回调地址为/WeChatBizServer
+    app["ba"] = app["accounts"].get(settings.APPID)
+    app["whitelist"] = CallbackWhitelist(
+        app["ba"],
+        refresh_interval=getattr(settings, "WHITELIST_REFRESH_INTERVAL", 3600),
+        trusted_proxies=getattr(settings, "TRUSTED_PROXIES", ()),
+        forwarded_header=getattr(settings, "FORWARDED_HEADER", "X-Forwarded-For")
+    )
+    await app["whitelist"].start()
+    # 在后台预热，服务先开始监听，预热完成前/ready返回503
+    app["warm_up"] = asyncio.ensure_future(warm_up(app))
+    dedup_file = getattr(settings, "DEDUP_SQLITE_FILE", None)
+    if not dedup_file and getattr(settings, "WORKERS", 1) > 1:
+        # 多进程时微信的重试可能落到其他worker，去重缓存必须共享
+        dedup_file = os.path.join(log_dir(), "dedup.db")
+    backend = SqliteDedupBackend(dedup_file) if dedup_file else MemoryDedupBackend()
+    app["dedup"] = MessageDeduplicator(backend)
+    app["admission"] = AdmissionController(
+        max_concurrent=getattr(settings, "MAX_CONCURRENT_HANDLERS", 200),
+        max_waiting=getattr(settings, "ADMISSION_QUEUE_SIZE", 200),
+        queue_timeout=getattr(settings, "ADMISSION_QUEUE_TIMEOUT", 0.5),
+        user_rate=getattr(settings, "USER_RATE_LIMIT", 1),
+        user_burst=getattr(settings, "USER_RATE_BURST", 10),
+        max_users=getattr(settings, "USER_RATE_LIMIT_SIZE", 100000),
+        reply_text=getattr(settings, "OVERLOAD_REPLY", None)
+    )
+    if getattr(settings, "ASYNC_REPLY", False):
+        reply_queue = ReplyQueue(
+            workers=getattr(settings, "ASYNC_REPLY_WORKERS", 4),
+            maxsize=getattr(settings, "ASYNC_REPLY_QUEUE_SIZE", 1000)
+        )
+        reply_queue.start()
+        app["reply_queue"] = reply_queue
+
+
+async def warm_up(app: Application):
+    '''同时获取默认公众号的access_token、载入素材缓存和回调ip白名单(当天的文件或接口)，失败时退避重试
+    就绪后再预热配置了warm_up的其他公众号，它们失败不影响就绪
+    '''
+    delay = 1
+    while True:
+        start = time.perf_counter()
+        token, whitelist = await asyncio.gather(
+            app["ba"].warm_up(), app["whitelist"].refresh(only_if_empty=True), return_exceptions=True
+        )
+        if whitelist is True and not isinstance(token, BaseException):
+            app["ready"].set()
+            logger.info(f"预热完成，耗时{time.perf_counter() - start:.3f}秒")
+            await app["accounts"].warm_up()
+            return
+        logger.warning(f"预热未完成(access_token: {token!r}, 白名单: {whitelist})，{delay}秒后重试")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
+
+
+async def ready_handler(request: web.Request):
+    '''就绪检查，负载均衡只把流量发给预热完成的实例'''
+    if not request.app["ready"].is_set():
+        raise web.HTTPServiceUnavailable(reason="Warming up")
+    return web.Response(text="ok")
 
 
 async def on_cleanup_tasks(app: Application):
-    await app["ba"].close()
+    app["warm_up"].cancel()
+    await asyncio.gather(app["warm_up"], return_exceptions=True)
+    if "reply_queue" in app:
+        await app["reply_queue"].close()
+    await app["whitelist"].close()
+    await app["accounts"].close()
+    app["dedup"].close()
+    if "journal" in app:
+        app["journal"].close()
+
+def log_dir():
+    '''日志和缓存文件的目录，settings.LOG_DIR没有设置时为当前目录下的log'''
+    return getattr(settings, "LOG_DIR", None) or "log"
+
 
-def init_app():
+def init_app(worker_id:int=None):
     logger.remove(handler_id=None)
-    os.makedirs("log", exist_ok=True)
-    logger.add(sys.stdout,  level="INFO")
-    logger.add("log/web_app.log",  level="DEBUG", compression="zip", rotation="1 days")
+    os.makedirs(log_dir(), exist_ok=True)
+    sampler = LogSampler(getattr(settings, "LOG_SAMPLE_RATES", None))
+    # 每条记录只采样一次，stdout和文件写出同样的记录
+    logger.configure(patcher=sampler.patch)
+    logger.add(sys.stdout, level=getattr(settings, "LOG_STDOUT_LEVEL", "INFO"), format=text_format, filter=sampler)
+    # 多进程时每个worker写自己的日志文件，避免轮转时互相覆盖
+    log_name = os.path.join(log_dir(), "web_app" if worker_id is None else f"web_app.{worker_id}")
+    if getattr(settings, "LOG_FORMAT", "text") == "json":
+        from tools.log_sink import BackgroundJsonSink
+        sink = BackgroundJsonSink(f"{log_name}.json", queue_size=getattr(settings, "LOG_QUEUE_SIZE", 10000))
+        logger.add(sink, level="DEBUG", format="{message}", filter=sampler)
+    else:
+        logger.add(f"{log_name}.log", level="DEBUG", format=text_format, filter=sampler, compression="zip", rotation="1 days")
     
-    middlewares=[whitelist_middleware, VerifyMiddleware(settings.TOKEN)]
+    middlewares=[metrics_middleware, whitelist_middleware, VerifyMiddleware(settings.TOKEN)]
     app = web.Application(middlewares=middlewares)
-    app.router.add_view('/WeChatBizServer', RenderApiView)
+    app["ready"] = asyncio.Event()
+    journal_dir = getattr(settings, "JOURNAL_DIR", None)
+    if journal_dir:
+        from tools.journal import Journal
+        app["journal"] = Journal(
+            journal_dir, name="journal" if worker_id is None else f"journal.{worker_id}",
+            segment_size=getattr(settings, "JOURNAL_SEGMENT_SIZE", 64 * 1024 * 1024),
+            fsync=getattr(settings, "JOURNAL_FSYNC", False)
+        )
+    # 这些路径不经过白名单和签名校验
+    app["public_paths"] = {"/metrics", "/ready"}
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/ready", ready_handler)
+    RenderApiView().setup(app, '/WeChatBizServer')
     app.on_startup.append(on_startup_tasks)
     app.on_cleanup.append(on_cleanup_tasks)
     return app
 
     
 if __name__ == "__main__":
-    app = init_app()
     port = settings.API_PORT
-    loop = asyncio.get_event_loop()
-    web.run_app(app, port=port, loop=loop)
+    workers = getattr(settings, "WORKERS", 1)
+    if workers > 1:
+        from tools.prefork import PreforkServer
+        PreforkServer(
+            init_app, port, workers=workers,
+            reuse_port=getattr(settings, "WORKER_REUSE_PORT", False),
+            shutdown_timeout=getattr(settings, "SHUTDOWN_TIMEOUT", 30)
+        ).run()
+    else:
+        app = init_app()
+        loop = asyncio.get_event_loop()
+        web.run_app(app, port=port, loop=loop)
     
\ No newline at end of file